@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+# heap allocations of snapshot loads and OSD redraws
+# runs in micropython (unix port, or ESP32 with esp32/ on its
+# path) and on a PC. SPI is a null backend that allocates
+# nothing behind plain spibus, spidiff keeps a CRC per block.
+# every case runs once to grow loader buffers, then once
+# measured. micropython: bytes allocated with gc disabled,
+# exact. CPython: tracemalloc peak, catches buffers, slices
+# and strings made per block or per line, not small objects.
+# exits with status 1 when a case is over its budget.
+# snapshots/ files are copied to workdir, replay files are
+# made in workdir/.zxcache, workdir is removed at the end.
+
+# LICENSE=BSD
+
+# usage:
+#   micropython esp32/bench/zxalloc.py [workdir]
+#   python3 esp32/bench/zxalloc.py [workdir]
+
+import gc
+import os
+import sys
+
+MICROPYTHON=sys.implementation.name=="micropython"
+HERE=__file__.rsplit("/",1)[0] if "/" in __file__ else "."
+ROOT=HERE+"/../.."
+sys.path.insert(0,ROOT+"/esp32")
+
+import spibus
+import ld_zxspectrum
+import ld_replay
+import dirindex
+import osdfb
+
+if not MICROPYTHON:
+  import tracemalloc
+
+# bytes per case, (micropython allocated, CPython peak)
+# micropython 1.27 measured: loads 0-64, a "%" print of a 128K
+# snapshot and the (pc,header) tuple, replays 16, OSD 0-16.
+# CPython 3.11: loads 260-748, replays 184-192, OSD 160-360
+BUDGETS={"load":(64,768),"osd":(16,384)}
+
+class nullspi:
+  def on(self):
+    pass
+
+  def off(self):
+    pass
+
+  def write(self,buf):
+    pass
+
+  def readinto(self,buf,write=0):
+    pass
+
+  def write_readinto(self,wbuf,rbuf):
+    pass
+
+# os.ilistdir for dirindex on a PC
+class hostos:
+  def ilistdir(self,path):
+    for e in os.scandir(path):
+      yield (e.name,0x4000 if e.is_dir() else 0x8000,0,e.stat().st_size)
+
+  def __getattr__(self,name):
+    return getattr(os,name)
+
+# unbuffered on a PC, its read buffer is not the loader's
+def sdopen(path):
+  if MICROPYTHON:
+    return open(path,"rb")
+  return open(path,"rb",buffering=0)
+
+def exists(path):
+  try:
+    os.stat(path)
+    return True
+  except OSError:
+    return False
+
+def allocated(run,state):
+  if MICROPYTHON:
+    gc.collect()
+    gc.disable()
+    a=gc.mem_alloc()
+    run(state)
+    a=gc.mem_alloc()-a
+    gc.enable()
+    return a
+  tracemalloc.start()
+  base=tracemalloc.get_traced_memory()[0]
+  tracemalloc.reset_peak()
+  run(state)
+  a=tracemalloc.get_traced_memory()[1]-base
+  tracemalloc.stop()
+  return a
+
+# RAM page i of synthetic snapshots: screen-like noise with
+# single and repeated ED, runs of zeros and of one byte
+def page(i):
+  p=bytearray(0x4000)
+  x=0x1234+i
+  for k in range(0x1800):
+    x^=(x<<7)&0xFFFF
+    x^=x>>9
+    x^=(x<<8)&0xFFFF
+    p[k]=x&0xFF if x&0x300 else 0xED
+  for k in range(0x2000,0x2400):
+    p[k]=0xED
+  for k in range(0x3000,0x3100):
+    p[k]=i
+  return p
+
+# .z80 RLE, single ED is followed by a literal
+def rle(data):
+  out=bytearray()
+  i=0
+  lit=0
+  while i < len(data):
+    b=data[i]
+    n=1
+    if not lit:
+      while i+n < len(data) and data[i+n]==b and n < 255:
+        n+=1
+    if n > 4 or (b==0xED and n > 1):
+      out.extend(bytes((0xED,0xED,n,b)))
+    else:
+      out.extend(data[i:i+n])
+    lit=b==0xED and n==1
+    i+=n
+  return out
+
+def header(pc):
+  h=bytearray(30)
+  h[6]=pc&0xFF
+  h[7]=pc>>8
+  h[8]=0x00 # SP
+  h[9]=0xFF
+  h[27]=1 # EI
+  h[29]=1 # IM 1
+  return h
+
+# v3 snapshot, 48K pages 8,4,5 or 128K banks 0-7
+def z80v3(mem128):
+  h2=bytearray(54)
+  h2[0]=0x00 # PC
+  h2[1]=0x80
+  h2[2]=4 if mem128 else 0
+  h2[3]=0x13 # ROM 1, bank 3
+  data=header(0)+bytes((54,0))+h2
+  for p in range(3,11) if mem128 else (8,4,5):
+    c=rle(page(p))
+    data+=bytes((len(c)&0xFF,len(c)>>8,p))+c
+  return data
+
+def sna(mem128):
+  h=bytearray(27)
+  h[23]=0x00 # SP
+  h[24]=0xFF
+  h[25]=1 # IM 1
+  data=h+page(5)+page(2)+page(0)
+  if mem128:
+    data+=bytes((0x00,0x80,0x10,0))
+    for b in (1,3,4,6,7):
+      data+=page(b)
+  return data
+
+class zxalloc:
+  def __init__(self,workdir):
+    self.workdir=workdir
+    self.bus=spibus.spibus(nullspi(),nullspi())
+    self.ld=ld_zxspectrum.ld_zxspectrum(self.bus)
+    self.ld.mem128=1 # nullspi has no RAM to probe for 128K core
+    self.ld.replay_cache=ld_replay.ld_replay(self.ld,workdir+"/.zxcache")
+    self.over=0
+
+  def case(self,name,kind,setup,run):
+    budget=BUDGETS[kind][0 if MICROPYTHON else 1]
+    for i in range(2):
+      state=setup()
+      if i:
+        a=allocated(run,state)
+      else:
+        run(state)
+      if hasattr(state,"close"):
+        state.close()
+    if a > budget:
+      self.over+=1
+    print("%-28s %6d %6d %s" % (name,a,budget,"OVER" if a > budget else ""))
+
+  def write(self,name,data):
+    path=self.workdir+"/"+name
+    f=open(path,"wb")
+    f.write(data)
+    f.close()
+    return path
+
+  def snapshots(self):
+    files=[]
+    for name in ("wow.z80","chap26.sna"):
+      if exists(ROOT+"/snapshots/"+name):
+        f=open(ROOT+"/snapshots/"+name,"rb")
+        files.append(self.write(name,f.read()))
+        f.close()
+    files.append(self.write("v3_48.z80",z80v3(0)))
+    files.append(self.write("v3_128.z80",z80v3(1)))
+    files.append(self.write("regs.sna",sna(0)))
+    files.append(self.write("128.sna",sna(1)))
+    return files
+
+  def loads(self):
+    ld=self.ld
+    for path in self.snapshots():
+      name=path.rsplit("/",1)[1]
+      def setup(path=path):
+        return sdopen(path)
+      if name.endswith(".z80"):
+        def run(z):
+          ld.cpu_halt()
+          image=ld.load_z80(z)
+          ld.run(image[0],image[1])
+      else:
+        def run(z):
+          ld.load_sna(z)
+      self.case("load/"+name,"load",setup,run)
+      if name.endswith(".z80"):
+        ld.loadz80(path) # compiles replay file
+        cachefile=ld.replay_cache.cachefile(path)
+        def setup(cachefile=cachefile):
+          f=sdopen(cachefile)
+          self.boot=f.read(16)[14]
+          return f
+        def run(f):
+          ld.replay_cache.replay(f,self.boot)
+        self.case("replay/"+name,"load",setup,run)
+
+  def osd(self):
+    d=self.workdir+"/osd"
+    os.mkdir(d)
+    for i in range(100):
+      self.write("osd/game%03d.z80" % ((i*37)%100),bytes(i*97))
+    os.mkdir(d+"/subdir")
+    fb=osdfb.osdfb(spibus.spibus(nullspi(),nullspi()),d)
+    fb.show_dir()
+    def cursor():
+      fb.jump(5,0)
+      return fb
+    self.case("osd/cursor","osd",cursor,lambda fb:fb.move_dir_cursor(1))
+    def bottom():
+      fb.jump(19,0)
+      return fb
+    self.case("osd/scroll","osd",bottom,lambda fb:fb.move_dir_cursor(1))
+    def top():
+      fb.jump(0,0)
+      return fb
+    self.case("osd/page","osd",top,lambda fb:fb.move_dir_page(1))
+    def search():
+      fb.jump(0,0)
+      fb.type_key(27)
+      return fb
+    self.case("osd/search","osd",search,lambda fb:fb.type_key(ord("g")))
+
+def rmtree(path):
+  for name in os.listdir(path):
+    p=path+"/"+name
+    if os.stat(p)[0]&0x4000:
+      rmtree(p)
+    else:
+      os.remove(p)
+  os.rmdir(path)
+
+def main():
+  workdir=sys.argv[1] if len(sys.argv) > 1 else "zxalloc.tmp"
+  if not hasattr(os,"ilistdir"):
+    dirindex.os=hostos()
+  if exists(workdir): # left over from an interrupted run
+    rmtree(workdir)
+  os.mkdir(workdir)
+  z=zxalloc(workdir)
+  try:
+    z.loads()
+    z.osd()
+  finally:
+    rmtree(workdir)
+  print("%s: %d cases over budget, %s" % (sys.implementation.name,z.over,
+    "bytes allocated" if MICROPYTHON else "peak bytes"))
+  return 1 if z.over else 0
+
+if __name__=="__main__":
+  sys.exit(main())
@@ -0,0 +1,548 @@
+#!/usr/bin/env python3
+
+# load performance benchmark of ESP32 loaders and OSD browser
+# runs on a PC against spimodel (FPGA SPI slave) and
+# a counting SD card (host files)
+
+# LICENSE=BSD
+
+# usage:
+#   zxbench.py --out new.json                 # run, write results
+#   zxbench.py --out new.json --compare old.json
+# counters are exact and must not grow, time may vary within --time-tolerance
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+import contextlib
+import gzip
+import io
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.normpath(os.path.join(HERE, "..", ".."))
+sys.path.insert(0, os.path.join(ROOT, "esp32"))
+
+import spimodel
+import spibus
+import spidiff
+import ld_zxspectrum
+import ld_replay
+import ld_rom
+import ld_tape
+import osdfb
+import dirindex
+import catalog
+import gzstream
+
+# counters that are deterministic, any increase is a regression
+COUNTERS = ("transactions", "toggles", "calls", "bytes", "sd_reads", "sd_bytes", "sd_seeks", "sd_stats")
+
+
+# SD card simulation: host files with access counters
+class sdcard:
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.reads = 0
+    self.bytes = 0
+    self.seeks = 0
+    self.stats = 0
+
+  def open(self, name, mode="r"):
+    return sdfile(self, open(name, mode))
+
+
+class sdfile:
+  def __init__(self, sd, f):
+    self.sd = sd
+    self.f = f
+
+  def read(self, n=-1):
+    self.sd.reads += 1
+    b = self.f.read(n)
+    self.sd.bytes += len(b)
+    return b
+
+  def readinto(self, buf):
+    self.sd.reads += 1
+    n = self.f.readinto(buf)
+    self.sd.bytes += n or 0
+    return n
+
+  def seek(self, *args):
+    self.sd.seeks += 1
+    return self.f.seek(*args)
+
+  def __getattr__(self, name):
+    return getattr(self.f, name)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.f.close()
+
+
+# transfer time of SD reads and SPI writes as sleep,
+# which lets the other thread run like a driver without GIL
+class latency:
+  def __init__(self, f, rate):
+    self.f = f
+    self.rate = rate # bytes per second
+
+  def readinto(self, buf):
+    n = self.f.readinto(buf)
+    time.sleep((n or 0) / self.rate)
+    return n
+
+  def write(self, buf):
+    time.sleep(len(buf) / self.rate)
+    return self.f.write(buf)
+
+  def __getattr__(self, name):
+    return getattr(self.f, name)
+
+
+# os module with counted stat/listdir
+class sdos:
+  def __init__(self, sd):
+    self.sd = sd
+
+  def stat(self, name):
+    self.sd.stats += 1
+    st = os.stat(name)
+    return (st.st_mode, st.st_ino, st.st_dev, st.st_nlink, st.st_uid, st.st_gid,
+      st.st_size, int(st.st_atime), int(st.st_mtime), int(st.st_ctime))
+
+  def listdir(self, name):
+    self.sd.stats += 1
+    return os.listdir(name)
+
+  def ilistdir(self, name):
+    self.sd.stats += 1
+    for e in os.scandir(name):
+      st = e.stat()
+      yield (e.name, 0x4000 if e.is_dir() else 0x8000, 0, st.st_size)
+
+  def __getattr__(self, name):
+    return getattr(os, name)
+
+
+# ecp5.prog_stream with counters like spimodel, checks content
+class ecp5model:
+  def __init__(self, crc):
+    self.crc = crc
+    self.reset_stats()
+
+  def reset_stats(self):
+    self.transactions = 0
+    self.toggles = 0
+    self.calls = 0
+    self.bytes = 0
+
+  def prog_stream(self, filedata, blocksize=16384):
+    self.transactions += 1
+    self.toggles += 2
+    block = bytearray(blocksize)
+    crc = 0
+    while True:
+      n = filedata.readinto(block)
+      if not n:
+        break
+      self.calls += 1
+      self.bytes += len(block)
+      crc = zlib.crc32(block[0:n], crc)
+    if crc != self.crc:
+      raise ValueError("bitstream content differs")
+
+
+# bitstream-like data: frames of configuration bits, mostly zero
+def bitstream(size):
+  rnd = random.Random(2)
+  out = bytearray(size)
+  for frame in range(0, size, 104):
+    if rnd.random() < 0.3:
+      for i in range(frame, min(size, frame + 104)):
+        if rnd.random() < 0.25:
+          out[i] = rnd.getrandbits(8)
+  return bytes(out)
+
+
+# .z80 RLE, only for generating test files
+def rle(data):
+  out = bytearray()
+  i = 0
+  n = len(data)
+  while i < n:
+    b = data[i]
+    j = i + 1
+    while j < n and j - i < 255 and data[j] == b:
+      j += 1
+    run = j - i
+    if run >= 5 or (b == 0xED and run >= 2):
+      out += bytes([0xED, 0xED, run, b])
+      i = j
+    else:
+      out.append(b)
+      i += 1
+      if b == 0xED and i < n: # byte after single ED is never part of a run
+        out.append(data[i])
+        i += 1
+  return bytes(out)
+
+
+def z80_header1(pc):
+  h = bytearray(30)
+  h[0:8] = struct.pack("<BBHHH", 0x12, 0x34, 0x5678, 0x9ABC, pc)
+  h[8:10] = struct.pack("<H", 0xFF00)
+  h[10] = 0x3F
+  h[12] = 0x20 | (2 << 1) # compressed, border
+  h[23:25] = struct.pack("<H", 0x5C3A)
+  h[27] = 1
+  h[29] = 1
+  return h
+
+
+def make_z80(ram, version, compress=True):
+  if version == 1:
+    h = z80_header1(0x8000)
+    if not compress:
+      h[12] &= ~0x20
+      return bytes(h) + ram
+    return bytes(h) + rle(ram) + b"\x00\xED\xED\x00"
+  h = z80_header1(0)
+  length2 = 23 if version == 2 else 54
+  h2 = bytearray(length2)
+  h2[0:2] = struct.pack("<H", 0x8000)
+  out = bytearray(h) + struct.pack("<H", length2) + h2
+  for page, addr in ((8, 0x4000), (4, 0x8000), (5, 0xC000)):
+    data = ram[addr - 0x4000:addr]
+    if compress:
+      c = rle(data)
+      out += struct.pack("<HB", len(c), page) + c
+    else:
+      out += struct.pack("<HB", 0xFFFF, page) + data
+  return bytes(out)
+
+
+def synthetic(dirname):
+  rnd = random.Random(1)
+  empty = bytes(0xC000)
+  noise = bytes(rnd.getrandbits(8) for _ in range(0xC000))
+  # typical: screen with patterns, code, zeroed areas
+  typical = bytearray(0xC000)
+  for i in range(0x1800):
+    typical[i] = (i * 7) & 0xFF if (i >> 8) & 1 else 0
+  typical[0x1800:0x1B00] = b"\x38" * 0x300
+  typical[0x4000:0x6000] = noise[0:0x2000]
+  typical = bytes(typical)
+  files = {
+    "synth_v1_empty.z80": make_z80(empty, 1),
+    "synth_v1_noise.z80": make_z80(noise, 1),
+    "synth_v1_raw.z80": make_z80(typical, 1, False),
+    "synth_v2_typical.z80": make_z80(typical, 2),
+    "synth_v3_typical.z80": make_z80(typical, 3),
+    "synth_v3_empty.z80": make_z80(empty, 3),
+    "synth_v3_noise.z80": make_z80(noise, 3),
+    "synth_v3_raw.z80": make_z80(typical, 3, False),
+    "synth_ed.z80": make_z80(bytes([0xED, 0xED, 0, 0xED, 1] * (0xC000 // 5)) + bytes(0xC000 % 5), 3),
+  }
+  sna = bytearray(27)
+  sna[23:25] = struct.pack("<H", 0xFF00)
+  sna[25] = 1
+  files["synth.sna"] = bytes(sna) + typical
+  for name, data in files.items():
+    with open(os.path.join(dirname, name), "wb") as f:
+      f.write(data)
+  return sorted(files)
+
+
+class bench:
+  def __init__(self, repeat):
+    self.repeat = repeat
+    self.rom = open(os.path.join(ROOT, "roms", "opense.rom"), "rb").read()
+    self.sd = sdcard()
+    self.os = sdos(self.sd)
+    for m in (ld_zxspectrum, ld_replay, ld_tape, ld_rom, osdfb, dirindex, catalog):
+      m.open = self.sd.open
+    for m in (ld_replay, osdfb, dirindex):
+      m.os = self.os
+    self.results = {}
+
+  def model(self):
+    m = spimodel.spimodel(self.rom)
+    return m, spibus.spibus(m, m)
+
+  # setup() returns state, run(state) is measured
+  def case(self, name, setup, run):
+    # counters and allocations from one run
+    state = setup()
+    m = state[0]
+    m.reset_stats()
+    self.sd.reset()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    with contextlib.redirect_stdout(io.StringIO()):
+      run(state)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    r = {
+      "transactions": m.transactions,
+      "toggles": m.toggles,
+      "calls": m.calls,
+      "bytes": m.bytes,
+      "sd_reads": self.sd.reads,
+      "sd_bytes": self.sd.bytes,
+      "sd_seeks": self.sd.seeks,
+      "sd_stats": self.sd.stats,
+      "alloc_peak": peak - base,
+      "alloc_retained": current - base,
+    }
+    # wall time, best of repeats
+    best = None
+    for i in range(self.repeat):
+      state = setup()
+      t = time.perf_counter()
+      with contextlib.redirect_stdout(io.StringIO()):
+        run(state)
+      t = time.perf_counter() - t
+      best = t if best is None or t < best else best
+    r["time_ms"] = round(best * 1000, 3)
+    self.results[name] = r
+    print("%-36s %6d tr %7d B %6d calls %6d sdB %8.3f ms %7d alloc" %
+      (name, r["transactions"], r["bytes"], r["calls"], r["sd_bytes"], r["time_ms"], r["alloc_peak"]))
+
+  def loaders(self, files):
+    for path in files:
+      name = os.path.basename(path)
+      def setup():
+        m, bus = self.model()
+        return m, ld_zxspectrum.ld_zxspectrum(bus)
+      if name.endswith(".z80"):
+        self.case("loadz80/" + name, setup, lambda s: s[1].loadz80(path, cache=0))
+        cache = os.path.join(os.path.dirname(path), ".zxcache")
+        def warm_setup():
+          s = setup()
+          s[1].replay_cache = ld_replay.ld_replay(s[1], cache)
+          with contextlib.redirect_stdout(io.StringIO()):
+            s[1].loadz80(path)
+          return s
+        self.case("loadz80_cached/" + name, warm_setup, lambda s: s[1].loadz80(path))
+        shutil.rmtree(cache, ignore_errors=True)
+        # ROM manager already knows the ROM
+        def rom_setup():
+          m, bus = self.model()
+          rom = ld_rom.ld_rom(bus)
+          with contextlib.redirect_stdout(io.StringIO()):
+            ld_zxspectrum.ld_zxspectrum(bus, rom).loadz80(path, cache=0)
+          return m, ld_zxspectrum.ld_zxspectrum(bus, rom)
+        self.case("loadz80_rom/" + name, rom_setup, lambda s: s[1].loadz80(path, cache=0))
+      elif name.endswith(".sna") and os.path.getsize(path) != 0xC000:
+        self.case("loadsna/" + name, setup, lambda s: s[1].loadsna(path))
+      elif name.endswith(".tap") or name.endswith(".tzx"):
+        self.case("loadtap/" + name, setup, lambda s: s[1].loadtap(path))
+      else:
+        def stream(s):
+          s[1].cpu_halt()
+          s[1].load_stream(self.sd.open(path, "rb"), 0x4000, 0xC000)
+          s[1].cpu_continue()
+        self.case("load_stream/" + name, setup, stream)
+
+  # second load of the same data through spidiff, CPU halted in between
+  # or only ROM reloaded after CPU ran
+  def reload(self, files):
+    def rom(s):
+      s[1].cpu_halt()
+      s[1].load_stream(self.sd.open(os.path.join(ROOT, "roms", "opense.rom"), "rb"), 0, 0x4000)
+      s[1].cpu_continue()
+    def rom_setup():
+      m = spimodel.spimodel(self.rom)
+      s = (m, ld_zxspectrum.ld_zxspectrum(spidiff.spidiff(m, m)))
+      rom(s)
+      return s
+    self.case("reload_rom", rom_setup, rom)
+    for path in files:
+      name = os.path.basename(path)
+      if not name.endswith(".bin"):
+        continue
+      def stream(s):
+        s[1].load_stream(self.sd.open(path, "rb"), 0x4000, 0xC000)
+      def setup():
+        m = spimodel.spimodel(self.rom)
+        s = (m, ld_zxspectrum.ld_zxspectrum(spidiff.spidiff(m, m)))
+        s[1].cpu_halt()
+        stream(s)
+        return s
+      self.case("reload_stream/" + name, setup, stream)
+
+  # SD 1 MB/s and SPI 8 MHz as sleeps, serial load takes the sum
+  # of both times, read ahead in a thread about the longer.
+  # CPython sleeps release the GIL, an ESP32 driver may not
+  def overlap(self, path):
+    for nbuf in (1, 2):
+      def setup():
+        m = spimodel.spimodel(self.rom)
+        return m, ld_zxspectrum.ld_zxspectrum(spibus.spibus(latency(m, 1000000), m))
+      def stream(s, nbuf=nbuf):
+        s[1].cpu_halt()
+        s[1].load_stream(latency(self.sd.open(path, "rb"), 1000000), 0x4000, 0xC000, nbuf=nbuf)
+        s[1].cpu_continue()
+      self.case("load_stream_overlap/nbuf%d" % nbuf, setup, stream)
+
+  def osd(self, dirname, entries):
+    d = os.path.join(dirname, "dir%d" % entries)
+    os.mkdir(d)
+    for i in range(entries):
+      with open(os.path.join(d, "game%05d.z80" % ((i * 7919) % entries)), "wb") as f:
+        f.write(bytes(i % 3000))
+    os.mkdir(os.path.join(d, "subdir"))
+    def setup():
+      m, bus = self.model()
+      return [m, bus]
+    def read_dir(s):
+      s.append(osdfb.osdfb(s[1], d))
+    def index_setup():
+      try:
+        os.remove(os.path.join(d, dirindex.INDEX))
+      except OSError:
+        pass
+      return setup()
+    self.case("osd_read_dir/%d" % entries, index_setup, read_dir)
+    def indexed_setup():
+      with contextlib.redirect_stdout(io.StringIO()):
+        dirindex.dirindex(d)
+      return setup()
+    self.case("osd_read_dir_indexed/%d" % entries, indexed_setup, read_dir)
+    def fb_setup():
+      m, bus = self.model()
+      with contextlib.redirect_stdout(io.StringIO()):
+        fb = osdfb.osdfb(bus, d)
+      return m, bus, fb
+    self.case("osd_show_dir/%d" % entries, fb_setup, lambda s: s[2].show_dir())
+    def scroll(s):
+      for i in range(100):
+        s[2].move_dir_cursor(1)
+    self.case("osd_scroll100/%d" % entries, fb_setup, scroll)
+    def shown_setup():
+      s = fb_setup()
+      s[2].show_dir()
+      return s
+    def search(s):
+      for c in b"game%05d" % (entries - 1):
+        s[2].type_key(c)
+    self.case("osd_search/%d" % entries, shown_setup, search)
+    def page(s):
+      for i in range(10):
+        s[2].move_dir_page(1)
+    self.case("osd_page10/%d" % entries, shown_setup, page)
+    # BTN held 1 s: 15 frames after repeat delay, steps due per frame
+    def autorepeat(s):
+      done = 0
+      for frames in range(1, 16):
+        steps = osdfb.autorepeat_steps(frames)
+        s[2].move_dir_cursor(steps - done)
+        done = steps
+    self.case("osd_autorepeat1s/%d" % entries, shown_setup, autorepeat)
+
+
+  # core switch: plain .bit and compressed .bit.gz/.bit.z
+  def bitstreams(self, dirname):
+    data = bitstream(595959) # about 12F/25F size
+    crc = zlib.crc32(data)
+    z = zlib.compressobj(9, zlib.DEFLATED, 12) # 4K window
+    files = {
+      "core.bit": data,
+      "core.bit.gz": gzip.compress(data, 9),
+      "core.bit.z": z.compress(data) + z.flush(),
+    }
+    for name, d in files.items():
+      path = os.path.join(dirname, name)
+      with open(path, "wb") as f:
+        f.write(d)
+      def setup():
+        return [ecp5model(crc)]
+      def prog(s, path=path):
+        f = self.sd.open(path, "rb")
+        if not path.endswith(".bit"):
+          f = gzstream.gzstream(f)
+        s[0].prog_stream(f, blocksize=1024)
+        f.close()
+      self.case("bitstream/" + name, setup, prog)
+
+
+def compare(old, new, time_tolerance):
+  regressions = 0
+  for name, r in sorted(new["cases"].items()):
+    o = old["cases"].get(name)
+    if o is None:
+      continue
+    for k in COUNTERS + ("time_ms", "alloc_peak"):
+      if k not in o or k not in r:
+        continue
+      a, b = o[k], r[k]
+      if k == "time_ms":
+        worse = b > a * (1 + time_tolerance)
+      else:
+        worse = b > a
+      if a != b and (worse or k != "time_ms"):
+        print("%-6s %-36s %-14s %10s -> %10s" % ("WORSE" if worse else "better", name, k, a, b))
+      if worse and k != "alloc_peak":
+        regressions += 1
+  return regressions
+
+
+def main():
+  ap = argparse.ArgumentParser(description="ZX spectrum ESP32 loader benchmark")
+  ap.add_argument("--out", help="write JSON results")
+  ap.add_argument("--compare", help="JSON results of previous run")
+  ap.add_argument("--repeat", type=int, default=5, help="timed runs per case")
+  ap.add_argument("--time-tolerance", type=float, default=0.25)
+  ap.add_argument("--entries", type=int, nargs="*", default=[100, 2000], help="OSD directory sizes")
+  args = ap.parse_args()
+
+  tmp = tempfile.mkdtemp(prefix="zxbench")
+  try:
+    snapshots = os.path.join(ROOT, "snapshots")
+    files = []
+    for name in sorted(os.listdir(snapshots)):
+      shutil.copy(os.path.join(snapshots, name), tmp)
+      files.append(os.path.join(tmp, name))
+    files += [os.path.join(tmp, name) for name in synthetic(tmp)]
+    b = bench(args.repeat)
+    b.loaders(files)
+    b.reload(files)
+    b.bitstreams(tmp)
+    b.overlap(os.path.join(tmp, "galaxians.bin"))
+    for n in args.entries:
+      b.osd(tmp, n)
+  finally:
+    shutil.rmtree(tmp, ignore_errors=True)
+
+  result = {
+    "python": platform.python_version(),
+    "machine": platform.machine(),
+    "cases": b.results,
+  }
+  if args.out:
+    with open(args.out, "w") as f:
+      json.dump(result, f, indent=1, sort_keys=True)
+  if args.compare:
+    with open(args.compare) as f:
+      old = json.load(f)
+    if compare(old, result, args.time_tolerance):
+      sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
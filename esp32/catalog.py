@@ -0,0 +1,88 @@
+# micropython ESP32
+# snapshot library catalogue, written on a PC by converter/zxcatalog.py
+
+# LICENSE=BSD
+
+# ".zxcatalog" file at the top of a library tree, entries
+# sorted by path relative to that directory, "/" separated.
+# loaded like dirindex, with a few readinto into arrays.
+
+# header "<4sLL": magic, n, paths length
+# offsets "I"*(n+1): path offsets, last is paths length
+# info "H"*n: bits 2-0 format, bits 5-3 version,
+#   bit 6 broken, bit 7 duplicate, bit 8 128K
+# sizes "I"*n: file size
+# ratio "H"*n: file size per 1000 bytes of memory
+# hashes 8*n bytes: start of sha1 of memory content
+# paths
+
+from struct import unpack
+from dirindex import zeros
+
+MAGIC = b"ZXC1"
+CATALOG = ".zxcatalog"
+FORMAT_Z80 = 1
+FORMAT_SNA = 2
+FORMAT_TAP = 3
+FORMAT_TZX = 4
+FORMATS = (None, "z80", "sna", "tap", "tzx")
+BROKEN = 0x40
+DUPLICATE = 0x80
+MEM128 = 0x100
+
+class catalog:
+  def __init__(self, filename):
+    self.filename = filename
+    f = open(filename, "rb")
+    header = f.read(12)
+    if len(header) != 12 or header[0:4] != MAGIC:
+      f.close()
+      raise OSError("bad catalogue %s" % filename)
+    magic, n, length = unpack("<4sLL", header)
+    self.offsets = zeros("I", n+1)
+    self.info = zeros("H", n)
+    self.sizes = zeros("I", n)
+    self.ratio = zeros("H", n)
+    self.hashes = bytearray(8*n)
+    self.paths = bytearray(length)
+    for a in (self.offsets, self.info, self.sizes, self.ratio, self.hashes, self.paths):
+      f.readinto(a)
+    f.close()
+
+  def __len__(self):
+    return len(self.info)
+
+  def path(self, i):
+    return str(self.paths[self.offsets[i]:self.offsets[i+1]], "utf-8")
+
+  # path i compared to prefix+name without allocation
+  def cmp(self, i, prefix, name):
+    paths = self.paths
+    a = self.offsets[i]
+    la = self.offsets[i+1]-a
+    lp = len(prefix)
+    lb = lp+len(name)
+    for k in range(min(la, lb)):
+      c = prefix[k] if k < lp else name[k-lp]
+      if paths[a+k] != c:
+        return -1 if paths[a+k] < c else 1
+    return (la > lb)-(la < lb)
+
+  # index of first path not less than prefix+name
+  def find(self, prefix, name=b"", lo=0, hi=-1):
+    if hi < 0:
+      hi = len(self.info)
+    while lo < hi:
+      mid = (lo+hi)//2
+      if self.cmp(mid, prefix, name) < 0:
+        lo = mid+1
+      else:
+        hi = mid
+    return lo
+
+  # info of prefix+name, -1 if not catalogued
+  def lookup(self, prefix, name, lo=0, hi=-1):
+    i = self.find(prefix, name, lo, hi)
+    if i < len(self.info) and self.cmp(i, prefix, name) == 0:
+      return self.info[i]
+    return -1
@@ -1,20 +1,42 @@
 #!/usr/bin/env python3
 
-# convert raw code from a file to orao snapshot
-
-import struct
-code=open("../../roms/opense.rom","rb").read()
-addr=0xC000
-f = open("rom.z80","wb")
-header1 = bytearray(30)
-header2 = bytearray(23)
-header3 = bytearray(3)
-pc=0
-header2[0:2] = struct.pack("<H",pc)
-header3 = struct.pack("<HB",0xFFFF,0) # 16K uncompressed, page 0 (ROM)
-f.write(header1)
-f.write(struct.pack("<H",len(header2)))
-f.write(header2)
-f.write(header3)
-f.write(code)
-f.close()
+# convert raw code from a file to .z80 snapshot
+# ROM at address 0 is page 0, loaded over the FPGA ROM area
+
+# usage:
+#   rom2z80.py                                  # opense.rom -> rom.z80
+#   rom2z80.py 48.rom -o 48.z80
+#   rom2z80.py code.bin --addr 0x8000 -o code.z80
+
+import argparse
+import os
+import sys
+
+import zxconvert
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+  ap = argparse.ArgumentParser(description="raw code or ROM to .z80 snapshot")
+  ap.add_argument("code", nargs="?", default=os.path.normpath(os.path.join(HERE, "..", "..", "roms", "opense.rom")))
+  ap.add_argument("-o", "--out", default="rom.z80")
+  ap.add_argument("--addr", type=lambda s: int(s, 0), default=0, help="load address, 0 is ROM")
+  ap.add_argument("--pc", type=lambda s: int(s, 0), default=-1, help="start address, default addr")
+  args = ap.parse_args()
+
+  code = open(args.code, "rb").read()
+  try:
+    s = zxconvert.read_raw(code, args.addr, args.pc)
+  except zxconvert.broken as e:
+    print("%s: %s" % (args.code, e))
+    return 1
+  data = zxconvert.write_z80(s)
+  with open(args.out, "wb") as f:
+    f.write(data)
+  print("%s -> %s %d bytes" % (args.code, args.out, len(data)))
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
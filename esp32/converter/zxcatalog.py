@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+
+# catalogue of a .z80/.sna/.tap/.tzx library tree for the OSD browser
+# files are checked in parallel by a process pool: header and
+# blocks are validated, memory is decoded and hashed, screen
+# 0x4000-0x5AFF is written as PNG thumbnail (needs numpy)
+
+# LICENSE=BSD
+
+# usage:
+#   zxcatalog.py /path/to/library                   # write library/.zxcatalog
+#   zxcatalog.py /path/to/library --thumbs thumbs   # and thumbs/<hash>.png
+# broken files and groups of duplicates (same memory content)
+# are listed, --strict exits with status 1 when any are found
+
+import argparse
+import concurrent.futures
+import hashlib
+import os
+import struct
+import sys
+import zlib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.normpath(os.path.join(HERE, "..")))
+
+import catalog
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+EXTENSIONS = {
+  ".z80": catalog.FORMAT_Z80,
+  ".sna": catalog.FORMAT_SNA,
+  ".tap": catalog.FORMAT_TAP,
+  ".tzx": catalog.FORMAT_TZX,
+}
+HIDDEN = (".zxindex", ".zxcache", catalog.CATALOG)
+
+# z80 v2/v3 hardware modes with 128K paging
+Z80_128 = {2: (3, 4), 3: (4, 5, 6, 7, 9, 12, 13)}
+
+
+class broken(Exception):
+  pass
+
+
+# z80 RLE: ED ED nn bb is nn times bb
+def unrle(data, length, end_marker=False):
+  out = bytearray()
+  i = 0
+  n = len(data)
+  while i < n and len(out) < length:
+    if data[i] == 0xED and i + 1 < n and data[i + 1] == 0xED:
+      if i + 3 >= n:
+        raise broken("truncated ED ED run")
+      out += bytes([data[i + 3]]) * data[i + 2]
+      i += 4
+    else:
+      out.append(data[i])
+      i += 1
+  if len(out) != length:
+    raise broken("block decodes to %d bytes, expected %d" % (len(out), length))
+  if end_marker and data[i:i + 4] != b"\x00\xED\xED\x00":
+    raise broken("v1 end marker missing")
+  return bytes(out), i
+
+
+# memory: 48K image 0x4000-0xFFFF or 128K banks 0-7
+# returns version, 128K flag, memory, screen
+def decode_z80(data):
+  if len(data) < 30:
+    raise broken("short header")
+  if struct.unpack("<H", data[6:8])[0]:
+    flags = data[12] if data[12] != 255 else 1
+    if flags & 0x20:
+      mem, i = unrle(data[30:], 0xC000, True)
+    else:
+      mem = data[30:30 + 0xC000]
+      if len(mem) != 0xC000:
+        raise broken("uncompressed v1 is %d bytes" % len(mem))
+    return 1, 0, mem, mem[0:6912]
+  if len(data) < 32:
+    raise broken("short v2/v3 header")
+  extra = struct.unpack("<H", data[30:32])[0]
+  if extra == 23:
+    version = 2
+  elif extra in (54, 55):
+    version = 3
+  else:
+    raise broken("unknown extra header length %d" % extra)
+  if len(data) < 32 + extra:
+    raise broken("short v%d header" % version)
+  mem128 = data[34] in Z80_128[version]
+  pages = {}
+  i = 32 + extra
+  while i < len(data):
+    if i + 3 > len(data):
+      raise broken("truncated block header at %d" % i)
+    length, page = struct.unpack("<HB", data[i:i + 3])
+    i += 3
+    if length == 0xFFFF:
+      block = data[i:i + 0x4000]
+      if len(block) != 0x4000:
+        raise broken("truncated page %d" % page)
+      i += 0x4000
+    else:
+      block, n = unrle(data[i:i + length], 0x4000)
+      if n != length:
+        raise broken("page %d has %d bytes after data" % (page, length - n))
+      i += length
+    if page in pages:
+      raise broken("page %d twice" % page)
+    pages[page] = block
+  if mem128:
+    need = range(3, 11)
+  else:
+    need = (8, 4, 5)
+  for page in need:
+    if page not in pages:
+      raise broken("page %d missing" % page)
+  mem = b"".join(pages[page] for page in need)
+  return version, mem128, mem, pages[8][0:6912]
+
+
+def decode_sna(data):
+  if len(data) == 0xC000: # raw RAM dump without registers, as loadsna
+    return 0, 0, data, data[0:6912]
+  if len(data) == 27 + 0xC000:
+    mem = data[27:]
+    return 1, 0, mem, mem[0:6912]
+  if len(data) in (27 + 0xC000 + 4 + 5 * 0x4000, 27 + 0xC000 + 4 + 6 * 0x4000):
+    port = data[27 + 0xC000 + 2]
+    banks = {5: data[27:27 + 0x4000], 2: data[27 + 0x4000:27 + 0x8000]}
+    banks[port & 7] = data[27 + 0x8000:27 + 0xC000]
+    i = 27 + 0xC000 + 4
+    for bank in range(8):
+      if bank not in banks:
+        banks[bank] = data[i:i + 0x4000]
+        i += 0x4000
+    if len(banks) != 8:
+      raise broken("128K sna without all banks")
+    return 2, 1, b"".join(banks[bank] for bank in range(8)), banks[5][0:6912]
+  raise broken("sna is %d bytes" % len(data))
+
+
+# blocks with flag and checksum, screen from CODE 16384,6912
+def decode_tap(data):
+  i = 0
+  blocks = []
+  screen = None
+  header = None
+  while i < len(data):
+    if i + 2 > len(data):
+      raise broken("truncated block length at %d" % i)
+    length = struct.unpack("<H", data[i:i + 2])[0]
+    block = data[i + 2:i + 2 + length]
+    if length < 2 or len(block) != length:
+      raise broken("truncated block at %d" % i)
+    parity = 0
+    for b in block:
+      parity ^= b
+    if parity:
+      raise broken("checksum error in block at %d" % i)
+    if block[0] == 0 and length == 19:
+      header = block
+    else:
+      if header is not None and header[1] == 3:
+        size, start = struct.unpack("<HH", header[12:16])
+        if start == 0x4000 and size >= 6912 and length >= 6914:
+          screen = block[1:6913]
+      header = None
+    blocks.append(block[1:-1])
+    i += 2 + length
+  if not blocks:
+    raise broken("no blocks")
+  return 0, 0, b"".join(blocks), screen
+
+
+def decode_tzx(data):
+  if data[0:8] != b"ZXTape!\x1a" or len(data) < 10:
+    raise broken("no tzx signature")
+  return data[8], 0, data[10:], None
+
+
+DECODERS = {
+  catalog.FORMAT_Z80: decode_z80,
+  catalog.FORMAT_SNA: decode_sna,
+  catalog.FORMAT_TAP: decode_tap,
+  catalog.FORMAT_TZX: decode_tzx,
+}
+
+# index 0-7 normal, 8-15 bright
+PALETTE = bytes([
+  0x00, 0x00, 0x00, 0x00, 0x00, 0xD7, 0xD7, 0x00, 0x00, 0xD7, 0x00, 0xD7,
+  0x00, 0xD7, 0x00, 0x00, 0xD7, 0xD7, 0xD7, 0xD7, 0x00, 0xD7, 0xD7, 0xD7,
+  0x00, 0x00, 0x00, 0x00, 0x00, 0xFF, 0xFF, 0x00, 0x00, 0xFF, 0x00, 0xFF,
+  0x00, 0xFF, 0x00, 0x00, 0xFF, 0xFF, 0xFF, 0xFF, 0x00, 0xFF, 0xFF, 0xFF,
+])
+
+if np is not None:
+  # bitmap offset of each of 192 pixel lines
+  Y = np.arange(192)
+  LINES = ((Y & 0xC0) << 5) | ((Y & 7) << 8) | ((Y & 0x38) << 2)
+  COLUMNS = LINES[:, None] + np.arange(32)
+
+
+# 256x192 palette indexes, flash is shown as not inverted
+def screen_pixels(screen):
+  s = np.frombuffer(screen, dtype=np.uint8)
+  bits = np.unpackbits(s[COLUMNS], axis=1).astype(bool)
+  attr = s[6144:6912].reshape(24, 32).repeat(8, axis=0).repeat(8, axis=1)
+  ink = attr & 7
+  paper = (attr >> 3) & 7
+  bright = (attr >> 3) & 8
+  return (np.where(bits, ink, paper) | bright).astype(np.uint8)
+
+
+def png_chunk(kind, data):
+  return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+# 8-bit palette PNG
+def write_png(filename, pixels):
+  h, w = pixels.shape
+  rows = np.zeros((h, w + 1), dtype=np.uint8) # filter byte 0 per row
+  rows[:, 1:] = pixels
+  with open(filename, "wb") as f:
+    f.write(b"\x89PNG\r\n\x1a\n")
+    f.write(png_chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 3, 0, 0, 0)))
+    f.write(png_chunk(b"PLTE", PALETTE))
+    f.write(png_chunk(b"IDAT", zlib.compress(rows.tobytes(), 9)))
+    f.write(png_chunk(b"IEND", b""))
+
+
+# one file, runs in a worker process
+def scan(job):
+  root, path, thumbs = job
+  filename = os.path.join(root, path)
+  entry = {"path": path, "format": EXTENSIONS[os.path.splitext(path)[1].lower()]}
+  with open(filename, "rb") as f:
+    data = f.read()
+  entry["size"] = len(data)
+  try:
+    version, mem128, mem, screen = DECODERS[entry["format"]](data)
+  except (broken, IndexError, struct.error) as e:
+    entry["error"] = str(e) or type(e).__name__
+    entry["hash"] = hashlib.sha1(data).digest()[0:8]
+    return entry
+  entry["version"] = version
+  entry["mem128"] = mem128
+  entry["ratio"] = min(0xFFFF, len(data) * 1000 // max(1, len(mem)))
+  entry["hash"] = hashlib.sha1(mem).digest()[0:8]
+  if thumbs and screen is not None and len(screen) == 6912:
+    png = os.path.join(thumbs, entry["hash"].hex() + ".png")
+    if not os.path.exists(png): # duplicates share one
+      write_png(png + ".%d" % os.getpid(), screen_pixels(screen))
+      os.replace(png + ".%d" % os.getpid(), png)
+    entry["thumb"] = png
+  return entry
+
+
+def find_files(root):
+  files = []
+  for dirpath, dirnames, filenames in os.walk(root):
+    dirnames[:] = sorted(d for d in dirnames if d not in HIDDEN)
+    for name in filenames:
+      if name not in HIDDEN and os.path.splitext(name)[1].lower() in EXTENSIONS:
+        files.append(os.path.relpath(os.path.join(dirpath, name), root).replace(os.sep, "/"))
+  # byte order of utf-8 paths, as catalog.find bisects
+  files.sort(key=lambda p: p.encode())
+  return files
+
+
+def write_catalog(filename, entries):
+  paths = bytearray()
+  offsets = []
+  info = []
+  for e in entries:
+    offsets.append(len(paths))
+    paths += e["path"].encode()
+    i = e["format"] | (e.get("version", 0) & 7) << 3
+    if "error" in e:
+      i |= catalog.BROKEN
+    if e.get("duplicate"):
+      i |= catalog.DUPLICATE
+    if e.get("mem128"):
+      i |= catalog.MEM128
+    info.append(i)
+  offsets.append(len(paths))
+  n = len(entries)
+  with open(filename + ".tmp", "wb") as f:
+    f.write(struct.pack("<4sLL", catalog.MAGIC, n, len(paths)))
+    f.write(struct.pack("<%dI" % (n + 1), *offsets))
+    f.write(struct.pack("<%dH" % n, *info))
+    f.write(struct.pack("<%dI" % n, *(e["size"] for e in entries)))
+    f.write(struct.pack("<%dH" % n, *(e.get("ratio", 0) for e in entries)))
+    f.write(b"".join(e["hash"] for e in entries))
+    f.write(paths)
+  os.replace(filename + ".tmp", filename)
+
+
+def main():
+  ap = argparse.ArgumentParser(description="ZX spectrum snapshot library catalogue")
+  ap.add_argument("root", help="library directory")
+  ap.add_argument("--out", help="catalogue file, default root/%s" % catalog.CATALOG)
+  ap.add_argument("--thumbs", help="directory for screen thumbnails <hash>.png")
+  ap.add_argument("--jobs", type=int, default=os.cpu_count(), help="worker processes")
+  ap.add_argument("--strict", action="store_true", help="exit status 1 on broken or duplicate files")
+  args = ap.parse_args()
+
+  if args.thumbs:
+    if np is None:
+      sys.exit("thumbnails need numpy")
+    os.makedirs(args.thumbs, exist_ok=True)
+  files = find_files(args.root)
+  jobs = [(args.root, path, args.thumbs) for path in files]
+  with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+    entries = list(pool.map(scan, jobs, chunksize=max(1, len(jobs) // (8 * (args.jobs or 1)))))
+
+  groups = {}
+  for e in entries:
+    if "error" in e:
+      print("broken %s: %s" % (e["path"], e["error"]))
+    else:
+      groups.setdefault(e["hash"], []).append(e)
+  duplicates = 0
+  for h, group in sorted(groups.items(), key=lambda g: g[1][0]["path"]):
+    if len(group) > 1:
+      duplicates += len(group) - 1
+      print("duplicate %s: %s" % (h.hex(), ", ".join(e["path"] for e in group)))
+      for e in group:
+        e["duplicate"] = 1
+  out = args.out or os.path.join(args.root, catalog.CATALOG)
+  write_catalog(out, entries)
+  nbroken = sum(1 for e in entries if "error" in e)
+  print("%s: %d files, %d broken, %d duplicates" % (out, len(entries), nbroken, duplicates))
+  if args.strict and (nbroken or duplicates):
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+
+# convert between .z80 v1/v2/v3, .sna, raw binaries and .tap code blocks
+# RLE of .z80 pages is the smallest valid ED ED encoding, smaller
+# files are read faster from SD when loading. directories are
+# converted in parallel by a process pool.
+
+# LICENSE=BSD
+
+# usage:
+#   zxconvert.py game.sna --to z80 -o game.z80
+#   zxconvert.py game.z80 --to sna -o game.sna
+#   zxconvert.py code.bin --addr 0x8000 --pc 0x8000 -o code.z80
+#   zxconvert.py game.tap --to bin --outdir code   # CODE blocks
+#   zxconvert.py library --to z80 --outdir converted
+# raw .bin of a 48K snapshot is RAM 0x4000-0xFFFF (--to bin), as
+# loaded by loadsna. .tap converts only to bin: RAM of a tape is
+# not complete without BASIC system variables set up by ROM.
+
+import argparse
+import concurrent.futures
+import os
+import struct
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.normpath(os.path.join(HERE, "..")))
+
+import ld_zxspectrum
+import zxcatalog
+from zxcatalog import broken
+
+FORMATS = ("z80", "z80v1", "z80v2", "z80v3", "sna", "bin")
+INPUTS = (".z80", ".sna", ".tap")
+
+# z80 page numbers of 48K RAM at 0x4000, 0x8000, 0xC000
+PAGES48 = (8, 4, 5)
+
+
+# z80 header in 30 bytes (pc kept apart), pages as in .z80:
+# 0 ROM, 3-10 128K banks 0-7, 4/5/8 48K RAM
+class snapshot:
+  def __init__(self, header, pc, pages, mem128=0, port=0):
+    self.header = bytearray(header)
+    self.pc = pc
+    self.pages = pages
+    self.mem128 = mem128
+    self.port = port # last write to 0x7FFD
+
+  def ram48(self):
+    return b"".join(self.pages.get(page, bytes(0x4000)) for page in PAGES48)
+
+
+# smallest .z80 RLE: ED ED nn bb is nn times bb. a run costs
+# 4 bytes whatever its length, so runs of 5 or more are encoded,
+# longer than 255 are split. ED ED can't be data, so runs of
+# 2 or more ED are encoded too, and a single literal ED can't
+# be followed by a run, the next byte is literal. no valid
+# encoding is shorter, checked against exhaustive search.
+def rle(data):
+  out = bytearray()
+  i = 0
+  n = len(data)
+  while i < n:
+    b = data[i]
+    j = i + 1
+    while j < n and j - i < 255 and data[j] == b:
+      j += 1
+    if j - i >= 5 or (b == 0xED and j - i >= 2):
+      out += bytes((0xED, 0xED, j - i, b))
+      i = j
+    else:
+      out.append(b)
+      i += 1
+      if b == 0xED and i < n: # byte after single ED
+        out.append(data[i])
+        i += 1
+  return bytes(out)
+
+
+# all pages of a .z80, ROM page 0 too
+def z80_pages(data, i):
+  pages = {}
+  while i < len(data):
+    if i + 3 > len(data):
+      raise broken("truncated block header at %d" % i)
+    length, page = struct.unpack("<HB", data[i:i + 3])
+    i += 3
+    if length == 0xFFFF:
+      block = data[i:i + 0x4000]
+      if len(block) != 0x4000:
+        raise broken("truncated page %d" % page)
+      i += 0x4000
+    else:
+      block, n = zxcatalog.unrle(data[i:i + length], 0x4000)
+      i += length
+    pages[page] = block
+  return pages
+
+
+def read_z80(data):
+  if len(data) < 30:
+    raise broken("short header")
+  header = bytearray(data[0:30])
+  pc = struct.unpack("<H", header[6:8])[0]
+  if header[12] == 255:
+    header[12] = 1
+  if pc: # v1
+    version, mem128, mem, screen = zxcatalog.decode_z80(data)
+    pages = {page: mem[k * 0x4000:(k + 1) * 0x4000] for k, page in enumerate(PAGES48)}
+    return snapshot(header, pc, pages)
+  if len(data) < 34:
+    raise broken("short v2/v3 header")
+  extra = struct.unpack("<H", data[30:32])[0]
+  if extra not in (23, 54, 55):
+    raise broken("unknown extra header length %d" % extra)
+  pc = struct.unpack("<H", data[32:34])[0]
+  mem128 = data[34] in zxcatalog.Z80_128[2 if extra == 23 else 3]
+  pages = z80_pages(data, 32 + extra)
+  return snapshot(header, pc, pages, mem128, data[35] if mem128 else 0)
+
+
+def read_sna(data):
+  version, mem128, mem, screen = zxcatalog.decode_sna(data)
+  if version == 0:
+    raise broken("raw RAM dump has no registers, convert it with --addr 0x4000")
+  sna = data[0:27]
+  sp = struct.unpack("<H", sna[23:25])[0]
+  if mem128:
+    pages = {bank + 3: mem[bank * 0x4000:(bank + 1) * 0x4000] for bank in range(8)}
+    pc, port = struct.unpack("<HB", data[27 + 0xC000:27 + 0xC000 + 3])
+    header = ld_zxspectrum.ld_zxspectrum(None).sna2z80(sna, sp)
+    return snapshot(header, pc, pages, 1, port)
+  if sp < 0x4000 or sp >= 0xFFFF:
+    raise broken("SP 0x%04X is not in RAM" % sp)
+  pc = struct.unpack("<H", mem[sp - 0x4000:sp - 0x4000 + 2])[0]
+  header = ld_zxspectrum.ld_zxspectrum(None).sna2z80(sna, (sp + 2) & 0xFFFF)
+  pages = {page: mem[k * 0x4000:(k + 1) * 0x4000] for k, page in enumerate(PAGES48)}
+  return snapshot(header, pc, pages)
+
+
+# raw code at addr, ROM if at 0, started like a loaded tape
+def read_raw(data, addr, pc=-1, sp=0xFF57):
+  header = ld_zxspectrum.ld_zxspectrum(None).z80_header(sp)
+  if pc < 0:
+    pc = addr
+  if addr == 0 and len(data) <= 0x4000:
+    return snapshot(header, pc, {0: bytes(data) + bytes(0x4000 - len(data))})
+  if addr < 0x4000 or addr + len(data) > 0x10000:
+    raise broken("%d bytes at 0x%04X are not in RAM" % (len(data), addr))
+  ram = bytearray(0xC000)
+  ram[addr - 0x4000:addr - 0x4000 + len(data)] = data
+  pages = {page: bytes(ram[k * 0x4000:(k + 1) * 0x4000]) for k, page in enumerate(PAGES48)}
+  return snapshot(header, pc, pages)
+
+
+# CODE blocks of a .tap as (name, addr, data)
+def read_tap(data):
+  zxcatalog.decode_tap(data) # checksums
+  code = []
+  header = None
+  i = 0
+  while i + 2 <= len(data):
+    length = struct.unpack("<H", data[i:i + 2])[0]
+    block = data[i + 2:i + 2 + length]
+    if length < 2 or len(block) != length:
+      raise broken("truncated block at %d" % i)
+    if block[0] == 0 and length == 19:
+      header = block
+    else:
+      if header is not None and header[1] == 3:
+        name = "".join(c if c.isalnum() or c in "-_" else "_" for c in header[2:12].decode("latin-1").rstrip())
+        addr = struct.unpack("<H", header[14:16])[0]
+        code.append((name, addr, block[1:-1]))
+      header = None
+    i += 2 + length
+  return code
+
+
+def write_z80(s, version=3):
+  header = bytearray(s.header)
+  if version == 1:
+    if s.mem128 or set(s.pages) - set(PAGES48):
+      raise broken("z80 v1 holds only 48K RAM")
+    if s.pc == 0:
+      raise broken("z80 v1 can't start at 0, PC 0 means v2/v3")
+    header[6:8] = struct.pack("<H", s.pc)
+    ram = s.ram48()
+    c = rle(ram) + b"\x00\xED\xED\x00"
+    if len(c) < len(ram):
+      header[12] |= 0x20
+      return bytes(header) + c
+    header[12] &= ~0x20
+    return bytes(header) + ram
+  header[6:8] = b"\x00\x00"
+  header[12] &= ~0x20
+  extra = bytearray(23 if version == 2 else 54)
+  extra[0:2] = struct.pack("<H", s.pc)
+  if s.mem128:
+    extra[2] = 3 if version == 2 else 4
+    extra[3] = s.port
+  out = bytearray(header) + struct.pack("<H", len(extra)) + extra
+  for page in sorted(s.pages):
+    data = s.pages[page]
+    c = rle(data)
+    if len(c) >= 0x4000 and version == 3:
+      out += struct.pack("<HB", 0xFFFF, page) + data
+    else:
+      out += struct.pack("<HB", len(c), page) + c
+  return bytes(out)
+
+
+def write_sna(s):
+  h = s.header
+  sna = bytearray(27)
+  sna[0] = h[10] # I
+  sna[1:3] = h[19:21] # HL'
+  sna[3:5] = h[17:19] # DE'
+  sna[5:7] = h[15:17] # BC'
+  sna[7] = h[22] # F'
+  sna[8] = h[21] # A'
+  sna[9:11] = h[4:6] # HL
+  sna[11:13] = h[13:15] # DE
+  sna[13:15] = h[2:4] # BC
+  sna[15:17] = h[23:25] # IY
+  sna[17:19] = h[25:27] # IX
+  sna[19] = (h[27] & 1) << 2 # IFF2, loaders use it as IFF1
+  sna[20] = (h[11] & 0x7F) | ((h[12] & 1) << 7) # R
+  sna[21] = h[1] # F
+  sna[22] = h[0] # A
+  sna[25] = h[29] & 3 # IM
+  sna[26] = (h[12] >> 1) & 7 # border
+  sp = struct.unpack("<H", h[8:10])[0]
+  if s.mem128:
+    sna[23:25] = h[8:10]
+    banks = [s.pages.get(bank + 3, bytes(0x4000)) for bank in range(8)]
+    paged = s.port & 7
+    out = sna + banks[5] + banks[2] + banks[paged] + struct.pack("<HBB", s.pc, s.port, 0)
+    for bank in range(8):
+      if bank not in (5, 2, paged):
+        out += banks[bank]
+    return bytes(out)
+  # 48K sna has PC on the stack
+  sp = (sp - 2) & 0xFFFF
+  if sp < 0x4000 or sp > 0xFFFE:
+    raise broken("SP 0x%04X leaves no room for PC in RAM" % sp)
+  ram = bytearray(s.ram48())
+  ram[sp - 0x4000:sp - 0x4000 + 2] = struct.pack("<H", s.pc)
+  sna[23:25] = struct.pack("<H", sp)
+  return bytes(sna + ram)
+
+
+def write_bin(s):
+  if s.mem128:
+    raise broken("128K snapshot has no flat RAM")
+  return s.ram48()
+
+
+def convert(data, name, to, addr=-1, pc=-1, sp=0xFF57):
+  ext = os.path.splitext(name)[1].lower()
+  if ext == ".z80":
+    s = read_z80(data)
+  elif ext == ".sna" and addr < 0:
+    s = read_sna(data)
+  elif addr >= 0:
+    s = read_raw(data, addr, pc, sp)
+  else:
+    raise broken("raw file needs --addr")
+  if pc >= 0:
+    s.pc = pc
+  if to == "sna":
+    return write_sna(s)
+  if to == "bin":
+    return write_bin(s)
+  return write_z80(s, int(to[4:]) if to[4:] else 3)
+
+
+# returns list of (output name, data)
+def outputs(path, to, out, addr=-1, pc=-1, sp=0xFF57):
+  with open(path, "rb") as f:
+    data = f.read()
+  stem = os.path.splitext(out)[0] if out.endswith("." + to[0:3]) else out
+  if path.lower().endswith(".tap"):
+    if to != "bin":
+      raise broken("tape converts only to bin")
+    return [("%s.%s.%04x.bin" % (stem, name or "code", a), code) for name, a, code in read_tap(data)]
+  return [(stem + "." + to[0:3], convert(data, path, to, addr, pc, sp))]
+
+
+def job(args):
+  path, to, out, addr, pc, sp = args
+  try:
+    written = []
+    for name, data in outputs(path, to, out, addr, pc, sp):
+      os.makedirs(os.path.dirname(name) or ".", exist_ok=True)
+      with open(name, "wb") as f:
+        f.write(data)
+      written.append("%s %d bytes" % (name, len(data)))
+    return 0, "%s -> %s" % (path, ", ".join(written) or "nothing")
+  except (OSError, broken) as e:
+    return 1, "%s: %s" % (path, e)
+
+
+def find_files(root):
+  found = []
+  for dirpath, dirnames, filenames in os.walk(root):
+    dirnames.sort()
+    for name in sorted(filenames):
+      if os.path.splitext(name)[1].lower() in INPUTS:
+        found.append(os.path.join(dirpath, name))
+  return found
+
+
+def main():
+  ap = argparse.ArgumentParser(description="convert ZX spectrum snapshots, raw binaries and tape code")
+  ap.add_argument("inputs", nargs="+", help=".z80/.sna/.tap/raw files or directories")
+  ap.add_argument("--to", choices=FORMATS, default="z80", help="output format, z80 is v3")
+  ap.add_argument("-o", "--out", help="output file for a single input")
+  ap.add_argument("--outdir", default=".", help="output directory, tree of a directory input is kept")
+  ap.add_argument("--addr", type=lambda s: int(s, 0), default=-1, help="load address of raw input")
+  ap.add_argument("--pc", type=lambda s: int(s, 0), default=-1, help="start address")
+  ap.add_argument("--sp", type=lambda s: int(s, 0), default=0xFF57, help="stack pointer of raw input")
+  ap.add_argument("--jobs", type=int, default=os.cpu_count(), help="parallel conversions")
+  args = ap.parse_args()
+
+  jobs = []
+  for path in args.inputs:
+    if os.path.isdir(path):
+      for name in find_files(path):
+        if name.lower().endswith(".tap") and args.to != "bin":
+          continue
+        rel = os.path.splitext(os.path.relpath(name, path))[0]
+        jobs.append((name, args.to, os.path.join(args.outdir, rel), args.addr, args.pc, args.sp))
+    else:
+      out = args.out or os.path.join(args.outdir, os.path.splitext(os.path.basename(path))[0])
+      jobs.append((path, args.to, out, args.addr, args.pc, args.sp))
+  if args.out and len(jobs) != 1:
+    ap.error("-o needs a single input file")
+
+  errors = 0
+  with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+    for status, message in pool.map(job, jobs, chunksize=4):
+      print(message)
+      errors += status
+  return 1 if errors else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,292 @@
+# micropython ESP32
+# directory index file for OSD file browser
+
+# LICENSE=BSD
+
+# os.stat of every file in a directory with thousands of
+# files takes seconds. sorted names, flags and sizes are
+# kept in ".zxindex" file in the directory. it is rebuilt
+# only when directory mtime or number of entries changes.
+
+# entries are kept compact, without object per entry:
+# name offsets and flags in arrays, names and sizes are
+# read from the index file in a window of entries around
+# the one used, window names are one bytearray. an index
+# built from listing keeps all in RAM, window is everything.
+
+# index file:
+# header "<4sLLLL": magic, dir mtime, dir entries, n, names length
+# first "I"*257: see below
+# offsets "I"*n: name offset in names
+# flags "H"*n: bit 0 directory, bits 15-1 name length
+# sizes "I"*n
+# names: names without separators, in sorted order
+# magic is written last, incomplete file is never used
+
+# names are sorted by bytes. first[c] is index of first
+# entry with first byte >= c, prefix search bisects
+# only between first[c] and first[c+1].
+
+from struct import pack, unpack, calcsize
+from array import array
+import os
+
+INDEX = ".zxindex"
+HIDDEN = (INDEX, ".zxcache", ".zxcatalog")
+FLAG_DIR = 1
+HEADER = 20+4*257
+
+# array of n zeros, array(typecode,bytes) is a raw copy
+def zeros(typecode, n):
+  return array(typecode, bytes(n*calcsize(typecode)))
+
+class dirindex:
+  def __init__(self, path, window=64):
+    self.path = path
+    self.window = window # entries read from index file at once
+    self.f = None # open index file, None: all in RAM
+    self.name_buf = bytearray(256) # name outside window
+    st = os.stat(path)
+    mtime = st[8]&0xFFFFFFFF
+    count = 0
+    for e in os.ilistdir(path):
+      count += 1
+    filename = self.fullpath(INDEX)
+    try:
+      f = open(filename, "rb")
+      header = f.read(20)
+      if len(header) == 20:
+        magic, m, c, n, length = unpack("<4sLLLL", header)
+        if magic == b"ZXD3" and m == mtime and c == count:
+          self.first = zeros("I", 257)
+          self.offsets = zeros("I", n)
+          self.flags = zeros("H", n)
+          for a in (self.first, self.offsets, self.flags):
+            f.readinto(a)
+          self.f = f
+          self.names_at = f.tell()+4*n # names in file
+          self.sizes_at = f.tell()
+          self.lo = 0 # window entries
+          self.hi = 0
+          self.base = 0 # names[0] offset in all names
+          self.sizes = zeros("I", min(window, n))
+          self.names = bytearray(min(32*window, length)) # grows for long names
+          return
+      f.close()
+      count -= 1 # index itself is counted
+    except OSError:
+      pass
+    self.read(path)
+    self.sort()
+    self.index_letters()
+    self.write(filename, count)
+
+  def fullpath(self, fname):
+    if self.path.endswith("/"):
+      return self.path+fname
+    return self.path+"/"+fname
+
+  def close(self):
+    if self.f:
+      self.f.close()
+      self.f = None
+
+  # fill arrays from directory listing
+  def read(self, path):
+    self.offsets = array("I")
+    self.flags = array("H")
+    self.sizes = array("I")
+    self.names = bytearray()
+    for e in os.ilistdir(path):
+      name = e[0]
+      if name in HIDDEN:
+        continue
+      self.offsets.append(len(self.names))
+      self.names += name.encode()
+      if e[1] == 0x4000:
+        self.flags.append(((len(self.names)-self.offsets[-1])<<1)|FLAG_DIR)
+        self.sizes.append(0)
+      else:
+        self.flags.append((len(self.names)-self.offsets[-1])<<1)
+        self.sizes.append(e[3] if len(e) > 3 else os.stat(self.fullpath(name))[6])
+    self.lo = 0
+    self.hi = len(self.offsets)
+    self.base = 0
+
+  # file has names in sorted order, so a window of entries is
+  # one read. names in RAM stay in listing order
+  def write(self, filename, count):
+    try:
+      f = open(filename, "wb")
+    except OSError: # read-only SD, index only in RAM
+      return
+    mtime = os.stat(self.path)[8]&0xFFFFFFFF # creating index may change it
+    n = len(self.offsets)
+    f.write(bytearray(20))
+    f.write(self.first)
+    chunk = zeros("I", 64) # offsets of sorted names
+    o = 0
+    for i in range(0, n, 64):
+      k = min(64, n-i)
+      for j in range(k):
+        chunk[j] = o
+        o += self.flags[i+j]>>1
+      f.write(memoryview(chunk)[0:k])
+    f.write(self.flags)
+    f.write(self.sizes)
+    names = memoryview(self.names)
+    for i in range(n):
+      a = self.offsets[i]
+      f.write(names[a:a+(self.flags[i]>>1)])
+    f.seek(0)
+    f.write(pack("<4sLLLL", b"ZXD3", mtime, count+1, n, o))
+    f.close()
+    print("index %s: %d entries" % (self.path, n))
+
+  # entries around i from index file, window stays when i is in it
+  def load_window(self, i):
+    if i >= self.lo and i < self.hi:
+      return
+    n = len(self.offsets)
+    lo = max(0, min(i-self.window//2, n-self.window))
+    hi = min(n, lo+self.window)
+    base = self.offsets[lo]
+    length = self.offsets[hi-1]+(self.flags[hi-1]>>1)-base
+    if len(self.names) < length:
+      self.names = bytearray(length)
+    f = self.f
+    f.seek(self.sizes_at+4*lo)
+    f.readinto(memoryview(self.sizes)[0:hi-lo])
+    f.seek(self.names_at+base)
+    f.readinto(memoryview(self.names)[0:length])
+    self.lo = lo
+    self.hi = hi
+    self.base = base
+
+  def __len__(self):
+    return len(self.offsets)
+
+  # offset of name i in names, window is read if needed
+  def name_offset(self, i):
+    if self.f:
+      self.load_window(i)
+    return self.offsets[i]-self.base
+
+  def name(self, i):
+    o = self.name_offset(i)
+    return str(self.names[o:o+(self.flags[i]>>1)], "utf-8")
+
+  # memoryview of name i, valid until next window read
+  def name_mv(self, i):
+    o = self.name_offset(i)
+    return memoryview(self.names)[o:o+(self.flags[i]>>1)]
+
+  # copy at most n bytes of name i to buf at o, returns bytes copied
+  def name_into(self, i, buf, o, n):
+    a = self.name_offset(i)
+    names = self.names
+    n = min(n, self.flags[i]>>1)
+    for k in range(n):
+      buf[o+k] = names[a+k]
+    return n
+
+  def is_dir(self, i):
+    return self.flags[i]&FLAG_DIR
+
+  def size(self, i):
+    if self.f:
+      self.load_window(i)
+    return self.sizes[i-self.lo]
+
+  # first byte of name i
+  def letter(self, i):
+    return self.names[self.name_offset(i)]
+
+  def index_letters(self):
+    n = len(self.offsets)
+    self.first = zeros("I", 257)
+    c = 0
+    for i in range(n):
+      b = self.letter(i)
+      while c <= b:
+        self.first[c] = i
+        c += 1
+    while c <= 256:
+      self.first[c] = n
+      c += 1
+
+  # name i compared to prefix without allocation:
+  # -1 less, 0 name starts with prefix, 1 greater
+  # bisect probes outside window read one name
+  def cmp_prefix(self, i, prefix):
+    la = self.flags[i]>>1
+    if self.f and (i < self.lo or i >= self.hi):
+      names = self.name_buf
+      a = 0
+      k = min(la, len(prefix), len(names))
+      self.f.seek(self.names_at+self.offsets[i])
+      self.f.readinto(memoryview(names)[0:k])
+    else:
+      a = self.name_offset(i)
+      names = self.names
+    for k in range(len(prefix)):
+      if k >= la:
+        return -1
+      if names[a+k] != prefix[k]:
+        return -1 if names[a+k] < prefix[k] else 1
+    return 0
+
+  # index of first name not less than prefix
+  def find(self, prefix):
+    if len(prefix) == 0:
+      return 0
+    lo = self.first[prefix[0]]
+    hi = self.first[prefix[0]+1]
+    while lo < hi:
+      mid = (lo+hi)//2
+      if self.cmp_prefix(mid, prefix) < 0:
+        lo = mid+1
+      else:
+        hi = mid
+    return lo
+
+  # compare names i and j like str, without allocation
+  def less(self, i, j):
+    names = self.names
+    a = self.offsets[i]
+    b = self.offsets[j]
+    la = self.flags[i]>>1
+    lb = self.flags[j]>>1
+    for k in range(min(la, lb)):
+      if names[a+k] != names[b+k]:
+        return names[a+k] < names[b+k]
+    return la < lb
+
+  def swap(self, i, j):
+    a = self.offsets
+    a[i], a[j] = a[j], a[i]
+    a = self.flags
+    a[i], a[j] = a[j], a[i]
+    a = self.sizes
+    a[i], a[j] = a[j], a[i]
+
+  # heap sort in place, names stay where they are
+  def sort(self):
+    n = len(self.offsets)
+    for i in range(n//2-1, -1, -1):
+      self.sift(i, n)
+    for end in range(n-1, 0, -1):
+      self.swap(0, end)
+      self.sift(0, end)
+
+  def sift(self, i, n):
+    while True:
+      c = 2*i+1
+      if c >= n:
+        return
+      if c+1 < n and self.less(c, c+1):
+        c += 1
+      if not self.less(i, c):
+        return
+      self.swap(i, c)
+      i = c
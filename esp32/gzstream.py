@@ -0,0 +1,63 @@
+# micropython ESP32
+# gzip or zlib compressed file as stream for ecp5.prog_stream
+
+# LICENSE=BSD
+
+# file is decompressed while it is read, memory is one
+# input block and the deflate window: 32K for gzip, zlib
+# streams can be made with smaller window (wbits in header).
+# readinto fills the whole buffer except at the end, as
+# prog_stream sends full blocks.
+
+import zlib
+try:
+  import deflate # micropython 1.21+
+except ImportError:
+  deflate = None
+
+class gzstream:
+  def __init__(self, f, blocksize=1024):
+    self.f = f
+    magic = f.read(2)
+    f.seek(0)
+    wbits = 31 if magic == b"\x1f\x8b" else 15 # gzip or zlib header
+    if deflate:
+      self.z = deflate.DeflateIO(f, deflate.GZIP if wbits == 31 else deflate.ZLIB)
+    elif hasattr(zlib, "DecompIO"):
+      self.z = zlib.DecompIO(f, wbits)
+    else: # CPython
+      self.z = None
+      self.d = zlib.decompressobj(wbits)
+      self.blocksize = blocksize
+
+  def readpart(self, mv):
+    if self.z:
+      return self.z.readinto(mv)
+    while not self.d.eof:
+      raw = self.d.unconsumed_tail
+      if not raw:
+        raw = self.f.read(self.blocksize)
+        if not raw:
+          break
+      data = self.d.decompress(raw, len(mv))
+      if data:
+        mv[0:len(data)] = data
+        return len(data)
+    return 0
+
+  def readinto(self, buf):
+    mv = memoryview(buf)
+    n = 0
+    while n < len(buf):
+      k = self.readpart(mv[n:])
+      if not k:
+        break
+      n += k
+    return n
+
+  def read(self, n):
+    buf = bytearray(n)
+    return buf[0:self.readinto(buf)]
+
+  def close(self):
+    self.f.close()
@@ -0,0 +1,375 @@
+# micropython ESP32
+# ZX spectrum snapshot SPI replay cache
+
+# LICENSE=BSD
+
+# first load of a snapshot is recorded while it is loaded:
+# every SPI RAM write and fill done by the parser is written
+# to a replay file in one cache directory on SD, named by CRC32
+# of snapshot path and its name. next loads just replay the file
+# without parsing. least recently used files are deleted when
+# the whole cache is over budget.
+
+# replay file:
+# header "<4sLLHBx": magic, snapshot size, snapshot mtime, hits, boot
+# records "<BLL": op, addr, length
+# op "W": length bytes of data follow
+# op "F": 1 byte follows, to be repeated length times
+# op "B": 32 bytes follow, PC and .z80 header of boot stub
+# op "E": end
+# paging port write is a "W" record of 1 byte to ADDR_PAGING<<24,
+# it comes before RAM records. writes and fills that continue
+# each other are one record: SPI chunks of a fill, blocks of
+# a page and pages in a row. runs in RAM writes are fills.
+# magic is written last, incomplete file is never replayed.
+# a replay that is not smaller than the snapshot is kept as
+# header with boot DIRECT and no records, the snapshot is
+# then loaded directly, not compiled again
+
+from struct import pack, unpack
+from binascii import crc32
+import os
+import spibus
+from ld_zxspectrum import find_run, run_end
+
+# runs of RAM data at least this long are recorded as fills.
+# "F" and the "W" that goes on after it cost 19 bytes but two
+# more SD reads on replay, shorter runs are cheaper as data
+RUN = 512
+
+DIRECT = 0xFF # boot of header-only file
+
+CACHEDIR = "/sd/.zxcache"
+
+# spibus backend, pretends to be SPI and CS, forwards all to
+# real SPI and CS and records RAM writes and fills to replay file.
+# last record is pending until one that doesn't continue it,
+# "W" header is written first and its length when it ends.
+# with blocksize, CRC32 of whole aligned blocks below 64K are
+# kept in crc, to be checked by spidiff like its own writes
+class spi_recorder:
+  def __init__(self,f,spi,cs,blocksize=0):
+    self.f=f
+    self.spi=spi
+    self.cs=cs
+    self.cmd=bytearray(5)
+    self.ncmd=0
+    self.addr=0
+    self.op=0 # pending record, 0 none
+    self.start=0 # its address
+    self.n=0 # its length
+    self.b=0 # its fill byte
+    self.pos=0 # file offset of pending "W" record
+    self.blocksize=blocksize
+    if blocksize:
+      self.crc=[None]*(0x10000//blocksize) # None: not whole
+      self.crc_end=-1 # address after last tracked byte
+      self.ones=bytearray(blocksize) # fill bytes for crc32
+      self.crc_run=0
+
+  def on(self):
+    self.ncmd=0
+    self.cs.on()
+
+  def off(self):
+    self.cs.off()
+
+  # write request to anything except control register
+  def recording(self):
+    return self.ncmd==5 and self.cmd[0]==0 and self.cmd[1]!=0xFF
+
+  def write(self,buf):
+    self.spi.write(buf)
+    n=len(buf)
+    i=0
+    while self.ncmd < 5 and i < n:
+      self.cmd[self.ncmd]=buf[i]
+      self.ncmd+=1
+      i+=1
+      if self.ncmd==5:
+        self.addr=unpack(">L",self.cmd[1:5])[0]
+    if i < n and self.recording():
+      if self.cmd[1]: # registers
+        self.data(memoryview(buf)[i:n])
+      else:
+        self.ram(buf,i,n)
+
+  # loader stages runs shorter than a block with the data
+  # around them, here they become fills
+  def ram(self,buf,i,n):
+    while i < n:
+      j=find_run(buf,i,n,RUN)
+      if j > i:
+        self.data(memoryview(buf)[i:j])
+      if j < n:
+        k=run_end(buf,j,n)
+        self.fill(k-j,buf[j])
+        j=k
+      i=j
+
+  # readinto with write byte is a fill, see spibus.spi_fill
+  def readinto(self,buf,b=None):
+    if b is None:
+      self.spi.readinto(buf)
+      return
+    self.spi.readinto(buf,b)
+    if self.recording():
+      self.fill(len(buf),b)
+
+  def data(self,buf):
+    if self.op!=0x57 or self.start+self.n!=self.addr:
+      self.flush()
+      self.op=0x57
+      self.start=self.addr
+      self.n=0
+      self.pos=self.f.tell()
+      self.f.write(pack("<BLL",0x57,self.addr,0))
+    if self.blocksize:
+      self.track(buf,len(buf),0)
+    self.f.write(buf)
+    self.n+=len(buf)
+    self.addr+=len(buf)
+
+  def fill(self,n,b):
+    if self.op!=0x46 or self.start+self.n!=self.addr or self.b!=b:
+      self.flush()
+      self.op=0x46
+      self.start=self.addr
+      self.n=0
+      self.b=b
+    if self.blocksize:
+      self.track(None,n,b)
+    self.n+=n
+    self.addr+=n
+
+  # CRC of data or n times b at addr, continued over writes.
+  # paging and linear RAM writes remap CPU view, all forgotten
+  def track(self,buf,n,b):
+    a=self.addr
+    if a>>16:
+      if a>>24==0 or a>>24==spibus.ADDR_PAGING:
+        for i in range(len(self.crc)):
+          self.crc[i]=None
+        self.crc_end=-1
+      return
+    bs=self.blocksize
+    j=0
+    while j < n and a+j < 0x10000:
+      o=(a+j)%bs
+      k=min(n-j,bs-o)
+      i=(a+j)//bs
+      self.crc[i]=None
+      if o==0:
+        self.crc_run=0
+      elif self.crc_end!=a+j:
+        self.crc_end=-1
+        j+=k
+        continue
+      if buf is None:
+        if self.ones[0]!=b or self.ones[bs-1]!=b:
+          for m in range(bs):
+            self.ones[m]=b
+        self.crc_run=crc32(memoryview(self.ones)[0:k],self.crc_run)
+      else:
+        self.crc_run=crc32(buf[j:j+k],self.crc_run)
+      self.crc_end=a+j+k
+      if o+k==bs:
+        self.crc[i]=self.crc_run
+      j+=k
+
+  # pending record to file
+  def flush(self):
+    if self.op==0x57:
+      end=self.f.tell()
+      self.f.seek(self.pos+5)
+      self.f.write(pack("<L",self.n))
+      self.f.seek(end)
+    elif self.op==0x46:
+      self.f.write(pack("<BLLB",0x46,self.start,self.n,self.b))
+    self.op=0
+
+class ld_replay:
+  def __init__(self,ld,cachedir=CACHEDIR,budget=0x400000,blocksize=1024):
+    self.ld=ld # ld_zxspectrum
+    self.cachedir=cachedir
+    self.budget=budget # max bytes in cache directory
+    self.blocksize=blocksize
+    self.record=bytearray(9)
+    self.byte=bytearray(1)
+
+  # same name in different directories is a different file
+  def cachefile(self,filename):
+    return "%s/%08x_%s.zxr" % (self.cachedir,crc32(filename.encode()),filename[filename.rfind("/")+1:])
+
+  def loadz80(self,filename):
+    st=os.stat(filename)
+    cachedir=self.cachedir
+    cachefile=self.cachefile(filename)
+    try:
+      f=open(cachefile,"r+b")
+    except OSError:
+      f=None
+    if f:
+      header=bytearray(16)
+      f.readinto(header)
+      magic,size,mtime,hits,boot=unpack("<4sLLHBx",header)
+      if magic==b"ZXR4" and size==st[6] and mtime==st[8]&0xFFFFFFFF:
+        if boot==DIRECT:
+          self.ld.loadz80(filename,cache=0)
+        else:
+          self.replay(f,boot)
+        # touch: hit counter write updates mtime for LRU eviction
+        f.seek(12)
+        f.write(pack("<H",(hits+1)&0xFFFF))
+        f.close()
+        if (hits+1)&15==0: # stats all files, not on every replay
+          self.evict(cachedir)
+        return
+      f.close()
+    try:
+      os.mkdir(cachedir)
+    except OSError:
+      pass
+    try:
+      f=open(cachefile,"wb")
+    except OSError: # read-only or full SD, load without cache
+      self.ld.loadz80(filename,cache=0)
+      return
+    self.compile(filename,cachefile,f,st[6],st[8]&0xFFFFFFFF)
+    self.evict(cachedir)
+
+  # load snapshot normally while recording it. if it can't be
+  # loaded, partial replay file is deleted and CPU continues
+  def compile(self,filename,cachefile,f,size,mtime):
+    boot=-1
+    try:
+      boot=self.record_load(filename,f,size,mtime)
+    finally:
+      f.close()
+      if boot<0:
+        os.remove(cachefile)
+        self.ld.cpu_continue()
+    if boot>=0:
+      self.ld.start(boot)
+      if os.stat(cachefile)[6]>=size:
+        f=open(cachefile,"wb")
+        f.write(pack("<4sLLHBx",b"ZXR4",size,mtime,0,DIRECT))
+        f.close()
+
+  # returns boot flag, -1 if snapshot can't be loaded
+  def record_load(self,filename,f,size,mtime):
+    f.write(bytearray(16))
+    bus=self.ld.bus
+    rec=spi_recorder(f,bus.spi,bus.cs,bus.blocksize if hasattr(bus,"written") else 0)
+    ld=self.ld.__class__(spibus.spibus(rec,rec))
+    ld.rom_manager=self.ld.rom_manager
+    ld.core128=self.ld.core128 # probed through real bus, not recorded
+    ld.nbuf=1 # serial, replay file is written to SD meanwhile
+    z=open(filename,"rb")
+    self.ld.cpu_halt()
+    try:
+      image=ld.load_z80(z)
+    finally:
+      z.close()
+      self.ld.bus.invalidate() # written past self.ld.bus
+      self.ld.paging(ld.port)
+    if not image:
+      return -1
+    if rec.blocksize: # read back by spidiff before CPU runs
+      for i in range(len(rec.crc)):
+        if rec.crc[i] is not None:
+          bus.written(i,rec.crc[i])
+    rec.flush()
+    boot=ld.restores()
+    if boot: # stub is made again on replay, from 32 bytes
+      f.write(pack("<BLLH",0x42,0,32,image[0]))
+      f.write(image[1])
+      self.ld.bus.boot_write(ld.boot_stub(image[0],image[1]))
+    f.write(pack("<BLL",0x45,0,0))
+    f.seek(0)
+    f.write(pack("<4sLLHBx",b"ZXR4",size,mtime,0,boot))
+    return boot
+
+  # contiguous records are sent in one SPI transaction.
+  # records are decoded without unpack, data go through loader
+  # transfer buffer, replay doesn't allocate. register address
+  # is not made as reg<<24, that would be a heap int in micropython
+  def replay(self,f,boot):
+    ld=self.ld
+    bus=ld.bus
+    record=self.record
+    byte=self.byte
+    mv=ld.buffer(0,self.blocksize)
+    ld.cpu_halt()
+    ld.rom0_loaded=0
+    addr=-1 # next address of open SPI RAM write, -1 if closed
+    while f.readinto(record)==9:
+      op=record[0]
+      a=record[1]|(record[2]<<8)|(record[3]<<16)
+      reg=record[4]
+      n=record[5]|(record[6]<<8)|(record[7]<<16)|(record[8]<<24)
+      if op!=0x57 and op!=0x46 and op!=0x42:
+        break
+      if reg or a!=addr or op==0x42:
+        if addr>=0:
+          bus.end()
+          addr=-1
+      if op==0x42:
+        f.readinto(ld.word)
+        f.readinto(ld.header)
+        bus.boot_write(ld.boot_stub(ld.word[0]|(ld.word[1]<<8),ld.header))
+        continue
+      if op==0x57 and reg==spibus.ADDR_PAGING:
+        f.readinto(byte)
+        ld.paging(byte[0])
+        continue
+      if reg:
+        bus.begin_write_reg(reg,a)
+      else:
+        if a >= 0x10000 and not ld.core128(): # 128K replay on 48K core
+          if addr>=0:
+            bus.end()
+          ld.cpu_continue()
+          return
+        if a < 0x4000 and ld.rom1(): # ROM written
+          ld.rom_manager.forget()
+        if a >= spibus.ROM0_LINEAR and a < spibus.ROM0_LINEAR+0x4000: # .z80 page 2
+          ld.rom0_loaded=1
+          if ld.rom_manager:
+            ld.rom_manager.forget_rom0()
+        if addr<0:
+          bus.begin_write(a)
+        addr=a+n
+      if op==0x57:
+        while n:
+          k=min(n,self.blocksize)
+          b=mv if k==self.blocksize else mv[0:k]
+          f.readinto(b)
+          bus.write(b)
+          n-=k
+      else:
+        f.readinto(byte)
+        bus.fill(n,byte[0])
+      if reg:
+        bus.end()
+    if addr>=0:
+      bus.end()
+    if not ld.rom0_ready(ld.port): # ROM 0 file gone since compile
+      ld.paging()
+      boot=0
+    ld.start(boot)
+
+  # delete least recently used replay files until cache fits in budget
+  def evict(self,cachedir):
+    entries=[]
+    total=0
+    for name in os.listdir(cachedir):
+      st=os.stat(cachedir+"/"+name)
+      entries.append((st[8],st[6],name))
+      total+=st[6]
+    entries.sort()
+    for mtime,size,name in entries:
+      if total <= self.budget:
+        break
+      os.remove(cachedir+"/"+name)
+      total-=size
@@ -0,0 +1,148 @@
+# micropython ESP32
+# ZX spectrum ROM manager
+
+# LICENSE=BSD
+
+# remembers which ROM file is in FPGA RAM 0x0000-0x3FFF
+# (CPU can't write there) and which bytes of it were
+# overwritten by patch_rom. original bytes are kept
+# for patched areas, after start only they are restored.
+# switching ROM file writes only bytes that differ.
+# ROM from bitstream is unknown: original bytes are read
+# back once, first load of a ROM file writes all of it.
+# 128K editor ROM (ROM 0) is only written when a 128K
+# snapshot starts in it, from rom0 file or from bitstream.
+
+import spibus
+
+class ld_rom:
+  def __init__(self,bus,blocksize=1024,rom0=None):
+    self.bus=bus # spibus
+    self.blocksize=blocksize
+    self.filename=None # active ROM file, None: from bitstream
+    self.original={} # addr -> original bytes of active ROM
+    self.patched=[] # (addr,length) overwritten since last restore
+    self.rom0=rom0 # 128K editor ROM file
+    self.rom0_loaded=0 # ROM 0 holds editor ROM
+
+  # ROM content is not known any more (written by other loader)
+  def forget(self):
+    self.filename=None
+    self.original={}
+    self.patched=[]
+    self.rom0_loaded=0
+
+  # ROM 0 written by other loader (.z80 page 2)
+  def forget_rom0(self):
+    self.rom0_loaded=0
+
+  # editor ROM in ROM 0, CPU should be halted. ROM 0 from
+  # bitstream is used if there's no file and it isn't empty.
+  # returns 0 if there is no ROM 0
+  def load_rom0(self):
+    if self.rom0_loaded:
+      return 1
+    f=None
+    if self.rom0:
+      try:
+        f=open(self.rom0,"rb")
+      except OSError:
+        pass
+    if f:
+      print("load ROM 0 %s" % self.rom0)
+      self.bus.begin_write(spibus.ROM0_LINEAR)
+      block=bytearray(self.blocksize)
+      while True:
+        n=f.readinto(block)
+        if not n:
+          break
+        self.bus.write(memoryview(block)[0:n])
+      self.bus.end()
+      f.close()
+    elif not any(self.bus.peek(spibus.ROM0_LINEAR,16)):
+      return 0
+    self.rom0_loaded=1
+    return 1
+
+  # original bytes of active ROM, CPU should be halted
+  def get(self,addr,length):
+    b=self.original.get(addr)
+    if b is None or len(b) < length:
+      if self.filename:
+        f=open(self.filename,"rb")
+        f.seek(addr)
+        b=f.read(length)
+        f.close()
+      else:
+        b=self.bus.peek(addr,length)
+      self.original[addr]=b
+    return b
+
+  # area will be overwritten, remember it to restore
+  def touch(self,addr,length):
+    self.get(addr,length)
+    self.patched.append((addr,length))
+
+  def restore(self):
+    for addr,length in self.patched:
+      self.bus.poke(addr,memoryview(self.original[addr])[0:length])
+    self.patched=[]
+
+  # make filename active ROM, CPU should be halted
+  def load(self,filename):
+    if filename==self.filename:
+      self.restore()
+      return
+    f=open(filename,"rb")
+    if self.filename is None:
+      print("load ROM %s" % filename)
+      self.bus.begin_write(0)
+      block=bytearray(self.blocksize)
+      while True:
+        n=f.readinto(block)
+        if not n:
+          break
+        self.bus.write(memoryview(block)[0:n])
+      self.bus.end()
+      self.patched=[]
+    else:
+      self.switch(open(self.filename,"rb"),f)
+    f.close()
+    self.filename=filename
+    self.original={}
+    # patched areas hold neither ROM, write them from new ROM
+    for addr,length in self.patched:
+      self.get(addr,length)
+    self.restore()
+
+  # write only bytes where new ROM differs from old
+  # differences closer than 8 bytes are sent together
+  def switch(self,old,new):
+    a=bytearray(self.blocksize)
+    b=bytearray(self.blocksize)
+    mv=memoryview(b)
+    addr=0
+    written=0
+    while True:
+      na=old.readinto(a)
+      n=new.readinto(b)
+      if not n:
+        break
+      i=0
+      while i < n:
+        while i < n and i < na and a[i]==b[i]:
+          i+=1
+        if i==n:
+          break
+        j=i+1
+        k=j # end of difference
+        while j < n and j-k < 8:
+          if j >= na or a[j]!=b[j]:
+            k=j+1
+          j+=1
+        self.bus.poke(addr+i,mv[i:k])
+        written+=k-i
+        i=k
+      addr+=n
+    old.close()
+    print("switch ROM: %d bytes written" % written)
@@ -0,0 +1,324 @@
+# micropython ESP32
+# ZX spectrum .tap/.tzx tape image loader
+
+# LICENSE=BSD
+
+# instead of playing the tape in real time, each data block
+# is written directly to RAM at the address from its header block.
+# CPU is reset first and ROM sets up system variables, then
+# BASIC program is written to PROG area and its pointers are set
+# like LOAD sets them. BASIC loader is not run by the ROM: its
+# statements are followed up to the first USR, CLEAR and POKE
+# with numbers are done here, display and sound statements are
+# skipped. others (GO TO, IF, LET, OUT, ...) and anything after
+# USR are reported as not run, such a tape may not start right.
+# then the image is started like a .z80 snapshot.
+
+# https://sinclair.wiki.zxnet.co.uk/wiki/TAP_format
+# https://worldofspectrum.net/TZXformat.html
+
+from struct import pack, unpack
+from time import sleep
+
+# TZX block id -> (header length, length field offset, length field bytes, length multiplier)
+# block length = header length + multiplier * length field
+# unknown blocks have 4 byte length field (TZX 1.10+)
+tzx_blocks = {
+  0x10:(4,2,2,1),    # standard speed data
+  0x11:(18,15,3,1),  # turbo speed data
+  0x12:(4,0,0,0),    # pure tone
+  0x13:(1,0,1,2),    # pulse sequence
+  0x14:(10,7,3,1),   # pure data
+  0x15:(8,5,3,1),    # direct recording
+  0x20:(2,0,0,0),    # pause
+  0x21:(1,0,1,1),    # group start
+  0x22:(0,0,0,0),    # group end
+  0x23:(2,0,0,0),    # jump
+  0x24:(2,0,0,0),    # loop start
+  0x25:(0,0,0,0),    # loop end
+  0x26:(2,0,2,2),    # call sequence
+  0x27:(0,0,0,0),    # return
+  0x28:(2,0,2,1),    # select
+  0x30:(1,0,1,1),    # text
+  0x31:(2,1,1,1),    # message
+  0x32:(2,0,2,1),    # archive info
+  0x33:(1,0,1,3),    # hardware type
+  0x35:(20,16,4,1),  # custom info
+  0x5A:(9,0,0,0),    # glue
+}
+
+PROG = 23755 # BASIC program start on 48K without interface 1
+
+# system variables
+SV_VARS = 0x5C4B
+SV_CHANS = 0x5C4F
+SV_PROG = 0x5C53
+SV_E_LINE = 0x5C59
+SV_WORKSP = 0x5C61
+SV_RAMTOP = 0x5CB2
+SV_DF_SZ = 0x5C6B
+
+# BASIC tokens
+T_USR = 0xC0
+T_VAL = 0xB0
+T_REM = 0xEA
+T_POKE = 0xF4
+T_CLEAR = 0xFD
+T_LOAD = 0xEF
+# statements a loader doesn't need: INK PAPER FLASH BRIGHT
+# INVERSE OVER BEEP BORDER REM LOAD PAUSE PRINT RANDOMIZE CLS
+BASIC_SKIP = b"\xD9\xDA\xDB\xDC\xDD\xDE\xD7\xE7\xEA\xEF\xF2\xF5\xF9\xFB"
+
+class ld_tape:
+  def __init__(self,ld,init_ms=1000):
+    self.ld=ld # ld_zxspectrum
+    self.init_ms=init_ms # max wait for ROM init after reset
+
+  # yields (offset,length) of each data block: flag, data, checksum
+  def tap_blocks(self,f):
+    word=bytearray(2)
+    while f.readinto(word)==2:
+      length=unpack("<H",word)[0]
+      offset=f.tell()
+      yield offset,length
+      f.seek(offset+length)
+
+  def tzx_blocks(self,f):
+    header=bytearray(20)
+    f.seek(10) # "ZXTape!",0x1A,major,minor
+    while f.readinto(memoryview(header)[0:1])==1:
+      bid=header[0]
+      hlen,off,size,mult=tzx_blocks.get(bid,(4,0,4,1))
+      f.readinto(memoryview(header)[0:hlen])
+      length=0
+      for i in range(size):
+        length|=header[off+i]<<(i*8)
+      offset=f.tell()
+      if bid==0x10:
+        yield offset,length
+      f.seek(offset+mult*length)
+
+  def load(self,filename):
+    f=open(filename,"rb")
+    magic=f.read(8)
+    if magic==b"ZXTape!\x1A":
+      blocks=self.tzx_blocks(f)
+    else:
+      f.seek(0)
+      blocks=self.tap_blocks(f)
+    ld=self.ld
+    ld.cpu_halt()
+    ld.paging() # 48K machine
+    if self.rom_init():
+      prog=self.peek_word(SV_PROG)
+    else:
+      prog=PROG
+    header=None
+    code=[] # start addresses of loaded CODE blocks
+    loaded=[] # (addr,size) of blocks after last BASIC block
+    usr=-1
+    clear=-1
+    pokes=[]
+    b=bytearray(18)
+    for offset,length in blocks:
+      if length < 2:
+        continue
+      f.readinto(memoryview(b)[0:1])
+      if b[0]==0 and length==19: # header
+        f.readinto(b)
+        header=bytearray(b)
+        continue
+      if header is None:
+        print("headerless block ignored")
+        continue
+      btype=header[0]
+      size=min(unpack("<H",header[11:13])[0],length-2)
+      addr=-1
+      if btype==0: # BASIC program
+        addr=prog
+      if btype==3: # CODE
+        addr=unpack("<H",header[13:15])[0]
+        code.append(addr)
+        loaded.append((addr,size))
+      proglen=unpack("<H",header[15:17])[0] # BASIC without variables
+      header=None
+      if addr < 0:
+        print("array block ignored")
+        continue
+      print("load tape block: addr=%04X length=%d" % (addr,size))
+      ld.load_stream(f,addr,size)
+      if btype==0:
+        n=min(proglen,size)
+        self.basic_pointers(prog,n,size)
+        f.seek(offset+1)
+        u,c,pokes=self.basic_run(f.read(n))
+        if u >= 0:
+          usr=u
+        if c >= 0:
+          clear=c
+        loaded=[]
+    f.close()
+    if clear >= 0:
+      ld.bus.poke(SV_RAMTOP,pack("<H",clear))
+    # POKE before a LOAD is overwritten when that block covers it
+    pokes=[(a,bytes((v,))) for a,v,nload in pokes
+      if not any(addr <= a < addr+size for addr,size in loaded[nload:])]
+    if pokes:
+      ld.bus.poke_many(pokes)
+    if usr < 0:
+      if not code:
+        print("no code to start")
+        ld.cpu_continue() # in BASIC after ROM init
+        return
+      usr=code[0]
+    sp=clear
+    if sp < 0:
+      sp=0xFF57 # default RAMTOP
+      if code and min(code) > 0x5D00:
+        sp=min(code)
+    print("start PC=%04X SP=%04X" % (usr,sp))
+    ld.rom_loaded=0
+    ld.ram_loaded=1
+    ld.run(usr,ld.z80_header(sp))
+
+  # reset, wait until ROM has set up system variables and halt.
+  # DF_SZ is cleared first. ROM sets it to 2 after CHANS, PROG,
+  # E_LINE, WORKSP and streams, just before it clears the screen,
+  # nothing the loader needs comes later. RAM is read back only
+  # while CPU is halted, CPU runs between polls.
+  # returns 0 if ROM init didn't finish in init_ms
+  def rom_init(self):
+    ld=self.ld
+    ld.bus.poke(SV_DF_SZ,b"\x00")
+    ld.start(0) # reset
+    for i in range(self.init_ms//10):
+      sleep(0.01)
+      ld.cpu_halt()
+      if ld.bus.peek(SV_DF_SZ,1)[0]==2:
+        return 1
+      ld.cpu_continue()
+    ld.cpu_halt()
+    print("ROM init timeout")
+    return 0
+
+  def peek_word(self,addr):
+    b=self.ld.bus.peek(addr,2)
+    return b[0]|(b[1]<<8)
+
+  # BASIC block of length size with program of length n at prog:
+  # variables follow program, edit line follows variables
+  def basic_pointers(self,prog,n,size):
+    e_line=prog+size
+    self.ld.bus.poke_many([
+      (SV_VARS,pack("<H",prog+n)),
+      (SV_E_LINE,pack("<HH",e_line,e_line)), # E_LINE, K_CUR
+      (SV_WORKSP,pack("<HHH",e_line+2,e_line+2,e_line+2)), # WORKSP, STKBOT, STKEND
+      (e_line,b"\x0D\x80"),
+    ])
+
+  # BASIC program followed up to first USR, see top.
+  # returns usr (-1 if none), clear (-1 if none) and pokes
+  # (addr,value,LOADs before it)
+  def basic_run(self,prog):
+    usr=-1
+    clear=-1
+    pokes=[]
+    nload=0
+    i=0
+    n=len(prog)
+    while i+4 <= n:
+      line=(prog[i]<<8)|prog[i+1]
+      end=min(i+4+(prog[i+2]|(prog[i+3]<<8)),n)
+      j=i+4
+      while j < end:
+        if usr >= 0:
+          if prog[j]!=T_REM and prog[j]!=13:
+            print("BASIC after USR not run: line %d" % line)
+          return usr,clear,pokes
+        k=self.statement_end(prog,j,end)
+        t=prog[j]
+        u=self.find_token(prog,T_USR,j,k)
+        if u >= 0:
+          usr=self.number(prog,u+1,k)[0]
+          if usr < 0:
+            print("USR address not a number: line %d" % line)
+            return usr,clear,pokes
+        elif t==T_REM:
+          break
+        elif t==T_CLEAR:
+          c=self.number(prog,j+1,k)[0]
+          if c >= 0:
+            clear=c
+        elif t==T_POKE:
+          a,m=self.number(prog,j+1,k)
+          v=-1
+          if a >= 0x4000 and a <= 0xFFFF and m < k and prog[m]==44: # ,
+            v=self.number(prog,m+1,k)[0]
+          if v >= 0 and v < 256:
+            pokes.append((a,v,nload))
+          else:
+            print("POKE not run: line %d" % line)
+        elif t==T_LOAD:
+          nload+=1
+        elif BASIC_SKIP.find(bytes((t,))) < 0:
+          print("BASIC not run: line %d statement %02X" % (line,t))
+        j=k+1
+      i=end
+    return usr,clear,pokes
+
+  # index after element at j: 0x0E and hidden 5 byte number,
+  # string in quotes or one byte
+  def skip(self,prog,j,end):
+    if prog[j]==0x0E:
+      return j+6
+    if prog[j]==34: # "
+      k=prog.find(b'"',j+1,end)
+      return end if k < 0 else k+1
+    return j+1
+
+  # end of statement at j, index of : or end of line 0x0D
+  def statement_end(self,prog,j,end):
+    while j < end and prog[j]!=58 and prog[j]!=13:
+      j=self.skip(prog,j,end)
+    return min(j,end)
+
+  def find_token(self,prog,token,j,k):
+    while j < k:
+      if prog[j]==token:
+        return j
+      j=self.skip(prog,j,k)
+    return -1
+
+  # number at j: visible digits with hidden 0x0E + 5 byte number
+  # or VAL "digits". returns (value,index after it), value -1
+  # if it is not a number
+  def number(self,prog,j,end):
+    while j < end and prog[j]==32:
+      j+=1
+    if j+1 < end and prog[j]==T_VAL and prog[j+1]==34:
+      k=prog.find(b'"',j+2,end)
+      if k > j+2:
+        try:
+          return int(str(prog[j+2:k],"ascii")),k+1
+        except ValueError:
+          pass
+      return -1,j
+    k=j
+    while k < end and (48 <= prog[k] <= 57 or prog[k]==46):
+      k+=1
+    if k > j and k+6 <= end and prog[k]==0x0E:
+      return self.float5(prog[k+1:k+6]),k+6
+    return -1,j
+
+  # ZX spectrum 5 byte number
+  def float5(self,n):
+    if n[0]==0: # small integer
+      v=n[2]|(n[3]<<8)
+      if n[1]==0xFF:
+        v-=0x10000
+      return v
+    exp=n[0]-128
+    mantissa=((n[1]|0x80)<<24)|(n[2]<<16)|(n[3]<<8)|n[4]
+    if exp < 0 or exp > 32 or n[1]&0x80:
+      return -1
+    return mantissa>>(32-exp)
@@ -14,54 +14,318 @@
 #from machine import SPI, Pin, SDCard, Timer
 #from micropython import const, alloc_emergency_exception_buf
 #from uctypes import addressof
-from struct import unpack
+from struct import pack, unpack
+import sys
+import spibus
+try:
+  import _thread
+except ImportError:
+  _thread = None
 #from time import sleep_ms
 #import os
 
 #import ecp5
 #import gc
 
+BOOT_HEADER = 0x80 # registers in boot stub
+
+# Z80 code that POPs REGs from header as stack data, LD SP operand
+# at 1-2 is header+9. z80asm restore.z80asm; hexdump -v -e '/1 "0x%02X,"' a.bin
+RESTORE = bytes([0x31,0x00,0x00,0xF1,0xED,0x47,0xF1,0x1F,0xD3,0xFE,0xD1,0xD9,0xC1,0xD1,0xE1,0xD9,0xF1,0x08,0xFD,0xE1,0xDD,0xE1,0x21,0xE5,0xFF,0x39,0xF9,0xF1,0xC1,0xE1])
+IM_ARG = bytes([0x46,0x56,0x5E,0x5E]) # IM 0,1,2,2
+
+# .z80 header 1 word <- .sna header word: BC, HL, DE, BC', DE', HL', IY, IX
+SNA_WORDS = ((2,13),(4,9),(13,11),(15,5),(17,3),(19,1),(23,15),(25,17))
+
+# .z80 v2/v3 hardware modes with 128K paging
+Z80_128 = {23:(3,4), 54:(4,5,6,7,9,12,13), 55:(4,5,6,7,9,12,13)}
+
+# SPI RAM address of 128K .z80 page, see spibus:
+# 0 ROM 1, 2 ROM 0, 3-10 banks 0-7
+def page128_addr(page):
+  if page==0:
+    return 0x10000
+  if page>=2 and page<=10:
+    return 0xC000+page*0x4000
+  return -1
+
+# byte loops of RLE decoding. micropython: viper, slices of
+# memoryview would be heap objects. buffers are views from offset 0
+if sys.implementation.name == "micropython":
+  # index of first byte b in buf[i:n], n if none
+  @micropython.viper
+  def find_byte(buf:ptr8, i:int, n:int, b:int) -> int:
+    while i < n and buf[i] != b:
+      i += 1
+    return i
+
+  @micropython.viper
+  def copy_bytes(dst:ptr8, o:int, src:ptr8, i:int, n:int):
+    for k in range(n):
+      dst[o+k] = src[i+k]
+
+  @micropython.viper
+  def fill_bytes(dst:ptr8, o:int, n:int, b:int):
+    for k in range(o, o+n):
+      dst[k] = b
+
+  # index of first run of at least m equal bytes in buf[i:n], n if none
+  @micropython.viper
+  def find_run(buf:ptr8, i:int, n:int, m:int) -> int:
+    j = i
+    while j < n:
+      if buf[j] != buf[i]:
+        i = j
+      j += 1
+      if j-i >= m:
+        return i
+    return n
+
+  # end of run of buf[i] in buf[i:n]
+  @micropython.viper
+  def run_end(buf:ptr8, i:int, n:int) -> int:
+    b = buf[i]
+    while i < n and buf[i] == b:
+      i += 1
+    return i
+
+  # first n bytes of buf from stream f, without a slice
+  def readinto(f, buf, n):
+    return f.readinto(buf, n)
+else:
+  def find_byte(buf, i, n, b):
+    i = buf.obj.find(b, i, n)
+    return n if i < 0 else i
+
+  def copy_bytes(dst, o, src, i, n):
+    dst[o:o+n] = src[i:i+n]
+
+  # doubling copy within dst, n bytes b would be a heap object
+  def fill_bytes(dst, o, n, b):
+    if n:
+      dst[o] = b
+      k = 1
+      while k < n:
+        m = min(k, n-k)
+        dst[o+k:o+k+m] = dst[o:o+m]
+        k += m
+
+  def find_run(buf, i, n, m):
+    j = i
+    while j < n:
+      if buf[j] != buf[i]:
+        i = j
+      j += 1
+      if j-i >= m:
+        return i
+    return n
+
+  def run_end(buf, i, n):
+    b = buf[i]
+    while i < n and buf[i] == b:
+      i += 1
+    return i
+
+  def readinto(f, buf, n):
+    return f.readinto(buf if n == len(buf) else memoryview(buf)[0:n])
+
+# read-ahead thread of write_stream, one for all loaders since
+# zx and osdzx make a loader per load. buffer i is handed over
+# by locks: full[i] released by reader when filled, empty[i]
+# by writer when sent. locks and lists grow with nbuf only
+class read_ahead:
+  def __init__(self):
+    self.go = _thread.allocate_lock() # released for a load
+    self.go.acquire()
+    self.full = []
+    self.empty = []
+    self.bufs = []
+    self.lengths = []
+    self.nbuf = 0
+    self.file = None
+    self.maxlen = 0
+    self.stop = 0
+    self.error = None
+    _thread.start_new_thread(self.run, ())
+
+  def grow(self, nbuf):
+    while len(self.full) < nbuf:
+      full = _thread.allocate_lock()
+      full.acquire()
+      self.full.append(full)
+      self.empty.append(_thread.allocate_lock())
+      self.bufs.append(None)
+      self.lengths.append(0)
+
+  def run(self):
+    while True:
+      self.go.acquire()
+      bufs = self.bufs
+      nbuf = self.nbuf
+      i = 0
+      bytes_loaded = 0
+      n = 1
+      try:
+        while n:
+          self.empty[i].acquire()
+          n = 0
+          if not self.stop and bytes_loaded < self.maxlen:
+            n = readinto(self.file, bufs[i], min(self.maxlen-bytes_loaded, len(bufs[i]))) or 0
+            bytes_loaded += n
+          self.lengths[i] = n
+          self.full[i].release()
+          i = (i+1)%nbuf
+      except Exception as e:
+        self.error = e
+        self.lengths[i] = 0
+        self.full[i].release()
+
+reader_thread = None
+
+def reader(nbuf):
+  global reader_thread
+  if not reader_thread:
+    reader_thread = read_ahead()
+  reader_thread.grow(nbuf)
+  return reader_thread
+
 class ld_zxspectrum:
-  def __init__(self,spi,cs):
-    self.spi=spi
-    self.cs=cs
-    self.cs.off()
+  def __init__(self,bus,rom_manager=None):
+    self.bus=bus # spibus
+    self.rom_manager=rom_manager # ld_rom, told when ROM is written
     #self.rom="/sd/zxspectrum/roms/opense.rom"
+    self.port=0x30 # paging port 0x7FFD, 48K
+    self.next=-1 # next address of open page write, -1 closed
+    # buffers are kept between loads, loads don't allocate per block
+    self.bufs=[]
+    self.views=[]
+    self.page_header=bytearray(3)
+    self.header=bytearray(30) # .z80 header 1, also made from .sna
+    self.header2=bytearray(55)
+    self.sna=bytearray(27)
+    self.word=bytearray(2)
+    self.stub=bytearray(BOOT_HEADER+30) # 0 is NOP
+    self.stub_header=memoryview(self.stub)[BOOT_HEADER:]
+    self.replay_cache=None
+    self.nbuf=1 # read-ahead buffers of load paths, see write_stream
+    self.mem128=-1 # core has 128K banks (C_mem128), -1 not probed yet
+
+  # memoryview of n bytes of transfer buffer i,
+  # buffer grows only, it is allocated once for a blocksize.
+  # last view is kept, same n again doesn't make a slice
+  def buffer(self,i,n):
+    while len(self.bufs) <= i:
+      self.bufs.append(memoryview(bytearray(0)))
+      self.views.append(self.bufs[-1])
+    v=self.views[i]
+    if len(v)==n:
+      return v
+    b=self.bufs[i]
+    if len(b) < n:
+      b=memoryview(bytearray(n))
+      self.bufs[i]=b
+    v=b if len(b)==n else b[0:n]
+    self.views[i]=v
+    return v
 
   # LOAD/SAVE and CPU control
 
+  # raw file -> SPI RAM, file is opened for every call
+  def load_file(self, filename, addr=0, maxlen=0x10000):
+    f = open(filename, "rb")
+    try:
+      self.load_stream(f, addr, maxlen)
+    finally:
+      f.close()
+
   # read from file -> write to SPI RAM
-  def load_stream(self, filedata, addr=0, maxlen=0x10000, blocksize=1024):
-    block = bytearray(blocksize)
+  def load_stream(self, filedata, addr=0, maxlen=0x10000, blocksize=1024, nbuf=0):
     # Request load
-    self.cs.on()
-    self.spi.write(bytearray([0,(addr >> 24) & 0xFF, (addr >> 16) & 0xFF, (addr >> 8) & 0xFF, addr & 0xFF]))
+    self.bus.begin_write(addr)
+    try:
+      self.write_stream(filedata, maxlen, blocksize, nbuf)
+    finally:
+      self.bus.end()
+
+  # read from file -> SPI RAM write already requested by caller
+  # never reads more than maxlen bytes from file
+  # nbuf > 1: long loads read ahead in a second thread into nbuf
+  # buffers. SD reads overlap with SPI writes only if the driver
+  # releases the GIL, not measured on the board, so self.nbuf
+  # (used when nbuf=0) is 1, serial. returns bytes written
+  def write_stream(self, filedata, maxlen=0x10000, blocksize=1024, nbuf=0):
+    if not nbuf:
+      nbuf = self.nbuf
+    if _thread and nbuf > 1 and maxlen > 8*blocksize:
+      return self.write_stream_threaded(filedata, maxlen, blocksize, nbuf)
+    mv = self.buffer(0, blocksize)
     bytes_loaded = 0
     while bytes_loaded < maxlen:
-      if filedata.readinto(block):
-        self.spi.write(block)
-        bytes_loaded += blocksize
+      n = readinto(filedata, mv, min(maxlen-bytes_loaded, blocksize))
+      if n:
+        self.bus.write(mv if n == blocksize else mv[0:n])
+        bytes_loaded += n
       else:
         break
-    self.cs.off()
+    return bytes_loaded
+
+  def write_stream_threaded(self, filedata, maxlen, blocksize, nbuf):
+    r = reader(nbuf)
+    for i in range(nbuf):
+      r.bufs[i] = self.buffer(i, blocksize)
+    r.file = filedata
+    r.maxlen = maxlen
+    r.nbuf = nbuf
+    r.stop = 0
+    r.error = None
+    r.go.release()
+    full = r.full
+    empty = r.empty
+    i = 0
+    n = 1
+    bytes_loaded = 0
+    try:
+      while True:
+        full[i].acquire()
+        n = r.lengths[i]
+        if not n:
+          break
+        b = r.bufs[i]
+        self.bus.write(b if n == len(b) else b[0:n])
+        bytes_loaded += n
+        empty[i].release()
+        i = (i+1)%nbuf
+    finally:
+      # if write failed, reader is stopped and its buffers are
+      # drained, reader doesn't use filedata after return
+      r.stop = 1
+      while n:
+        empty[i].release()
+        i = (i+1)%nbuf
+        full[i].acquire()
+        n = r.lengths[i]
+      empty[i].release()
+      r.file = None
+      for i in range(nbuf):
+        r.bufs[i] = None
+    if r.error:
+      raise r.error
+    return bytes_loaded
 
   # read from SPI RAM -> write to file
   def save_stream(self, filedata, addr=0, length=1024, blocksize=1024):
     bytes_saved = 0
     block = bytearray(blocksize)
     # Request save
-    self.cs.on()
-    self.spi.write(bytearray([1,(addr >> 24) & 0xFF, (addr >> 16) & 0xFF, (addr >> 8) & 0xFF, addr & 0xFF, 0]))
+    self.bus.begin_read(addr)
     while bytes_saved < length:
-      self.spi.readinto(block)
+      self.bus.readinto(block)
       filedata.write(block)
       bytes_saved += len(block)
-    self.cs.off()
+    self.bus.end()
 
   def ctrl(self,i):
-    self.cs.on()
-    self.spi.write(bytearray([0, 0xFF, 0xFF, 0xFF, 0xFF, i]))
-    self.cs.off()
+    self.bus.ctrl(i)
 
   def cpu_halt(self):
     self.ctrl(2)
@@ -69,140 +333,351 @@ class ld_zxspectrum:
   def cpu_continue(self):
     self.ctrl(0)
 
-  def load_z80_compressed_stream(self, filedata, length=0xFFFF):
-    b=bytearray(1)
-    escbyte=bytearray([0xED])
-    s=0
+  # 128K paging port 0x7FFD, 0x30 for 48K snapshots
+  def paging(self,port=0x30):
+    self.port=port
+    self.bus.paging(port)
+
+  # decode .z80 RLE stream into SPI RAM write already requested by caller
+  # compressed data are read in blocks, decoded data are staged
+  # in a buffer and sent to SPI in full blocks. runs of one byte
+  # are joined, whole blocks of a run are filled by SPI, so writes
+  # and fills stay block aligned and a 16K page needs no slice.
+  # ED ED escape may span over block boundary.
+  # never reads more than "length" bytes from file, never
+  # writes more than "limit" bytes, decoded data past it are
+  # dropped (corrupt page, 00 of v1 end marker).
+  # returns bytes read, self.decoded holds bytes written
+  def load_z80_compressed_stream(self, filedata, length=0xFFFF, blocksize=1024, limit=0x10000):
+    block=self.buffer(0,blocksize) # staged decoded data
+    chunk=self.buffer(1,blocksize) # compressed data
+    o=0 # staged bytes count
+    s=0 # 0:data 1:ED 2:ED,ED 3:ED,ED,repeat
     repeat=0
+    run=0 # length of pending run of byte run_b
+    run_b=0
     bytes_loaded=0
-    while bytes_loaded < length:
-      if filedata.readinto(b):
-        nexts=s
+    end=0
+    decoded=0
+    while bytes_loaded < length and not end:
+      n=readinto(filedata,chunk,min(length-bytes_loaded,blocksize))
+      if not n:
+        break
+      bytes_loaded+=n
+      i=0
+      while i < n:
         if s==0:
-          if b[0]==escbyte[0]:
-            nexts=1
-          else:
-            self.spi.write(b)
+          j=find_byte(chunk,i,n,0xED)
+          m=j
+          if decoded+j-i > limit:
+            m=i+limit-decoded
+          if run and i < m:
+            o=self.stage_run(block,o,run,run_b)
+            run=0
+          decoded+=m-i
+          while i < m: # copy run of literal data
+            k=min(m-i,blocksize-o)
+            copy_bytes(block,o,chunk,i,k)
+            o+=k
+            i+=k
+            if o==blocksize:
+              self.bus.write(block)
+              o=0
+          i=j
+          if i < n:
+            s=1
+            i+=1
+          continue
+        b=chunk[i]
+        i+=1
         if s==1:
-          if b[0]==escbyte[0]:
-            nexts=2
-          else:
-            self.spi.write(escbyte)
-            self.spi.write(b)
-            nexts=0
-        if s==2:
-          repeat=b[0]
+          if b==0xED:
+            s=2
+          else: # single ED is data, next byte is processed as data
+            if decoded < limit:
+              if run:
+                o=self.stage_run(block,o,run,run_b)
+                run=0
+              block[o]=0xED
+              o+=1
+              decoded+=1
+              if o==blocksize:
+                self.bus.write(block)
+                o=0
+            s=0
+            i-=1
+        elif s==2:
+          repeat=b
           if repeat==0:
             print("end")
+            bytes_loaded-=n-i
+            end=1
             break
-          nexts=3
-        if s==3:
-          self.spi.read(repeat,b[0])
-          nexts=0
-        s=nexts
-        bytes_loaded += 1
-      else:
-        break
-    print("bytes loaded %d" % bytes_loaded)
+          s=3
+        else:
+          k=min(repeat,limit-decoded)
+          if k:
+            if run and b!=run_b:
+              o=self.stage_run(block,o,run,run_b)
+              run=0
+            run+=k
+            run_b=b
+            decoded+=k
+          s=0
+    if run:
+      o=self.stage_run(block,o,run,run_b)
+    if s==1 and decoded < limit: # ED at end of stream is data
+      block[o]=0xED
+      o+=1
+      decoded+=1
+    if o==blocksize:
+      self.bus.write(block)
+    elif o:
+      self.bus.write(block[0:o])
+    print("bytes loaded", bytes_loaded) # no string made per block
+    self.decoded=decoded
+    return bytes_loaded
+
+  # run of n bytes b at staged offset o: a started block is
+  # completed, whole blocks are filled by SPI, rest is staged.
+  # returns o
+  def stage_run(self,block,o,n,b):
+    blocksize=len(block)
+    if o:
+      k=min(n,blocksize-o)
+      fill_bytes(block,o,k,b)
+      o+=k
+      n-=k
+      if o==blocksize:
+        self.bus.write(block)
+        o=0
+    k=n-n%blocksize
+    if k:
+      self.bus.fill(k,b)
+      n-=k
+    fill_bytes(block,o,n,b)
+    return o+n
 
   def load_z80_v1_compressed_block(self, filedata):
-    self.cs.on()
-    self.spi.write(bytearray([0,0,0,0x40,0])) # from 0x4000
-    self.load_z80_compressed_stream(filedata)
-    self.cs.off()
+    self.bus.begin_write(0x4000)
+    self.load_z80_compressed_stream(filedata,0xFFFF,1024,0xC000)
+    self.bus.end()
 
-  def load_z80_v23_block(self, filedata):
-    header = bytearray(3)
+  # pages follow each other in one SPI write while their
+  # addresses are contiguous: 48K pages 4,5 or 8,4,5 and
+  # 128K pages 3-10. caller ends write open in self.next
+  def load_z80_v23_block(self, filedata, mem128=0):
+    header = self.page_header
     if filedata.readinto(header):
-      length,page = unpack("<HB",header)
+      length = header[0]|(header[1]<<8)
+      page = header[2]
     else:
       return False
     addr = -1
-    if page==0:
-      addr=0
-      self.rom_loaded=1
-    if page==4:
-      addr=0x8000
-      self.ram_loaded=1
-    if page==5:
-      addr=0xC000
-      self.ram_loaded=1
-    if page==8:
-      addr=0x4000
-      self.ram_loaded=1
-    if addr < 0:
-      print("unsupported page ignored")
-      filedata.seek(length,1)
-      return True
+    if mem128:
+      addr=page128_addr(page)
+    else:
+      if page==0:
+        addr=0
+      if page==4:
+        addr=0x8000
+      if page==5:
+        addr=0xC000
+      if page==8:
+        addr=0x4000
     if length==0xFFFF:
       compress=0
       length=0x4000
     else:
       compress=1
-    print("load z80 block: length=%d, page=%d, compress=%d" % (length,page,compress))
+    if addr < 0:
+      print("unsupported page ignored")
+      filedata.seek(length,1)
+      return True
+    if page==0:
+      self.rom_loaded=1
+      if self.rom_manager:
+        self.rom_manager.forget()
+    else:
+      self.ram_loaded=1
+    if mem128 and page==2 and self.rom_manager:
+      self.rom_manager.forget_rom0()
+    print("load z80 block: length", length, "page", page, "compress", compress)
     #print("addr=%04X compress=%d" % (addr,compress))
-    if compress:
+    if addr!=self.next:
+      if self.next>=0:
+        self.bus.end()
       # Request load
-      self.cs.on()
-      self.spi.write(bytearray([0,(addr >> 24) & 0xFF, (addr >> 16) & 0xFF, (addr >> 8) & 0xFF, addr & 0xFF]))
-      self.load_z80_compressed_stream(filedata,length)
-      self.cs.off()
+      self.bus.begin_write(addr)
+    if compress:
+      self.load_z80_compressed_stream(filedata,length,1024,0x4000)
+      n=self.decoded
     else:
-      print("uncompressed v2/v3 may need FIXME")
-      self.load_stream(filedata,addr,16384)
+      n=self.write_stream(filedata,16384)
+    self.next=addr+n
     return True
 
-  def store_rom(self):
-    self.stored_code=bytearray(self.code_length)
-    self.cs.on()
-    self.spi.write(bytearray([1, 0,0,(self.code_addr>>8)&0xFF,self.code_addr&0xFF, 0]))
-    self.spi.readinto(self.stored_code)
-    self.cs.off()
-    self.stored_vector=bytearray(self.vector_length)
-    self.cs.on()
-    self.spi.write(bytearray([1, 0,0,(self.vector_addr>>8)&0xFF,self.vector_addr&0xFF, 0]))
-    self.spi.readinto(self.stored_vector)
-    self.cs.off()
-
-  def restore_rom(self):
-    self.cs.on()
-    self.spi.write(bytearray([0, 0,0,(self.code_addr>>8)&0xFF,self.code_addr&0xFF]))
-    self.spi.write(self.stored_code)
-    self.cs.off()
-    self.cs.on()
-    self.spi.write(bytearray([0, 0,0,(self.vector_addr>>8)&0xFF,self.vector_addr&0xFF]))
-    self.spi.write(self.stored_vector)
-    self.cs.off()
+  # read SPI RAM -> .z80 RLE -> file, CPU should be halted
+  # RAM is read in blocks, runs may span over block boundary.
+  # returns compressed length
+  def save_z80_compressed_stream(self, filedata, addr=0, length=0x4000, blocksize=1024):
+    block=bytearray(blocksize)
+    out=bytearray(blocksize+4) # staged compressed data
+    o=0
+    rb=-1 # run byte
+    rn=0 # run length
+    lit=0 # previous output was single ED, next byte is literal
+    bytes_saved=0
+    self.bus.begin_read(addr)
+    while length > 0:
+      n=min(blocksize,length)
+      mv=memoryview(block)[0:n]
+      self.bus.readinto(mv)
+      length-=n
+      for i in range(n+(length==0)):
+        if i < n:
+          b=block[i]
+          if b==rb and rn < 255:
+            rn+=1
+            continue
+        if rn: # end of run
+          if rn > 4 or (rb==0xED and rn > 1):
+            out[o]=0xED
+            out[o+1]=0xED
+            out[o+2]=rn
+            out[o+3]=rb
+            o+=4
+          else:
+            for k in range(o,o+rn):
+              out[k]=rb
+            o+=rn
+            lit=rb==0xED
+          if o >= blocksize:
+            filedata.write(memoryview(out)[0:o])
+            bytes_saved+=o
+            o=0
+        if i==n:
+          break
+        if lit: # byte after single ED is not compressed
+          out[o]=b
+          o+=1
+          lit=0
+          rb=-1
+          rn=0
+        else:
+          rb=b
+          rn=1
+    self.bus.end()
+    if o:
+      filedata.write(memoryview(out)[0:o])
+      bytes_saved+=o
+    return bytes_saved
 
-  def patch_rom(self,pc,header):
-    # overwrite tape saving code in original ROM
-    # with restore code and data from header
-    code_addr = 0x4C2
-    header_addr = 0x500
-    self.cs.on()
-    self.spi.write(bytearray([0, 0,0,0,0, 0xF3, 0xAF, 0x11, 0xFF, 0xFF, 0xC3, code_addr&0xFF, (code_addr>>8)&0xFF])) # overwrite start of ROM to JP 0x04C2
-    self.cs.off()
-    self.cs.on()
-    self.spi.write(bytearray([0, 0,0,(code_addr>>8)&0xFF,code_addr&0xFF])) # overwrite 0x04C2
-    # Z80 code that POPs REGs from header as stack data at 0x500
-    # z80asm restore.z80asm; hexdump -v -e '/1 "0x%02X,"' a.bin
-    # restores border color, registers I, AFBCDEHL' and AFBCDEHL
-    self.spi.write(bytearray([0x31,(header_addr+9)&0xFF,((header_addr+9)>>8)&0xFF,0xF1,0xED,0x47,0xF1,0x1F,0xD3,0xFE,0xD1,0xD9,0xC1,0xD1,0xE1,0xD9,0xF1,0x08,0xFD,0xE1,0xDD,0xE1,0x21,0xE5,0xFF,0x39,0xF9,0xF1,0xC1,0xE1]));
-    self.spi.write(bytearray([0x31])) # LD SP, ...
-    self.spi.write(header[8:10])
-    self.spi.write(bytearray([0xED])) # IM ...
-    imarg = bytearray([0x46,0x56,0x5E,0x5E])
-    self.spi.write(bytearray([imarg[header[29]&3]])) # IM mode
-    if header[27]:
-      self.spi.write(bytearray([0xFB])) # EI
-    header[6]=pc&0xFF
-    header[7]=(pc>>8)&0xFF
-    self.spi.write(bytearray([0xC3])) # JP ...
-    self.spi.write(header[6:8]) # PC address of final JP
-    self.cs.off()
-    self.cs.on()
-    self.spi.write(bytearray([0, 0,0,(header_addr>>8)&0xFF,header_addr&0xFF])) # overwrite 0x0500 with header
-    # header fix: exchange A and F, A' and F' to become POPable
+  # save 48K RAM as compressed .z80 v3
+  # registers are not readable from FPGA, header is made to return
+  # to BASIC: SP and PC are popped from error return address at ERR_SP,
+  # border from BORDCR. other programs need pc and sp from caller.
+  def savez80(self,filename,pc=-1,sp=-1,blocksize=1024):
+    self.cpu_halt()
+    sysvars=self.bus.peek(0x5C3D,12)
+    err_sp=unpack("<H",sysvars[0:2])[0] # ERR_SP
+    if pc < 0 and err_sp >= 0x4000 and err_sp < 0xFFFF:
+      ret=unpack("<H",self.bus.peek(err_sp,2))[0]
+      if ret < 0x4000: # ROM error handler
+        pc=ret
+        if sp < 0:
+          sp=err_sp+2
+    if pc < 0:
+      print("PC not recoverable, image will start from reset")
+      pc=0
+    if sp < 0:
+      sp=0xFF57
+    header=self.z80_header(sp&0xFFFF)
+    header[12]=(sysvars[11]>>2)&(7<<1) # border from BORDCR bits 3-5
+    f=open(filename,"wb")
+    f.write(header)
+    header2=bytearray(54)
+    header2[0]=pc&0xFF
+    header2[1]=(pc>>8)&0xFF
+    f.write(pack("<H",len(header2)))
+    f.write(header2)
+    for page,addr in ((8,0x4000),(4,0x8000),(5,0xC000)):
+      pos=f.tell()
+      f.write(pack("<HB",0,page))
+      length=self.save_z80_compressed_stream(f,addr,0x4000,blocksize)
+      print("save z80 block: length=%d, page=%d" % (length,page))
+      f.seek(pos)
+      f.write(pack("<H",length))
+      f.seek(0,2)
+    f.close()
+    self.cpu_continue()
+
+  # ld_rom knows ROM 1 only
+  def rom1(self):
+    return self.rom_manager if self.port&0x10 else None
+
+  # 128K snapshot started in ROM 0 (port bit 4 clear) needs the
+  # editor ROM: .z80 page 2 (rom0_loaded) or ROM 0 of rom_manager.
+  # CPU should be halted, returns 0 if there is none
+  def rom0_ready(self,port):
+    if port&0x10 or self.rom0_loaded:
+      return 1
+    if self.rom_manager and self.rom_manager.load_rom0():
+      return 1
+    print("128K snapshot needs ROM 0, not started")
+    return 0
+
+  # 128K banks are linear SPI RAM above 64K, a 48K core drops
+  # writes there. last byte of bank 7 is written inverted and
+  # read back, then restored, once per loader. CPU should be halted
+  def core128(self):
+    if self.mem128 < 0:
+      a=page128_addr(10)+0x3FFF
+      b=self.bus.peek(a)[0]
+      self.bus.poke(a,bytes((b^0xFF,)))
+      self.mem128=int(self.bus.peek(a)[0]==b^0xFF)
+      self.bus.poke(a,bytes((b,)))
+    if not self.mem128:
+      print("128K snapshot needs 128K core, not loaded")
+    return self.mem128
+
+  # .z80 has page, blocks are skipped and file is seeked back
+  def z80_has_page(self,z,page):
+    pos=z.tell()
+    header=self.page_header
+    found=0
+    while z.readinto(header)==3:
+      if header[2]==page:
+        found=1
+        break
+      length=header[0]|(header[1]<<8)
+      z.seek(0x4000 if length==0xFFFF else length,1)
+    z.seek(pos)
+    return found
+
+  def rom_write(self,addr,data):
+    if self.rom1():
+      self.rom_manager.touch(addr,len(data))
+    self.bus.poke(addr,data)
+
+  # restore code written to buf at o, POPs header at header_addr
+  # restores border color, registers I, AFBCDEHL' and AFBCDEHL, SP, IM
+  # returns end of code
+  def restore_code(self,header_addr,header,buf,o=0):
+    n=len(RESTORE)
+    buf[o:o+n]=RESTORE
+    buf[o+1]=(header_addr+9)&0xFF
+    buf[o+2]=((header_addr+9)>>8)&0xFF
+    o+=n
+    buf[o]=0x31 # LD SP, ...
+    buf[o+1]=header[8]
+    buf[o+2]=header[9]
+    buf[o+3]=0xED # IM ...
+    buf[o+4]=IM_ARG[header[29]&3] # IM mode
+    return o+5
+
+  # header fix: exchange A and F, A' and F' to become POPable
+  def popable(self,header):
     x=header[0]
     header[0]=header[1]
     header[1]=x
@@ -212,32 +687,84 @@ class ld_zxspectrum:
     if header[12]==255:
       header[12]=1
     #header[12] ^= 7<<1 # FIXME border color
-    self.spi.write(header) # AF and AF' now POPable
-    self.cs.off()
-
-  def loadz80(self,filename):
-    self.code_addr=0x4c2
-    self.code_length=128
-    self.vector_addr=0
-    self.vector_length=16
+
+  # ROM start for images without ESP32 (roms/mkmem.py)
+  def patch_rom(self,pc,header):
+    # overwrite tape saving code in original ROM
+    # with restore code and data from header
+    code_addr = 0x4C2
+    header_addr = 0x500
+    self.rom_write(0,bytearray([0xF3, 0xAF, 0x11, 0xFF, 0xFF, 0xC3, code_addr&0xFF, (code_addr>>8)&0xFF])) # overwrite start of ROM to JP 0x04C2
+    code = bytearray(len(RESTORE)+9)
+    o = self.restore_code(header_addr,header,code)
+    if header[27]:
+      code[o] = 0xFB # EI
+      o += 1
+    header[6]=pc&0xFF
+    header[7]=(pc>>8)&0xFF
+    code[o] = 0xC3 # JP ...
+    code[o+1] = header[6] # PC address of final JP
+    code[o+2] = header[7]
+    self.rom_write(code_addr,memoryview(code)[0:o+3]) # overwrite 0x04C2
+    self.popable(header)
+    self.rom_write(header_addr,header) # overwrite 0x0500 with header, AF and AF' now POPable
+
+  # FPGA maps boot stub at 0x0000 after control bit 2, ROM and RAM
+  # are not touched: DI, restore code, NOPs, EI if enabled and
+  # JP PC at BOOT_JP unmaps it. header is at BOOT_HEADER.
+  # stub is one buffer of the loader, valid until next boot_stub
+  def boot_stub(self,pc,header):
+    stub=self.stub
+    stub[0]=0xF3 # DI
+    self.restore_code(BOOT_HEADER,header,stub,1)
+    stub[spibus.BOOT_JP-1]=0xFB if header[27] else 0 # EI or NOP
+    stub[spibus.BOOT_JP]=0xC3 # JP ...
+    stub[spibus.BOOT_JP+1]=pc&0xFF
+    stub[spibus.BOOT_JP+2]=(pc>>8)&0xFF
+    h=self.stub_header
+    h[0:30]=header
+    self.popable(h)
+    return stub
+
+  # loads snapshot from SD, compiled SPI replay cache is used if cache=1
+  def loadz80(self,filename,cache=1):
+    if cache:
+      if not self.replay_cache:
+        import ld_replay
+        self.replay_cache=ld_replay.ld_replay(self)
+      self.replay_cache.loadz80(filename)
+      return
+    z=open(filename,"rb")
+    self.cpu_halt()
+    image=self.load_z80(z)
+    z.close()
+    if image:
+      self.run(image[0],image[1])
+    else:
+      self.cpu_continue()
+
+  # parse .z80 file and load its RAM/ROM pages,
+  # CPU should be halted. returns (pc,header1) or None,
+  # header1 is a buffer of the loader, valid until next load
+  def load_z80(self,z):
     self.rom_loaded=0
     self.ram_loaded=0
-    z=open(filename,"rb")
-    header1 = bytearray(30)
+    self.rom0_loaded=0
+    header1 = self.header
     z.readinto(header1)
-    pc=unpack("<H",header1[6:8])[0]
-    self.cpu_halt()
+    pc=header1[6]|(header1[7]<<8)
     #self.load_stream(open(self.rom, "rb"), addr=0)
     if pc: # V1 format
       print("Z80 v1")
+      self.paging()
       if header1[12] & 32:
         self.load_z80_v1_compressed_block(z)
       else:
         self.load_stream(z,0x4000)
     else: # V2 or V3 format
-      word = bytearray(2)
+      word = self.word
       z.readinto(word)
-      length2 = unpack("<H", word)[0]
+      length2 = word[0]|(word[1]<<8)
       if length2 == 23:
         print("Z80 v2")
       else:
@@ -245,23 +772,165 @@ class ld_zxspectrum:
           print("Z80 v3")
         else:
           print("unsupported header2 length %d" % length2)
-          return
-      header2 = bytearray(length2)
-      z.readinto(header2)
-      pc=unpack("<H",header2[0:2])[0]
-      while self.load_z80_v23_block(z):
-        pass
-    z.close()
-    # if only ROM is loaded, don't restore
-    if self.ram_loaded or not self.rom_loaded:
-      self.store_rom()
-      self.patch_rom(pc,header1)
+          return None
+      header2 = self.header2
+      readinto(z,header2,length2)
+      pc=header2[0]|(header2[1]<<8)
+      mem128=header2[2] in Z80_128[length2]
+      if mem128:
+        print("128K port 7FFD=%02X" % header2[3])
+        if not self.core128():
+          return None
+        self.rom0_loaded=self.z80_has_page(z,2)
+        if not self.rom0_ready(header2[3]):
+          return None
+        self.paging(header2[3])
+      else:
+        self.paging()
+      self.next=-1
+      try:
+        while self.load_z80_v23_block(z,mem128):
+          pass
+      finally:
+        if self.next>=0:
+          self.next=-1
+          self.bus.end()
+    return pc,header1
+
+  # .tap/.tzx: data blocks are placed directly to RAM
+  def loadtap(self,filename):
+    import ld_tape
+    ld_tape.ld_tape(self).load(filename)
+
+  # .sna: 27 byte header followed by 48K RAM from 0x4000
+  # header is converted to .z80 header for patch_rom
+  # PC is popped from the stack in the image
+  def loadsna(self,filename,blocksize=4096):
+    z=open(filename,"rb")
+    try:
+      self.load_sna(z,blocksize)
+    finally:
+      z.close()
+
+  # parse .sna from file z, load and start it
+  def load_sna(self,z,blocksize=4096):
+    z.seek(0,2)
+    size=z.tell()
+    z.seek(0)
+    self.cpu_halt()
+    if size==0xC000: # raw RAM dump without registers
+      print("SNA raw 48K")
+      self.paging()
+      self.load_stream(z,0x4000,0xC000,blocksize)
+      self.cpu_continue()
+      return
+    sna=self.sna
+    z.readinto(sna)
+    sp=sna[23]|(sna[24]<<8)
+    if size > 27+0xC000:
+      self.loadsna128(z,sna,sp,blocksize)
+      return
+    self.paging()
+    word=self.word
+    word[0]=0
+    word[1]=0
+    if sp >= 0x4000 and sp < 0xFFFF:
+      z.seek(27+sp-0x4000)
+      z.readinto(word)
+      z.seek(27)
+    print("SNA 48K")
+    self.load_stream(z,0x4000,0xC000,blocksize)
+    self.rom_loaded=0
+    self.ram_loaded=1
+    self.run(word[0]|(word[1]<<8),self.sna2z80(sna,(sp+2)&0xFFFF))
+
+  # 128K .sna: 48K as paged, PC, port 0x7FFD, TR-DOS flag,
+  # then banks 0-7 without 5, 2 and the paged one
+  def loadsna128(self,z,sna,sp,blocksize=4096):
+    tail=self.header2 # free while .sna is loaded
+    z.seek(27+0xC000)
+    readinto(z,tail,4)
+    pc=tail[0]|(tail[1]<<8)
+    port=tail[2]
+    print("SNA 128K port 7FFD=%02X" % port)
+    self.rom0_loaded=0
+    if not self.core128() or not self.rom0_ready(port):
+      self.cpu_continue()
+      return
+    self.paging(port)
+    z.seek(27)
+    self.load_stream(z,0x4000,0xC000,blocksize)
+    z.seek(27+0xC000+4)
+    self.next=-1
+    try:
+      for bank in range(8):
+        if bank==5 or bank==2 or bank==port&7:
+          continue
+        addr=page128_addr(bank+3)
+        if addr!=self.next:
+          if self.next>=0:
+            self.bus.end()
+          self.bus.begin_write(addr)
+        self.next=addr+self.write_stream(z,0x4000,blocksize)
+    finally:
+      if self.next>=0:
+        self.next=-1
+        self.bus.end()
+    self.rom_loaded=0
+    self.ram_loaded=1
+    self.run(pc,self.sna2z80(sna,sp))
+
+  def sna2z80(self,sna,sp):
+    header=self.header
+    header[0]=sna[22] # A
+    header[1]=sna[21] # F
+    for i,j in SNA_WORDS: # slices would be heap objects
+      header[i]=sna[j]
+      header[i+1]=sna[j+1]
+    header[6]=0 # PC
+    header[7]=0
+    header[8]=sp&0xFF
+    header[9]=sp>>8
+    header[10]=sna[0] # I
+    header[11]=sna[20]&0x7F # R
+    header[12]=(sna[20]>>7)|((sna[26]&7)<<1) # R bit 7, border
+    header[21]=sna[8] # A'
+    header[22]=sna[7] # F'
+    header[27]=(sna[19]>>2)&1 # IFF1 = IFF2
+    header[28]=header[27]
+    header[29]=sna[25]&3 # IM
+    return header
+
+  # .z80 header 1 of state like after return from BASIC,
+  # for tape loads and saves of the running machine
+  def z80_header(self,sp):
+    header=bytearray(30)
+    header[8]=sp&0xFF
+    header[9]=sp>>8
+    header[10]=0x3F # I
+    header[12]=7<<1 # border
+    header[23]=0x3A # IY=0x5C3A system variables
+    header[24]=0x5C
+    header[27]=1 # EI
+    header[28]=1
+    header[29]=1 # IM 1
+    return header
+
+  # if only ROM is loaded, reset instead of restoring registers
+  def restores(self):
+    return self.ram_loaded or not self.rom_loaded
+
+  # restore registers from header and start loaded image
+  def run(self,pc,header):
+    if self.restores():
+      self.bus.boot_write(self.boot_stub(pc,header))
+    self.start(self.restores())
+
+  # boot stub is written if boot
+  def start(self,boot):
+    if boot:
+      self.ctrl(4) # reset pulse, registers from boot stub
+      return
     self.ctrl(3) # reset and halt
     self.ctrl(1) # only reset
     self.cpu_continue()
-    if self.ram_loaded or not self.rom_loaded:
-      self.cpu_halt()
-      self.restore_rom()
-      #self.load_stream(open(self.rom, "rb"), addr=0)
-      self.cpu_continue() # release reset
-
@@ -0,0 +1,364 @@
+# micropython ESP32
+# OSD file browser
+
+# LICENSE=BSD
+
+# directory listing and cursor on OSD text window,
+# needs only spibus, so it runs on a PC with spimodel too.
+# osdzx adds BTN IRQ, autorepeat and file loaders.
+
+# shadow keeps what was written to OSD tile memory, lines
+# are rendered into a buffer and only changed characters
+# are sent. scrolling by one line moves the OSD scroll
+# register and rewrites only the line that came in and
+# the cursor lines, instead of the whole screen. scroll
+# register 0xFC is only in spi_osd of this repo's ZX core,
+# with hw_scroll=0 lines are redrawn from the shadow.
+
+# autorepeat moves by the steps due since last frame, so a
+# slow redraw or a late timer never makes the cursor lag.
+
+# redraw doesn't allocate: lines are rendered in place from
+# directory index arrays into preallocated rows of frame.
+
+import dirindex
+try: # optional, see catalog.py
+  import catalog
+except ImportError:
+  catalog = None
+
+# cursor steps after n frames of autorepeat: 1 per frame
+# for 4 frames, then doubling each frame up to 512
+def autorepeat_steps(frames):
+  n = 0
+  for k in range(frames):
+    n += 1<<max(0, min(k-3, 9))
+  return n
+
+class osdfb:
+  def __init__(self, bus, cwd="/", hw_scroll=1):
+    self.bus = bus # spibus
+    self.hw_scroll = hw_scroll # core has OSD scroll register
+    self.screen_x = 64
+    self.screen_y = 20
+    self.cwd = cwd
+    self.init_fb()
+    self.init_osd()
+    self.exp_names = b" KMGTE"
+    self.mark = bytearray([32,16,42]) # space, right triangle, asterisk
+    self.loaders = {} # file extension -> loader
+    self.search = bytearray(self.screen_x) # type-ahead prefix
+    self.search_mv = memoryview(self.search)
+    self.catalog = None
+    self.direntries = None
+    self.read_dir()
+
+  # init file browser
+  def init_fb(self):
+    self.fb_topitem = 0
+    self.fb_cursor = 0
+    self.fb_selected = -1
+    self.search_len = 0
+
+  # OSD content is unknown (new bitstream), next show_dir writes all
+  def init_osd(self):
+    self.scroll = 0 # physical tile row of screen line 0
+    self.shadow = bytearray(self.screen_x*self.screen_y)
+    self.shadow_invert = bytearray(self.screen_x*self.screen_y)
+    self.shadow_valid = 0
+    self.line = memoryview(bytearray(self.screen_x))
+    self.frame = bytearray(self.screen_x*self.screen_y)
+    self.frame_invert = bytearray(self.screen_y)
+    sx = self.screen_x
+    frame = memoryview(self.frame)
+    shadow = memoryview(self.shadow)
+    self.frame_rows = [frame[p*sx:(p+1)*sx] for p in range(self.screen_y)]
+    self.shadow_rows = [shadow[p*sx:(p+1)*sx] for p in range(self.screen_y)]
+    if self.hw_scroll:
+      self.bus.osd_scroll(0)
+
+  def select_entry(self):
+    if self.direntries.is_dir(self.fb_cursor):
+      self.cwd = self.fullpath(self.direntries.name(self.fb_cursor))
+      self.init_fb()
+      self.read_dir()
+      self.show_dir()
+    else:
+      self.change_file()
+
+  def updir(self):
+    if len(self.cwd) < 2:
+      self.cwd = "/"
+    else:
+      s = self.cwd.split("/")[:-1]
+      self.cwd = ""
+      for name in s:
+        if len(name) > 0:
+          self.cwd += "/"+name
+    self.init_fb()
+    self.read_dir()
+    self.show_dir()
+
+  def fullpath(self,fname):
+    if self.cwd.endswith("/"):
+      return self.cwd+fname
+    else:
+      return self.cwd+"/"+fname
+
+  def change_file(self):
+    oldselected = self.fb_selected - self.fb_topitem
+    self.fb_selected = self.fb_cursor
+    try:
+      filename = self.fullpath(self.direntries.name(self.fb_cursor))
+    except:
+      filename = False
+      self.fb_selected = -1
+    self.show_dir_line(oldselected)
+    self.show_dir_line(self.fb_cursor - self.fb_topitem)
+    if filename:
+      loader=self.loaders.get(filename[filename.rfind("."):])
+      if loader:
+        loader(filename)
+
+  def osd_enable(self, en):
+    self.bus.osd_enable(en)
+
+  def osd_print(self, x, y, i, text):
+    if type(text) is str:
+      text = text.encode()
+    x &= 63
+    self.osd_put(x+(((y+self.scroll)%self.screen_y)<<6), memoryview(text)[0:self.screen_x-x], i)
+
+  def osd_cls(self):
+    self.bus.osd_fill(0,1280,32)
+    for i in range(len(self.shadow)):
+      self.shadow[i] = 32
+      self.shadow_invert[i] = 0
+    self.shadow_valid = 1
+
+  # write text at physical address a, only characters
+  # that differ from shadow. runs of less than 16 equal
+  # characters are sent with the changed ones.
+  def osd_put(self, a, text, invert):
+    shadow = self.shadow
+    shadow_invert = self.shadow_invert
+    n = len(text)
+    i = 0
+    while i < n:
+      if self.shadow_valid:
+        while i < n and shadow[a+i] == text[i] and shadow_invert[a+i] == invert:
+          i += 1
+        if i == n:
+          break
+        j = i+1
+        k = j # end of difference
+        while j < n and j-k < 16:
+          if shadow[a+j] != text[j] or shadow_invert[a+j] != invert:
+            k = j+1
+          j += 1
+      else:
+        k = n
+      self.bus.osd_write(a+i,text if k-i == n else text[i:k],invert)
+      for j in range(i,k):
+        shadow[a+j] = text[j]
+        shadow_invert[a+j] = invert
+      i = k
+
+  # render line y into line, return invert
+  def render_dir_line(self, y, line):
+    mark = 0
+    invert = 0
+    if y == self.fb_cursor - self.fb_topitem:
+      mark = 1
+      invert = 1
+    if y == self.fb_selected - self.fb_topitem:
+      mark = 2
+    for j in range(self.screen_x):
+      line[j] = 32
+    i = y+self.fb_topitem
+    d = self.direntries
+    if i >= len(d):
+      return invert
+    # mark, name in 57, size in 4 and exponent or D
+    line[0] = self.mark[mark]
+    d.name_into(i, line, 1, 57)
+    if d.is_dir(i):
+      line[63] = 68 # D
+    else: # file
+      mantissa = d.size(i)
+      exponent = 0
+      while mantissa >= 1024:
+        mantissa >>= 10
+        exponent += 1
+      line[63] = self.exp_names[exponent]
+      j = 62
+      while True:
+        line[j] = 48+mantissa%10
+        mantissa //= 10
+        j -= 1
+        if mantissa == 0:
+          break
+    if self.catalog:
+      info = self.catalog_info(i)
+      if info >= 0:
+        if info & catalog.BROKEN:
+          line[58] = 33 # !
+        elif info & catalog.DUPLICATE:
+          line[58] = 61 # =
+    return invert
+
+  # y is actual line on the screen
+  def show_dir_line(self, y):
+    if y < 0 or y >= self.screen_y:
+      return
+    invert = self.render_dir_line(y, self.line)
+    self.osd_put(((y+self.scroll)%self.screen_y)*self.screen_x, self.line, invert)
+
+  # whole screen is rendered to frame. when most lines
+  # changed it is sent in one burst, else line by line
+  def show_dir(self):
+    sx = self.screen_x
+    frame = self.frame
+    changed = 0
+    for y in range(self.screen_y):
+      p = (y+self.scroll)%self.screen_y
+      row = self.frame_rows[p]
+      invert = self.render_dir_line(y, row)
+      self.frame_invert[p] = invert
+      if not self.shadow_valid or self.shadow_invert[p*sx] != invert or self.shadow_rows[p] != row:
+        changed += 1
+    if changed == 0:
+      return
+    if changed > self.screen_y//2:
+      self.bus.osd_write(0,frame,0)
+      self.shadow[0:len(frame)] = frame
+      for i in range(len(self.shadow_invert)):
+        self.shadow_invert[i] = 0
+      self.shadow_valid = 1
+      for p in range(self.screen_y):
+        if self.frame_invert[p]:
+          self.osd_put(p*sx, self.frame_rows[p], 1)
+    else:
+      for p in range(self.screen_y):
+        self.osd_put(p*sx, self.frame_rows[p], self.frame_invert[p])
+
+  # step entries, any number of them costs one redraw
+  def move_dir_cursor(self, step):
+    oldcursor = self.fb_cursor
+    cursor = max(0, min(oldcursor+step, len(self.direntries)-1))
+    if cursor == oldcursor:
+      return
+    screen_line = cursor - self.fb_topitem
+    if screen_line >= 0 and screen_line < self.screen_y: # move cursor inside screen, no scroll
+      self.fb_cursor = cursor
+      self.show_dir_line(oldcursor - self.fb_topitem) # no highlight
+      self.show_dir_line(screen_line) # highlight
+    elif screen_line < 0: # cursor going up, on top line
+      self.jump(cursor, cursor)
+    else: # cursor going down, on bottom line
+      self.jump(cursor, cursor-self.screen_y+1)
+
+  # cursor to entry i with one redraw. screen moves only
+  # when i is not visible, or to top if given. shift by less
+  # than a screen uses hardware scroll, kept rows are not sent,
+  # rows coming in are sent before scroll register moves so no
+  # frame shows them stale. without it, show_dir sends the
+  # lines that differ from shadow
+  def jump(self, i, top=-1):
+    n = len(self.direntries)
+    if n == 0:
+      return
+    i = max(0, min(i, n-1))
+    if top < 0:
+      top = self.fb_topitem
+    if i < top or i >= top+self.screen_y:
+      top = i
+    top = max(0, min(top, n-self.screen_y))
+    step = top-self.fb_topitem
+    scroll = step != 0 and abs(step) < self.screen_y and self.hw_scroll
+    if scroll: # tile rows keep their content
+      self.scroll = (self.scroll+step)%self.screen_y
+    self.fb_cursor = i
+    self.fb_topitem = top
+    self.show_dir()
+    if scroll:
+      self.bus.osd_scroll(self.scroll)
+
+  # page up/down, cursor stays on the same screen line
+  def move_dir_page(self, step):
+    step *= self.screen_y
+    self.jump(self.fb_cursor+step, self.fb_topitem+step)
+
+  # to first entry of next or previous first letter
+  def move_dir_letter(self, step):
+    d = self.direntries
+    if len(d) == 0:
+      return
+    i = self.fb_cursor
+    while step > 0 and i < len(d):
+      i = d.first[d.letter(i)+1]
+      step -= 1
+    while step < 0:
+      c = d.letter(i)
+      if d.first[c] < i:
+        i = d.first[c]
+      elif i > 0:
+        i = d.first[d.letter(i-1)]
+      step += 1
+    self.jump(i)
+
+  # incremental search: key is added to prefix and cursor
+  # jumps to first name starting with it. key without match
+  # is dropped. backspace removes last key, esc clears.
+  def type_key(self, key):
+    if key == 8 or key == 127:
+      if self.search_len:
+        self.search_len -= 1
+    elif key == 27:
+      self.search_len = 0
+    elif self.search_len < len(self.search):
+      self.search[self.search_len] = key
+      self.search_len += 1
+    else:
+      return
+    if self.search_len == 0:
+      return
+    prefix = self.search_mv[0:self.search_len]
+    i = self.direntries.find(prefix)
+    if i < len(self.direntries) and self.direntries.cmp_prefix(i, prefix) == 0:
+      self.jump(i)
+    elif key != 8 and key != 127:
+      self.search_len -= 1
+
+  # sorted names, flags and sizes from directory index
+  def read_dir(self):
+    if self.direntries:
+      self.direntries.close()
+    self.direntries = None # free old arrays first
+    self.direntries = dirindex.dirindex(self.cwd)
+    if catalog:
+      self.read_catalog()
+
+  # catalogue of cwd or a directory above it, see catalog.py
+  def read_catalog(self):
+    path = self.fullpath("")
+    if self.catalog is None or not path.startswith(self.catalog_root):
+      self.catalog = None
+      try:
+        self.catalog = catalog.catalog(path+catalog.CATALOG)
+      except OSError:
+        return
+      self.catalog_root = path
+    self.catalog_prefix = path[len(self.catalog_root):].encode()
+    self.catalog_lo = self.catalog.find(self.catalog_prefix)
+    self.catalog_entries = dirindex.zeros("h", len(self.direntries))
+    for i in range(len(self.direntries)):
+      self.catalog_entries[i] = -2 # not looked up
+
+  # catalogue info of entry i, -1 if not catalogued
+  def catalog_info(self, i):
+    info = self.catalog_entries[i]
+    if info == -2:
+      info = self.catalog.lookup(self.catalog_prefix, self.direntries.name_mv(i), self.catalog_lo)
+      self.catalog_entries[i] = info
+    return info
@@ -11,51 +11,71 @@
 # SPI_write(buffer)
 # FPGA SPI slave will accept image and start it
 
+# pin IRQ handler only schedules poll. poll reads IRQ flag
+# and BTNs in one SPI transaction and queues the event,
+# events are processed after it. while a load or an SPI
+# transaction is in progress poll is postponed, IRQ stays
+# set in FPGA until it is read. IRQ+BTN register 0xF2 is read
+# only while ZX core of this repo is loaded, other cores have
+# spi_ram_btn without it and are read from 0xF1 and 0xFB.
+
 from machine import SPI, Pin, SDCard, Timer
-from micropython import const, alloc_emergency_exception_buf
-from uctypes import addressof
-from struct import unpack
+from micropython import const, alloc_emergency_exception_buf, schedule
+from time import ticks_ms, ticks_diff
 import os
 import gc
 import ecp5
+import spidiff
+import spicalib
+import ld_rom
+import osdfb
+
+AUTOREPEAT_DELAY = const(400) # ms before first repeat
+AUTOREPEAT_FRAME = const(40) # ms per redraw
+ZX_BIT = "/sd/zxspectrum/bitstreams/zxspectrum" # ZX core bitstreams
 
-class osdzx:
+class osdzx(osdfb.osdfb):
   def __init__(self):
-    self.screen_x = const(64)
-    self.screen_y = const(20)
-    self.cwd = "/"
-    self.init_fb()
-    self.exp_names = " KMGTE"
-    self.mark = bytearray([32,16,42]) # space, right triangle, asterisk
-    self.read_dir()
-    self.spi_read_irq = bytearray([1,0xF1,0,0,0,0,0])
-    self.spi_read_btn = bytearray([1,0xFB,0,0,0,0,0])
-    self.spi_result = bytearray(7)
-    self.spi_enable_osd = bytearray([0,0xFE,0,0,0,1])
-    self.spi_write_osd = bytearray([0,0xFD,0,0,0])
     self.spi_channel = const(2)
     self.spi_freq = const(4000000)
     self.init_pinout_sd()
     #self.spi=SPI(self.spi_channel, baudrate=self.spi_freq, polarity=0, phase=0, bits=8, firstbit=SPI.MSB, sck=Pin(self.gpio_sck), mosi=Pin(self.gpio_mosi), miso=Pin(self.gpio_miso))
+    self.zx_core = 1 # programmed at boot, below
     self.init_spi()
+    osdfb.osdfb.__init__(self, self.bus)
+    # file extension -> loader
+    self.loaders = {
+      ".bit":self.load_bit,
+      ".gz":self.load_gz,
+      ".z":self.load_gz,
+      ".z80":self.load_z80,
+      ".sna":self.load_sna,
+      ".tap":self.load_tap,
+      ".tzx":self.load_tap,
+      ".nes":self.load_nes,
+    }
     alloc_emergency_exception_buf(100)
     self.enable = bytearray(1)
     self.timer = Timer(3)
-    self.irq_handler(0)
-    self.irq_handler_ref = self.irq_handler # allocation happens here
+    self.events = bytearray(8) # BTN event queue
+    self.event_head = 0
+    self.event_tail = 0
+    self.busy = 0 # load in progress, events wait
+    self.processing = 0
+    self.poll_pending = bytearray(1)
+    self.poll_ref = self.poll # allocation happens here
+    self.irq_handler_ref = self.irq_handler
+    self.poll(0)
     self.spi_request = Pin(0, Pin.IN, Pin.PULL_UP)
     self.spi_request.irq(trigger=Pin.IRQ_FALLING, handler=self.irq_handler_ref)
 
   def init_spi(self):
     self.spi=SPI(self.spi_channel, baudrate=self.spi_freq, polarity=0, phase=0, bits=8, firstbit=SPI.MSB, sck=Pin(self.gpio_sck), mosi=Pin(self.gpio_mosi), miso=Pin(self.gpio_miso))
     self.cs=Pin(self.gpio_cs,Pin.OUT)
-    self.cs.off()
-
-# init file browser
-  def init_fb(self):
-    self.fb_topitem = 0
-    self.fb_cursor = 0
-    self.fb_selected = -1
+    self.calib=spicalib.spicalib(self.spi,self.cs)
+    self.spi_freq=self.calib.init() # stored or calibrated clock
+    self.bus=spidiff.spidiff(self.spi,self.cs)
+    self.rom_manager=ld_rom.ld_rom(self.bus,rom0="/sd/zxspectrum/roms/128-0.rom")
 
   @micropython.viper
   def init_pinout_sd(self):
@@ -64,224 +84,207 @@ class osdzx:
     self.gpio_mosi = const(4)
     self.gpio_miso = const(12)
 
-  @micropython.viper
+  # runs in interrupt, no SPI and no allocation
   def irq_handler(self, pin):
-    p8result = ptr8(addressof(self.spi_result))
-    self.cs.on()
-    self.spi.write_readinto(self.spi_read_irq, self.spi_result)
-    self.cs.off()
-    btn_irq = p8result[6]
-    if btn_irq&0x80: # btn event IRQ flag
-      self.cs.on()
-      self.spi.write_readinto(self.spi_read_btn, self.spi_result)
-      self.cs.off()
-      btn = p8result[6]
-      p8enable = ptr8(addressof(self.enable))
-      if p8enable[0]&2: # wait to release all BTNs
-        if btn==1:
-          p8enable[0]&=1 # clear bit that waits for all BTNs released
-      else: # all BTNs released
-        if (btn&0x78)==0x78: # all cursor BTNs pressed at the same time
-          self.show_dir() # refresh directory
-          p8enable[0]=(p8enable[0]^1)|2;
-          self.osd_enable(p8enable[0]&1)
-        if p8enable[0]==1:
-          if btn==9: # btn3 cursor up
-            self.start_autorepeat(-1)
-          if btn==17: # btn4 cursor down
-            self.start_autorepeat(1)
-          if btn==1:
-            self.timer.deinit() # stop autorepeat
-          if btn==33: # btn6 cursor left
-            self.updir()
-          if btn==65: # btn6 cursor right
-            self.select_entry()
+    if not self.poll_pending[0]:
+      self.poll_pending[0]=1
+      schedule(self.poll_ref, 0)
 
-  def start_autorepeat(self, i:int):
-    self.autorepeat_direction=i
-    self.move_dir_cursor(i)
-    self.timer_slow=1
-    self.timer.init(mode=Timer.PERIODIC, period=500, callback=self.autorepeat)
+  def poll(self, arg):
+    if self.busy:
+      self.poll_pending[0]=1 # polled after load
+      return
+    if self.cs.value(): # transaction open, try again
+      self.poll_pending[0]=1
+      schedule(self.poll_ref, 0)
+      return
+    self.poll_pending[0]=0
+    if self.zx_core:
+      ev = self.bus.irq_btn()
+    else:
+      ev = self.bus.irq()
+      if ev&0x80:
+        ev |= self.bus.btn()
+    if ev&0x80: # btn event IRQ flag
+      self.put_event(ev&0x7F)
+    self.process_events()
 
-  def autorepeat(self, timer):
-    if self.timer_slow:
-      self.timer_slow=0
-      self.timer.init(mode=Timer.PERIODIC, period=30, callback=self.autorepeat)
-    self.move_dir_cursor(self.autorepeat_direction)
-    self.irq_handler(0) # catch stale IRQ
+  def put_event(self, btn):
+    tail = (self.event_tail+1)%len(self.events)
+    if tail != self.event_head: # full queue drops event
+      self.events[self.event_tail] = btn
+      self.event_tail = tail
 
-  def select_entry(self):
-    if self.direntries[self.fb_cursor][1]: # is it directory
-      self.cwd = self.fullpath(self.direntries[self.fb_cursor][0])
-      self.init_fb()
-      self.read_dir()
-      self.show_dir()
-    else:
-      self.change_file()
+  def process_events(self):
+    if self.processing:
+      return
+    self.processing = 1
+    try:
+      while self.event_head != self.event_tail:
+        btn = self.events[self.event_head]
+        self.event_head = (self.event_head+1)%len(self.events)
+        self.button(btn)
+    finally:
+      self.processing = 0
 
-  def updir(self):
-    if len(self.cwd) < 2:
-      self.cwd = "/"
-    else:
-      s = self.cwd.split("/")[:-1]
-      self.cwd = ""
-      for name in s:
-        if len(name) > 0:
-          self.cwd += "/"+name
-    self.init_fb()
-    self.read_dir()
-    self.show_dir()
+  def button(self, btn):
+    enable = self.enable
+    if enable[0]&2: # wait to release all BTNs
+      if btn==1:
+        enable[0]&=1 # clear bit that waits for all BTNs released
+    else: # all BTNs released
+      if (btn&0x78)==0x78: # all cursor BTNs pressed at the same time
+        self.show_dir() # refresh directory
+        enable[0]=(enable[0]^1)|2;
+        self.osd_enable(enable[0]&1)
+      if enable[0]==1:
+        if btn==9: # btn3 cursor up
+          self.start_autorepeat(-1,self.move_dir_cursor,1)
+        if btn==17: # btn4 cursor down
+          self.start_autorepeat(1,self.move_dir_cursor,1)
+        if btn==11: # btn1+btn3 page up
+          self.start_autorepeat(-1,self.move_dir_page)
+        if btn==19: # btn1+btn4 page down
+          self.start_autorepeat(1,self.move_dir_page)
+        if btn==13: # btn2+btn3 previous letter
+          self.start_autorepeat(-1,self.move_dir_letter)
+        if btn==21: # btn2+btn4 next letter
+          self.start_autorepeat(1,self.move_dir_letter)
+        if btn==1:
+          self.timer.deinit() # stop autorepeat
+        if btn==33: # btn6 cursor left
+          self.updir()
+        if btn==65: # btn6 cursor right
+          self.select_entry()
+
+  # first move at press, repeat after DELAY, then one redraw
+  # per FRAME with the steps due by time, late frames coalesce
+  def start_autorepeat(self, i:int, move, accel=0):
+    self.autorepeat_direction=i
+    self.autorepeat_move=move
+    self.autorepeat_accel=accel
+    self.autorepeat_start=ticks_ms()
+    self.autorepeat_done=0
+    move(i)
+    self.timer.init(mode=Timer.PERIODIC, period=AUTOREPEAT_FRAME, callback=self.autorepeat)
 
-  def fullpath(self,fname):
-    if self.cwd.endswith("/"):
-      return self.cwd+fname
+  def autorepeat(self, timer):
+    if self.busy:
+      return
+    elapsed=ticks_diff(ticks_ms(),self.autorepeat_start)-AUTOREPEAT_DELAY
+    if elapsed < 0:
+      return
+    frames=elapsed//AUTOREPEAT_FRAME+1
+    if self.autorepeat_accel:
+      steps=osdfb.autorepeat_steps(frames)
     else:
-      return self.cwd+"/"+fname
+      steps=frames
+    if steps > self.autorepeat_done:
+      self.autorepeat_move(self.autorepeat_direction*(steps-self.autorepeat_done))
+      self.autorepeat_done=steps
+    self.poll(0) # catch stale IRQ
 
-  def change_file(self):
-    oldselected = self.fb_selected - self.fb_topitem
-    self.fb_selected = self.fb_cursor
+  # IRQ, SPI and busy are restored also when programming fails
+  def load_bit(self, filename):
+    self.busy+=1
+    self.spi_request.irq(handler=None)
     try:
-      filename = self.fullpath(self.direntries[self.fb_cursor][0])
-    except:
-      filename = False
-      self.fb_selected = -1
-    self.show_dir_line(oldselected)
-    self.show_dir_line(self.fb_cursor - self.fb_topitem)
-    if filename:
-      if filename.endswith(".bit"):
-        self.spi_request.irq(handler=None)
-        self.timer.deinit()
-        self.enable[0]=0
-        self.osd_enable(0)
-        self.spi.deinit()
-        tap=ecp5.ecp5()
-        tap.prog_stream(open(filename,"rb"),blocksize=1024)
-        if filename.endswith("_sd.bit"):
-          os.umount("/sd")
-          for i in bytearray([2,4,12,13,14,15]):
-            p=Pin(i,Pin.IN)
-            a=p.value()
-            del p,a
-        result=tap.prog_close()
-        del tap
-        gc.collect()
-        #os.mount(SDCard(slot=3),"/sd") # BUG, won't work
+      self.timer.deinit()
+      self.enable[0]=0
+      self.osd_enable(0)
+      self.spi.deinit()
+      self.zx_core=0 # unknown until programmed
+      tap=ecp5.ecp5()
+      f=open(filename,"rb")
+      try:
+        if not filename.endswith(".bit"): # .bit.gz or .bit.z
+          import gzstream
+          f=gzstream.gzstream(f)
+          filename=filename[:filename.rfind(".")]
+        tap.prog_stream(f,blocksize=1024)
+      finally:
+        f.close()
+      if filename.endswith("_sd.bit"):
+        self.direntries.close() # .zxindex may be open on /sd
+        os.umount("/sd")
+        self.cwd="/" # listing of /sd is gone, browse flash
+        self.init_fb()
+        self.read_dir()
+        for i in bytearray([2,4,12,13,14,15]):
+          p=Pin(i,Pin.IN)
+          a=p.value()
+          del p,a
+      result=tap.prog_close()
+      self.zx_core=filename.startswith(ZX_BIT)
+      del tap
+      gc.collect()
+      #os.mount(SDCard(slot=3),"/sd") # BUG, won't work
+    finally:
+      try:
         self.init_spi() # because of ecp5.prog() spi.deinit()
+        self.hw_scroll=self.zx_core
+        self.init_osd() # new bitstream, OSD content unknown
+      finally:
         self.spi_request.irq(trigger=Pin.IRQ_FALLING, handler=self.irq_handler_ref)
-        self.irq_handler(0) # handle stuck IRQ
-      if filename.endswith(".z80"):
-        self.enable[0]=0
-        self.osd_enable(0)
-        import ld_zxspectrum
-        s=ld_zxspectrum.ld_zxspectrum(self.spi,self.cs)
-        s.loadz80(filename)
-        del s
-        gc.collect()
-      if filename.endswith(".nes"):
-        import ld_zxspectrum
-        s=ld_zxspectrum.ld_zxspectrum(self.spi,self.cs)
-        s.ctrl(1)
-        s.ctrl(0)
-        s.load_stream(open(filename,"rb"),addr=0,maxlen=0x101000)
-        del s
-        gc.collect()
-        self.enable[0]=0
-        self.osd_enable(0)
+        self.busy-=1
+    self.poll(0) # handle stuck IRQ
 
-  @micropython.viper
-  def osd_enable(self, en:int):
-    pena = ptr8(addressof(self.spi_enable_osd))
-    pena[5] = en&1
-    self.cs.on()
-    self.spi.write(self.spi_enable_osd)
-    self.cs.off()
-
-  @micropython.viper
-  def osd_print(self, x:int, y:int, i:int, text):
-    p8msg=ptr8(addressof(self.spi_write_osd))
-    a=0xF000+(x&63)+((y&31)<<6)
-    p8msg[2]=i
-    p8msg[3]=a>>8
-    p8msg[4]=a
-    self.cs.on()
-    self.spi.write(self.spi_write_osd)
-    self.spi.write(text)
-    self.cs.off()
+  # load again when readback failed, see spicalib.checked
+  # BTN events wait until load is finished
+  def checked(self, load, *args):
+    self.busy+=1
+    try:
+      self.calib.checked(self.bus,self.rom_manager,load,*args)
+      self.spi_freq=self.calib.freq
+    finally:
+      self.busy-=1
+    if self.poll_pending[0]:
+      self.poll(0)
 
-  @micropython.viper
-  def osd_cls(self):
-    p8msg=ptr8(addressof(self.spi_write_osd))
-    p8msg[3]=0xF0
-    p8msg[4]=0
-    self.cs.on()
-    self.spi.write(self.spi_write_osd)
-    self.spi.read(1280,32)
-    self.cs.off()
+  # compressed bitstream, decompressed while programming
+  def load_gz(self, filename):
+    if filename[:filename.rfind(".")].endswith(".bit"):
+      self.load_bit(filename)
 
-  # y is actual line on the screen
-  def show_dir_line(self, y):
-    if y < 0 or y >= self.screen_y:
-      return
-    mark = 0
-    invert = 0
-    if y == self.fb_cursor - self.fb_topitem:
-      mark = 1
-      invert = 1
-    if y == self.fb_selected - self.fb_topitem:
-      mark = 2
-    i = y+self.fb_topitem
-    if i >= len(self.direntries):
-      self.osd_print(0,y,0,"%64s" % "")
-      return
-    if self.direntries[i][1]: # directory
-      self.osd_print(0,y,invert,"%c%-57s     D" % (self.mark[mark],self.direntries[i][0]))
-    else: # file
-      mantissa = self.direntries[i][2]
-      exponent = 0
-      while mantissa >= 1024:
-        mantissa >>= 10
-        exponent += 1
-      self.osd_print(0,y,invert,"%c%-57s %4d%c" % (self.mark[mark],self.direntries[i][0], mantissa, self.exp_names[exponent]))
+  def load_z80(self, filename):
+    self.enable[0]=0
+    self.osd_enable(0)
+    import ld_zxspectrum
+    s=ld_zxspectrum.ld_zxspectrum(self.bus,self.rom_manager)
+    self.checked(s.loadz80,filename)
+    del s
+    gc.collect()
 
-  def show_dir(self):
-    for i in range(self.screen_y):
-      self.show_dir_line(i)
+  def load_sna(self, filename):
+    self.enable[0]=0
+    self.osd_enable(0)
+    import ld_zxspectrum
+    s=ld_zxspectrum.ld_zxspectrum(self.bus,self.rom_manager)
+    self.checked(s.loadsna,filename)
+    del s
+    gc.collect()
 
-  def move_dir_cursor(self, step):
-    oldcursor = self.fb_cursor
-    if step == 1:
-      if self.fb_cursor < len(self.direntries)-1:
-        self.fb_cursor += 1
-    if step == -1:
-      if self.fb_cursor > 0:
-        self.fb_cursor -= 1
-    if oldcursor != self.fb_cursor:
-      screen_line = self.fb_cursor - self.fb_topitem
-      if screen_line >= 0 and screen_line < self.screen_y: # move cursor inside screen, no scroll
-        self.show_dir_line(oldcursor - self.fb_topitem) # no highlight
-        self.show_dir_line(screen_line) # highlight
-      else: # scroll
-        if screen_line < 0: # cursor going up
-          screen_line = 0
-          if self.fb_topitem > 0:
-            self.fb_topitem -= 1
-            self.show_dir()
-        else: # cursor going down
-          screen_line = self.screen_y-1
-          if self.fb_topitem+self.screen_y < len(self.direntries):
-            self.fb_topitem += 1
-            self.show_dir()
+  def load_tap(self, filename):
+    self.enable[0]=0
+    self.osd_enable(0)
+    import ld_zxspectrum
+    s=ld_zxspectrum.ld_zxspectrum(self.bus,self.rom_manager)
+    self.checked(s.loadtap,filename)
+    del s
+    gc.collect()
 
-  def read_dir(self):
-    self.direntries = []
-    ls = sorted(os.listdir(self.cwd))
-    for fname in ls:
-      stat = os.stat(self.fullpath(fname))
-      if stat[0] & 0o170000 == 0o040000:
-        self.direntries.append([fname,1,0]) # directory
-      else:
-        self.direntries.append([fname,0,stat[6]]) # file
+  def load_nes(self, filename):
+    import ld_zxspectrum
+    s=ld_zxspectrum.ld_zxspectrum(self.bus,self.rom_manager)
+    s.ctrl(1)
+    s.ctrl(0)
+    self.bus.invalidate()
+    self.rom_manager.forget()
+    self.checked(s.load_file,filename,0,0x101000)
+    del s
+    gc.collect()
+    self.enable[0]=0
+    self.osd_enable(0)
 
   # NOTE: this can be used for debugging
   #def osd(self, a):
@@ -299,6 +302,6 @@ class osdzx:
   #    self.cs.off()
 
 os.mount(SDCard(slot=3),"/sd")
-ecp5.prog("/sd/zxspectrum/bitstreams/zxspectrum12f.bit")
+ecp5.prog(ZX_BIT+"12f.bit")
 gc.collect()
 spectrum=osdzx()
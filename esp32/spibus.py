@@ -0,0 +1,249 @@
+# micropython ESP32
+# SPI protocol of FPGA spi_ram_btn and spi_osd slaves
+
+# LICENSE=BSD
+
+# write 00 <addr3> <addr2> <addr1> <addr0> <byte0> <byte1> ...
+# read  01 <addr3> <addr2> <addr1> <addr0> <dummy> <byte0> <byte1> ...
+# address increments after each data byte
+
+# addr3 selects:
+# 0x00 RAM, written only when CPU is halted
+#      0x000000-0x00FFFF as seen by CPU (paged by 0x7FFD)
+#      0x010000 + 0x4000*n: n=0 ROM 1 (48), 1 ROM 0 (128), 2-9 banks 0-7
+# 0xFF CPU control: bit0 reset, bit1 halt (loading),
+#      bit2 reset pulse and boot from stub
+# 0xFE OSD enable
+# 0xFD OSD text 64x20 at 0xF000, 0xFD01xxxx inverted
+# 0xFC OSD scroll, tile row shown on top line
+# 0xFB BTN state {0,btn[6:0]}
+# 0xFA 128K paging port 0x7FFD, kept over CPU reset
+# 0xF9 boot stub 256 bytes, seen by CPU at 0x0000 after control
+#      bit2 until first opcode fetch after JP at BOOT_JP
+# 0xF2 IRQ flag and BTN state {irq,btn[6:0]}, reading clears IRQ
+# 0xF1 IRQ flag {irq,0000000}, reading clears IRQ
+
+# backend is SPI (write/readinto/write_readinto)
+# with CS (on/off): machine.SPI and Pin, spimodel or spi_recorder
+
+ADDR_CTRL = 0xFF
+ADDR_OSD_ENABLE = 0xFE
+ADDR_OSD = 0xFD
+ADDR_OSD_SCROLL = 0xFC
+ADDR_BTN = 0xFB
+ADDR_PAGING = 0xFA
+ADDR_BOOT = 0xF9
+ADDR_IRQ_BTN = 0xF2
+ADDR_IRQ = 0xF1
+OSD_TEXT = 0xF000
+RAM_LINEAR = 0x10000 # ROM 1, ROM 0, banks 0-7
+ROM0_LINEAR = 0x14000 # 128K editor ROM
+BOOT_JP = 0x7D
+
+class spibus:
+  def __init__(self,spi,cs):
+    self.spi=spi
+    self.cs=cs
+    self.cmd_write=bytearray(5)
+    self.cmd_read=bytearray([1,0,0,0,0,0])
+    self.cmd_ctrl=bytearray([0,ADDR_CTRL,0xFF,0xFF,0xFF,0])
+    self.cmd_osd_enable=bytearray([0,ADDR_OSD_ENABLE,0,0,0,0])
+    self.cmd_osd_scroll=bytearray([0,ADDR_OSD_SCROLL,0,0,0,0])
+    self.cmd_paging=bytearray([0,ADDR_PAGING,0,0,0,0x30])
+    self.cmd_reg=bytearray([1,0,0,0,0,0,0])
+    self.reg=bytearray(7)
+    self.fillbuf=memoryview(bytearray(256)) # fill is clocked out of it
+    self.cs.off()
+
+  # write transaction: begin_write, write/fill..., end
+  def begin_write(self,addr):
+    c=self.cmd_write
+    c[1]=(addr>>24)&0xFF
+    c[2]=(addr>>16)&0xFF
+    c[3]=(addr>>8)&0xFF
+    c[4]=addr&0xFF
+    self.cs.on()
+    self.spi.write(c)
+
+  # write request to register addr3 at 24-bit addr,
+  # addr3<<24 would be a heap int in micropython
+  def begin_write_reg(self,addr3,addr):
+    c=self.cmd_write
+    c[1]=addr3
+    c[2]=(addr>>16)&0xFF
+    c[3]=(addr>>8)&0xFF
+    c[4]=addr&0xFF
+    self.cs.on()
+    self.spi.write(c)
+
+  # read transaction: begin_read, readinto..., end
+  def begin_read(self,addr):
+    c=self.cmd_read
+    c[1]=(addr>>24)&0xFF
+    c[2]=(addr>>16)&0xFF
+    c[3]=(addr>>8)&0xFF
+    c[4]=addr&0xFF
+    self.cs.on()
+    self.spi.write(c)
+
+  def end(self):
+    self.cs.off()
+
+  # forget known RAM content, see spidiff
+  def invalidate(self,addr=0,length=0x10000):
+    pass
+
+  def write(self,buf):
+    self.spi.write(buf)
+
+  # write byte b n times
+  def fill(self,n,b):
+    self.spi_fill(n,b)
+
+  # clock out byte b n times, spi.read(n,b) would allocate n bytes
+  def spi_fill(self,n,b):
+    buf=self.fillbuf
+    k=len(buf)
+    while n > k:
+      self.spi.readinto(buf,b)
+      n-=k
+    if n:
+      self.spi.readinto(buf if n==k else buf[0:n],b)
+
+  def readinto(self,buf):
+    self.spi.readinto(buf)
+
+  def poke(self,addr,data):
+    self.begin_write(addr)
+    self.spi.write(data)
+    self.cs.off()
+
+  def peekinto(self,addr,buf):
+    self.begin_read(addr)
+    self.spi.readinto(buf)
+    self.cs.off()
+    return buf
+
+  def peek(self,addr,length=1):
+    return self.peekinto(addr,bytearray(length))
+
+  # list of (addr,data), data are bytes or int for 1 byte.
+  # adjacent ranges are written in one transaction. ranges at most
+  # gap bytes apart are read, patched in given order and written back
+  # as one range, so RAM reads must be valid (CPU halted).
+  def poke_many(self,pokes,gap=32):
+    pokes=[(a,bytes([d]) if type(d) is int else d,i) for i,(a,d) in enumerate(pokes)]
+    pokes.sort(key=lambda p:p[0])
+    i=0
+    while i < len(pokes):
+      start=pokes[i][0]
+      end=start+len(pokes[i][1])
+      adjacent=1
+      j=i+1
+      while j < len(pokes) and pokes[j][0] <= end+gap:
+        a,d,k=pokes[j]
+        if a!=end:
+          adjacent=0
+        end=max(end,a+len(d))
+        j+=1
+      if adjacent:
+        self.begin_write(start)
+        for a,d,k in pokes[i:j]:
+          self.write(d)
+        self.end()
+      else:
+        buf=self.peek(start,end-start)
+        for a,d,k in sorted(pokes[i:j],key=lambda p:p[2]):
+          buf[a-start:a-start+len(d)]=d
+        self.poke(start,buf)
+      i=j
+
+  # list of (addr,length) -> list of bytearrays
+  # ranges at most gap bytes apart are read in one transaction
+  def peek_many(self,peeks,gap=32):
+    order=sorted(range(len(peeks)),key=lambda i:peeks[i][0])
+    result=[None]*len(peeks)
+    i=0
+    while i < len(order):
+      start=peeks[order[i]][0]
+      end=start+peeks[order[i]][1]
+      j=i+1
+      while j < len(order) and peeks[order[j]][0] <= end+gap:
+        a,n=peeks[order[j]]
+        end=max(end,a+n)
+        j+=1
+      buf=self.peek(start,end-start)
+      for k in order[i:j]:
+        a,n=peeks[k]
+        result[k]=buf[a-start:a-start+n]
+      i=j
+    return result
+
+  def ctrl(self,i):
+    self.cmd_ctrl[5]=i
+    self.cs.on()
+    self.spi.write(self.cmd_ctrl)
+    self.cs.off()
+
+  def cpu_halt(self):
+    self.ctrl(2)
+
+  def cpu_continue(self):
+    self.ctrl(0)
+
+  # reset and run boot stub
+  def cpu_boot(self):
+    self.ctrl(4)
+
+  def boot_write(self,stub):
+    self.begin_write_reg(ADDR_BOOT,0)
+    self.write(stub)
+    self.end()
+
+  # read 1-byte register, single transaction, no allocation
+  def read_reg(self,addr3):
+    self.cmd_reg[1]=addr3
+    self.cs.on()
+    self.spi.write_readinto(self.cmd_reg,self.reg)
+    self.cs.off()
+    return self.reg[6]
+
+  def irq(self):
+    return self.read_reg(ADDR_IRQ)
+
+  def btn(self):
+    return self.read_reg(ADDR_BTN)
+
+  # IRQ flag in bit 7 and BTN state read together
+  def irq_btn(self):
+    return self.read_reg(ADDR_IRQ_BTN)
+
+  def osd_enable(self,en):
+    self.cmd_osd_enable[5]=en&1
+    self.cs.on()
+    self.spi.write(self.cmd_osd_enable)
+    self.cs.off()
+
+  def osd_scroll(self,row):
+    self.cmd_osd_scroll[5]=row
+    self.cs.on()
+    self.spi.write(self.cmd_osd_scroll)
+    self.cs.off()
+
+  # 0x7FFD value: bits 2-0 bank at 0xC000, 3 screen in bank 7,
+  # 4 ROM 1, 5 locked. 0x30 is 48K machine
+  def paging(self,port):
+    self.cmd_paging[5]=port
+    self.cs.on()
+    self.spi.write(self.cmd_paging)
+    self.cs.off()
+
+  def osd_write(self,a,text,invert=0):
+    self.begin_write_reg(ADDR_OSD,((invert&1)<<16)|(OSD_TEXT+a))
+    self.spi.write(text)
+    self.cs.off()
+
+  def osd_fill(self,a,n,b,invert=0):
+    self.begin_write_reg(ADDR_OSD,((invert&1)<<16)|(OSD_TEXT+a))
+    self.spi_fill(n,b)
+    self.cs.off()
@@ -0,0 +1,146 @@
+# micropython ESP32
+# SPI clock calibration with write/readback through dpram
+
+# LICENSE=BSD
+
+# SPI clock is raised step by step, at each step test
+# patterns are read back: first a pattern written at the
+# base clock (read only), then patterns written at the
+# step clock. first failing step ends the search and a
+# step below the fastest passing one is used. result is
+# saved to flash and used at next start. test area is
+# saved before and restored after at the base clock.
+# CPU is halted during test, RAM tables of spidiff bus
+# should be invalidated after calibrate().
+
+import spibus
+
+# ESP32 HW SPI clocks are 80 MHz / n
+FREQS = (4000000, 8000000, 10000000, 13333333, 16000000, 20000000, 26666666, 40000000)
+
+class spicalib:
+  def __init__(self, spi, cs, filename="/spifreq", addr=0xFC00, length=1024, margin=1):
+    self.spi = spi
+    self.bus = spibus.spibus(spi, cs) # plain, spidiff would skip blocks
+    self.filename = filename
+    self.addr = addr
+    self.length = length
+    self.margin = margin # steps below fastest passing
+    self.base = FREQS[0]
+    self.freq = self.base
+    self.buf = bytearray(length)
+    self.pattern = bytearray(length)
+
+  # stored clock or calibrate if there is none
+  def init(self):
+    try:
+      f = open(self.filename)
+      self.freq = int(f.read())
+      f.close()
+      self.spi.init(baudrate=self.freq)
+      return self.freq
+    except (OSError, ValueError):
+      return self.calibrate()
+
+  def save(self):
+    try:
+      f = open(self.filename, "w")
+      f.write("%d\n" % self.freq)
+      f.close()
+    except OSError:
+      pass
+
+  # pattern k: 00, FF, 55/AA, walking one, pseudo random
+  def fill(self, k):
+    p = self.pattern
+    x = 0x1234+k
+    for i in range(len(p)):
+      if k == 0:
+        p[i] = 0
+      elif k == 1:
+        p[i] = 0xFF
+      elif k == 2:
+        p[i] = 0x55 if i&1 else 0xAA
+      elif k == 3:
+        p[i] = 1<<(i&7)
+      else:
+        x ^= (x<<7)&0xFFFF
+        x ^= x>>9
+        x ^= (x<<8)&0xFFFF
+        p[i] = x&0xFF
+
+  def readback(self):
+    self.bus.peekinto(self.addr, self.buf)
+    return self.buf == self.pattern
+
+  # write/readback patterns at freq, CPU halted
+  def test(self, freq, patterns=5, rounds=2):
+    self.fill(patterns-1)
+    self.spi.init(baudrate=self.base)
+    self.bus.poke(self.addr, self.pattern)
+    self.spi.init(baudrate=freq)
+    ok = 1
+    for r in range(rounds):
+      if not self.readback():
+        ok = 0
+    if ok:
+      for k in range(patterns):
+        self.fill(k)
+        for r in range(rounds):
+          self.bus.poke(self.addr, self.pattern)
+          if not self.readback():
+            ok = 0
+    self.spi.init(baudrate=self.base)
+    return ok
+
+  # fastest reliable clock up to maxfreq, saved if found
+  def calibrate(self, maxfreq=FREQS[-1]):
+    self.spi.init(baudrate=self.base)
+    self.bus.cpu_halt()
+    saved = self.bus.peek(self.addr, self.length)
+    passed = -1
+    for i in range(len(FREQS)):
+      if FREQS[i] > maxfreq or not self.test(FREQS[i]):
+        break
+      passed = i
+    self.bus.poke(self.addr, saved)
+    self.bus.cpu_continue()
+    if passed < 0:
+      print("SPI calibration failed at %d Hz" % self.base)
+      self.freq = self.base
+    else:
+      self.freq = FREQS[max(0, passed-self.margin)]
+      print("SPI %d Hz (fastest passing %d Hz)" % (self.freq, FREQS[passed]))
+      self.save()
+    self.spi.init(baudrate=self.freq)
+    return self.freq
+
+  # one step below current clock, saved
+  def step_down(self):
+    freq = self.base
+    for f in FREQS:
+      if f < self.freq:
+        freq = f
+    self.freq = freq
+    print("SPI %d Hz" % self.freq)
+    self.save()
+    self.spi.init(baudrate=self.freq)
+
+  # load(*args) is repeated when bus readback fails: first at
+  # the same clock, a single error may be transient, then one
+  # step lower. bus tables and rom_manager are reset before
+  # each retry. returns 1 if the last load passed
+  def checked(self, bus, rom_manager, load, *args):
+    for retry in range(3):
+      bus.errors = 0
+      load(*args)
+      if not bus.errors:
+        return 1
+      print("SPI readback error at %d Hz" % self.freq)
+      if retry == 1:
+        self.step_down()
+      bus.errors = 0
+      bus.invalidate()
+      if rom_manager:
+        rom_manager.forget()
+    return 0
@@ -0,0 +1,203 @@
+# micropython ESP32
+# SPI bus that skips RAM blocks already holding the same data
+
+# LICENSE=BSD
+
+# spibus with a table of CRC32 of what was last written to
+# each aligned block of the 64K dpram. RAM writes are staged
+# per block, a full block with unchanged CRC is not sent.
+# partial block writes are sent and forget the block.
+# when CPU runs (control register without halt and reset)
+# RAM blocks are forgotten, ROM 0x0000-0x3FFF is not
+# writable by CPU and is kept. after bitstream change
+# call invalidate().
+# table is for RAM as seen by CPU: paging port change forgets
+# the areas it remaps, linear (beyond 64K) writes forget all.
+# before CPU leaves halt, blocks written since the last check
+# are read back and compared with their CRC: samples of them
+# spread over the load, all if samples=0. errors counts failed
+# checks.
+
+from binascii import crc32
+import spibus
+
+class spidiff(spibus.spibus):
+  def __init__(self,spi,cs,blocksize=1024,samples=8):
+    spibus.spibus.__init__(self,spi,cs)
+    self.blocksize=blocksize
+    self.crc=[None]*(0x10000//blocksize) # None: unknown content
+    self.stage=bytearray(blocksize)
+    self.stage_mv=memoryview(self.stage)
+    self.addr=-1 # next RAM address of write request, -1 if not RAM
+    self.o=0 # staged bytes, block starts at addr-o
+    self.sent=-1 # next address of open SPI write, -1 if closed
+    self.samples=samples # blocks read back by check, 0 all
+    self.pending=bytearray(0x10000//blocksize) # written, not checked
+    self.npending=0
+    self.errors=0 # failed readback checks
+    self.port=-1 # paging port, -1 unknown
+    self.reset_stats()
+
+  def reset_stats(self):
+    self.bytes_sent=0
+    self.bytes_skipped=0
+
+  def invalidate(self,addr=0,length=0x10000):
+    for i in range(addr//self.blocksize,(addr+length+self.blocksize-1)//self.blocksize):
+      self.crc[i]=None
+
+  def begin_write(self,addr):
+    if addr>>16: # registers and beyond 64K are not tracked
+      self.addr=-1
+      if addr>>24==0: # linear RAM, aliases paged areas
+        self.invalidate()
+      spibus.spibus.begin_write(self,addr)
+    else:
+      self.addr=addr
+      self.o=0
+      self.sent=-1
+
+  def end(self):
+    if self.addr>=0:
+      if self.o: # partial block at the end
+        self.send(self.stage_mv[0:self.o],self.addr-self.o)
+        self.o=0
+      self.addr=-1
+      if self.sent>=0:
+        self.sent=-1
+        self.cs.off()
+    else:
+      self.cs.off()
+
+  # data to SPI at addr, reuses open write when contiguous
+  def send(self,data,addr,n=0,b=0):
+    if self.sent!=addr:
+      if self.sent>=0:
+        self.cs.off()
+      spibus.spibus.begin_write(self,addr)
+    if data is None:
+      self.spi_fill(n,b)
+    else:
+      n=len(data)
+      self.spi.write(data)
+    self.sent=addr+n
+    self.bytes_sent+=n
+    if addr+n > 0x10000: # may wrap around to 0
+      self.invalidate()
+    else:
+      self.invalidate(addr,n)
+
+  # staged block is complete
+  def commit(self):
+    a=self.addr-self.blocksize
+    i=a//self.blocksize
+    c=crc32(self.stage)
+    if self.crc[i]==c:
+      self.bytes_skipped+=self.blocksize
+    else:
+      self.send(self.stage,a)
+      self.written(i,c)
+    self.o=0
+
+  # block i holds data with CRC c, checked before CPU runs.
+  # also for blocks written past this bus, see ld_replay
+  def written(self,i,c):
+    self.crc[i]=c
+    if not self.pending[i]:
+      self.pending[i]=1
+      self.npending+=1
+
+  # data or n times byte b. data is memoryview, sliced
+  # only when it is not sent or staged whole
+  def put(self,data,n=0,b=0):
+    if data is not None:
+      n=len(data)
+    i=0
+    while i < n:
+      a=self.addr
+      bs=self.blocksize
+      if a >= 0x10000: # beyond 64K
+        k=n-i
+      elif self.o==0 and a%bs: # not aligned, send up to next block
+        k=min(n-i,bs-a%bs)
+      else:
+        k=min(n-i,bs-self.o)
+        if data is None:
+          for j in range(self.o,self.o+k):
+            self.stage[j]=b
+        else:
+          self.stage[self.o:self.o+k]=data if k==n else data[i:i+k]
+        self.o+=k
+        self.addr+=k
+        i+=k
+        if self.o==bs:
+          self.commit()
+        continue
+      if data is None:
+        self.send(None,a,k,b)
+      else:
+        self.send(data if k==n else data[i:i+k],a)
+      self.addr+=k
+      i+=k
+
+  def write(self,buf):
+    if self.addr>=0:
+      self.put(buf if type(buf) is memoryview else memoryview(buf))
+    else:
+      self.spi.write(buf)
+
+  def fill(self,n,b):
+    if self.addr>=0:
+      self.put(None,n,b)
+    else:
+      self.spi_fill(n,b)
+
+  def poke(self,addr,data):
+    self.begin_write(addr)
+    self.write(data)
+    self.end()
+
+  # read back blocks sent since last check, every step-th of
+  # them counted back from the last one, so at most samples.
+  # stage is free between writes. returns 0 if one failed
+  def check(self):
+    n=self.npending
+    self.npending=0
+    if not n:
+      return 1
+    step=(n+self.samples-1)//self.samples if self.samples else 1
+    ok=1
+    p=0
+    for i in range(len(self.pending)):
+      if not self.pending[i]:
+        continue
+      self.pending[i]=0
+      if (n-1-p)%step==0 and self.crc[i] is not None:
+        self.peekinto(i*self.blocksize,self.stage)
+        if crc32(self.stage)!=self.crc[i]:
+          self.crc[i]=None
+          ok=0
+      p+=1
+    if not ok:
+      self.errors+=1
+    return ok
+
+  def paging(self,port):
+    d=port^self.port if self.port>=0 else 0xFF
+    if d&0x10: # ROM
+      self.invalidate(0,0x4000)
+    if d&7: # bank at 0xC000
+      self.invalidate(0xC000,0x4000)
+    self.port=port
+    spibus.spibus.paging(self,port)
+
+  # written blocks are read back while CPU is still halted,
+  # running CPU may change RAM
+  def ctrl(self,i):
+    if not i&2 and self.npending:
+      self.check()
+    if not i&3:
+      self.invalidate(0x4000,0xC000)
+      if not self.port&0x20: # CPU may change unlocked paging
+        self.port=-1
+    spibus.spibus.ctrl(self,i)
@@ -0,0 +1,257 @@
+# ZX spectrum FPGA SPI slave model for CPython (and micropython)
+
+# LICENSE=BSD
+
+# behaves like src/osd/spirw_slave_v.v + spi_ram_btn.v + spi_osd.v
+# with the memory map of src/spectrum.v, to run loaders and
+# OSD on a PC without the board:
+#   m=spimodel(rom=open("roms/opense.rom","rb").read())
+#   bus=spibus.spibus(m,m)
+# it is both the SPI (write/read/readinto/write_readinto)
+# and the CS pin (on/off). counters measure SPI traffic.
+
+# RAM written by SPI only while CPU is halted (R_cpu_control[1]),
+# other writes are dropped. reads while CPU runs return 0xFF
+# because dpram port A address then comes from the CPU.
+
+# dpram is 16K slots: 0 ROM 1, 1-3 banks 5,2,0 (the 48K map),
+# 4-8 banks 1,3,4,6,7, 9 ROM 0. mem128=0 is 64K dpram of
+# C_mem128=0 bitstream, paging port is ignored.
+
+BANK_SLOT = (3,4,2,5,6,1,7,8) # slot of 128K bank
+
+class spimodel:
+  def __init__(self,rom=None,mem128=1):
+    self.mem128=mem128
+    self.ram=bytearray(0x28000 if mem128 else 0x10000) # dpram
+    if rom:
+      self.ram[0:len(rom)]=rom
+    self.port=0x30 # R_port_7ffd, 48K locked
+    self.boot_ram=bytearray(256) # R_boot_ram, boot stub
+    self.ctrl=0 # R_cpu_control, bit0 reset, bit1 halt, bit2 boot
+    self.ctrl_log=[] # every value written to control register
+    self.osd_en=0 # c_init_on=0
+    self.osd_text=bytearray(64*20) # tile_map[7:0]
+    self.osd_invert=bytearray(64*20) # tile_map[8]
+    self.osd_scroll=0 # tile row shown on top line
+    self.btn_state=0 # R_btn
+    self.btn_pending=0 # btn lines
+    self.irq=0 # R_btn_irq
+    self.irq_handler=None # called when IRQ rises, like Pin.irq handler
+    self.irq_raised=0 # IRQ rose during transaction, handler called after CS off
+    self.baudrate=4000000
+    self.max_baudrate=0 # if set, RAM reads above it return flipped bits
+    self.selected=0
+    self.count=0 # bytes clocked in this transaction
+    self.cmd=0
+    self.addr=0
+    self.reset_stats()
+
+  def reset_stats(self):
+    self.transactions=0 # CS cycles
+    self.toggles=0 # CS edges
+    self.calls=0 # SPI method calls
+    self.bytes=0 # bytes clocked
+    self.dropped_writes=0 # RAM writes while CPU runs
+    self.unhalted_reads=0 # RAM reads while CPU runs
+
+  # CS pin
+  def on(self):
+    if not self.selected:
+      self.selected=1
+      self.transactions+=1
+      self.toggles+=1
+      self.count=0
+
+  def off(self):
+    if self.selected:
+      self.selected=0
+      self.toggles+=1
+      if self.irq_raised:
+        self.irq_raised=0
+        if self.irq_handler:
+          self.irq_handler(self)
+
+  def value(self,v=None):
+    if v is None:
+      return self.selected
+    if v:
+      self.on()
+    else:
+      self.off()
+
+  # buttons changed, IRQ rises if not pending
+  def press(self,btn):
+    self.btn_pending=btn&0x7F
+    self.update_irq()
+
+  def update_irq(self):
+    if self.irq==0 and self.btn_pending!=self.btn_state:
+      self.btn_state=self.btn_pending
+      self.irq=1
+      if self.selected:
+        self.irq_raised=1
+      elif self.irq_handler:
+        self.irq_handler(self)
+
+  # SPI
+  def init(self,baudrate=None,**kw):
+    if baudrate:
+      self.baudrate=baudrate
+
+  def write(self,buf):
+    self.calls+=1
+    self.transfer(buf,None,None)
+
+  def read(self,n,write=0):
+    self.calls+=1
+    r=bytearray(n)
+    self.transfer(None,r,write,n)
+    return bytes(r)
+
+  def readinto(self,buf,write=0):
+    self.calls+=1
+    self.transfer(None,buf,write)
+
+  def write_readinto(self,wbuf,rbuf):
+    self.calls+=1
+    self.transfer(wbuf,rbuf,None)
+
+  # clock n bytes: from wbuf or constant wbyte, result to rbuf
+  def transfer(self,wbuf,rbuf,wbyte,n=0):
+    if isinstance(wbuf,str):
+      wbuf=wbuf.encode()
+    if wbuf is not None:
+      n=len(wbuf)
+    elif rbuf is not None and not n:
+      n=len(rbuf)
+    self.bytes+=n
+    if not self.selected:
+      return
+    i=0
+    while i < n:
+      if self.count < 5: # command and address
+        b=wbuf[i] if wbuf is not None else wbyte
+        if self.count==0:
+          self.cmd=b
+          self.addr=0
+        else:
+          self.addr=(self.addr<<8)|b
+        self.count+=1
+        if rbuf is not None:
+          rbuf[i]=0
+        i+=1
+        continue
+      if self.cmd&1 and self.count==5: # read dummy byte
+        self.count+=1
+        if rbuf is not None:
+          rbuf[i]=0
+        i+=1
+        continue
+      # data bytes, bulk RAM copy up to the end of region
+      a3=self.addr>>24
+      k=n-i
+      if a3==0:
+        k=min(k,0x4000-(self.addr&0x3FFF)) # up to end of slot
+        a=self.phys(self.addr)
+        loading=self.ctrl&2
+        if self.cmd&1:
+          if rbuf is not None:
+            if loading and a>=0:
+              rbuf[i:i+k]=self.ram[a:a+k]
+              if self.max_baudrate and self.baudrate>self.max_baudrate:
+                for j in range(i,i+k,7):
+                  rbuf[j]^=1
+            else:
+              for j in range(i,i+k):
+                rbuf[j]=0xFF
+          if not loading:
+            self.unhalted_reads+=k
+        else:
+          if loading:
+            if a < 0: # not in dpram
+              pass
+            elif wbuf is not None:
+              self.ram[a:a+k]=wbuf[i:i+k]
+            else:
+              for j in range(a,a+k):
+                self.ram[j]=wbyte
+          else:
+            self.dropped_writes+=k
+      else:
+        k=1
+        if self.cmd&1:
+          r=self.read_reg(a3)
+          if rbuf is not None:
+            rbuf[i]=r
+        else:
+          self.write_reg(a3,wbuf[i] if wbuf is not None else wbyte)
+      self.addr=(self.addr+k)&0xFFFFFFFF
+      self.count+=k
+      i+=k
+
+  # SPI RAM address -> dpram address, -1 if not there
+  def phys(self,addr):
+    addr&=0xFFFFFF
+    port=self.port if self.mem128 else 0x30
+    if addr < 0x10000:
+      n=addr>>14
+      if n==0:
+        slot=0 if port&0x10 else 9
+      elif n==3:
+        slot=BANK_SLOT[port&7]
+      else:
+        slot=n
+    else:
+      n=(addr>>14)-4
+      if not self.mem128 or n > 9:
+        return -1
+      slot=(0,9)[n] if n < 2 else BANK_SLOT[n-2]
+    return (slot<<14)|(addr&0x3FFF)
+
+  # 64K as seen by CPU, for tests
+  def cpu_view(self):
+    return b"".join(self.ram[self.phys(a):self.phys(a)+0x4000] for a in range(0,0x10000,0x4000))
+
+  # RAM bank 0-7 or ROM 0/1 ("rom0","rom1") content, for tests
+  def bank(self,n):
+    slot={"rom1":0,"rom0":9}[n] if type(n) is str else BANK_SLOT[n]
+    return bytes(self.ram[slot<<14:(slot+1)<<14])
+
+  def read_reg(self,a3):
+    if a3==0xF1:
+      r=self.irq<<7
+      self.irq=0 # cleared at end of read
+      self.update_irq()
+      return r
+    if a3==0xFB:
+      return self.btn_state
+    if a3==0xF2:
+      r=(self.irq<<7)|self.btn_state
+      self.irq=0
+      self.update_irq()
+      return r
+    return 0xFF
+
+  def write_reg(self,a3,b):
+    if a3==0xFF:
+      self.ctrl=b
+      self.ctrl_log.append(b)
+    elif a3==0xFE:
+      self.osd_en=b&1
+    elif a3==0xFC:
+      self.osd_scroll=min(b,19) # clamped to c_chars_y-1
+    elif a3==0xFA:
+      self.port=b
+    elif a3==0xF9:
+      self.boot_ram[self.addr&0xFF]=b
+    elif a3==0xFD:
+      a=self.addr&0x7FF # tile_map address bits
+      if a < len(self.osd_text):
+        self.osd_text[a]=b
+        self.osd_invert[a]=(self.addr>>16)&1
+
+  # OSD text line as displayed, for tests
+  def osd_line(self,y):
+    y=(y+self.osd_scroll)%20
+    return str(bytes(self.osd_text[y*64:y*64+64]),"ascii")
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+# dirindex against brute force: entries sorted by name bytes,
+# flags and sizes of the listing, find() is the first name not
+# less than the prefix. checked for an index built from the
+# listing and for one read from its file in small windows.
+
+# LICENSE=BSD
+
+# usage:
+#   python3 -m pytest esp32/tests
+#   python3 esp32/tests/test_dirindex.py
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.normpath(os.path.join(HERE, "..", ".."))
+sys.path[0:0] = [os.path.join(ROOT, "esp32"), os.path.join(ROOT, "esp32", "bench")]
+
+import dirindex
+import zxbench
+
+PREFIXES = ["", "a", "ab", "g", "game", "game0", "game05", "game999", "s", "sub", "subdir", "z", "zzz", "A", "_", "~"]
+
+
+def directory(d, rnd):
+  files = {}
+  for i in range(300):
+    name = rnd.choice(("game%03d" % rnd.randrange(1000), "a" * rnd.randint(1, 40), "Zx%d" % i, "s%d" % i, "_%d" % i))
+    name += rnd.choice((".z80", ".sna", ".tap", ""))
+    files[name] = rnd.randrange(70000)
+  for name, size in files.items():
+    with open(os.path.join(d, name), "wb") as f:
+      f.write(bytes(size))
+  dirs = ["subdir", "abc", "zz"]
+  for name in dirs:
+    os.mkdir(os.path.join(d, name))
+  os.mkdir(os.path.join(d, ".zxcache")) # hidden
+  return files, dirs
+
+
+def check(di, files, dirs, rnd):
+  names = sorted(list(files) + dirs, key=lambda n: n.encode())
+  assert len(di) == len(names)
+  for k in range(3): # forward, backward and random order cross windows
+    order = list(range(len(names)))
+    if k == 1:
+      order.reverse()
+    elif k == 2:
+      rnd.shuffle(order)
+    for i in order:
+      name = names[i]
+      assert di.name(i) == name, (i, di.name(i), name)
+      assert bytes(di.name_mv(i)) == name.encode()
+      assert bool(di.is_dir(i)) == (name in dirs), name
+      assert di.size(i) == files.get(name, 0), name
+      assert di.letter(i) == name.encode()[0]
+  prefixes = PREFIXES + [n[0:rnd.randint(1, len(n))] for n in rnd.sample(names, 50)]
+  for p in prefixes:
+    p = p.encode()
+    want = next((i for i, n in enumerate(names) if n.encode() >= p), len(names))
+    assert di.find(p) == want, (p, di.find(p), want)
+
+
+def test_dirindex():
+  dirindex.os = zxbench.sdos(zxbench.sdcard()) # os.ilistdir on a PC
+  d = tempfile.mkdtemp()
+  try:
+    rnd = random.Random(1)
+    files, dirs = directory(d, rnd)
+    di = dirindex.dirindex(d) # from listing, writes index
+    assert di.f is None
+    check(di, files, dirs, rnd)
+    di = dirindex.dirindex(d, 8) # from index file
+    assert di.f is not None
+    check(di, files, dirs, rnd)
+    di.close()
+    files["new.z80"] = 5 # listing changed, index rebuilt
+    with open(os.path.join(d, "new.z80"), "wb") as f:
+      f.write(bytes(5))
+    di = dirindex.dirindex(d, 8)
+    assert di.f is None
+    check(di, files, dirs, rnd)
+  finally:
+    dirindex.os = os
+    shutil.rmtree(d)
+
+
+if __name__ == "__main__":
+  test_dirindex()
+  print("test_dirindex ok")
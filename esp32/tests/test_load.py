@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+# snapshot loads against spimodel: RAM seen by the CPU after
+# .z80 v1/v2/v3 and .sna loads, 48K and 128K, is the RAM of the
+# file as read by zxconvert. replay files and spidiff must load
+# the same RAM, savez80 must save what it loads back.
+
+# LICENSE=BSD
+
+# usage:
+#   python3 -m pytest esp32/tests
+#   python3 esp32/tests/test_load.py
+
+import os
+import shutil
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.normpath(os.path.join(HERE, "..", ".."))
+sys.path[0:0] = [os.path.join(ROOT, "esp32"), os.path.join(ROOT, "esp32", "bench"), os.path.join(ROOT, "esp32", "converter")]
+
+import spimodel
+import spibus
+import spidiff
+import ld_zxspectrum
+import ld_replay
+import zxbench
+import zxconvert
+
+ROM = open(os.path.join(ROOT, "roms", "opense.rom"), "rb").read()
+PAGES48 = ((8, 0x4000), (4, 0x8000), (5, 0xC000))
+
+
+# RAM pages of test snapshots: noise, runs and single and repeated ED
+def ram(seed, size=0xC000):
+  x = seed | 1
+  out = bytearray(size)
+  for i in range(size):
+    x = (x * 1103515245 + 12345) & 0x7FFFFFFF
+    out[i] = (x >> 16) & 0xFF if (i >> 9) & 3 else 0xED if (x >> 20) & 1 else seed & 0xFF
+  return out
+
+
+def snapshots():
+  ram48 = ram(1)
+  s48 = zxconvert.read_z80(zxbench.make_z80(ram48, 3))
+  pages = {bank + 3: bytes(ram(bank + 2, 0x4000)) for bank in range(8)}
+  s128 = zxconvert.snapshot(zxbench.z80_header1(0), 0x8000, pages, 1, 0x13)
+  return {
+    "v1.z80": zxbench.make_z80(ram48, 1),
+    "v1_raw.z80": zxbench.make_z80(ram48, 1, False),
+    "v2.z80": zxbench.make_z80(ram48, 2),
+    "v3.z80": zxbench.make_z80(ram48, 3),
+    "v3_raw.z80": zxbench.make_z80(ram48, 3, False),
+    "v3_128.z80": zxconvert.write_z80(s128, 3),
+    "v2_128.z80": zxconvert.write_z80(s128, 2),
+    "48.sna": zxconvert.write_sna(s48),
+    "128.sna": zxconvert.write_sna(s128),
+  }
+
+
+# RAM a loaded snapshot must leave
+def expected(name, data):
+  s = zxconvert.read_sna(data) if name.endswith(".sna") else zxconvert.read_z80(data)
+  if not s.mem128:
+    return s, {"cpu": s.ram48()}
+  return s, {bank: bytes(s.pages[bank + 3]) for bank in range(8)}
+
+
+def loaded(m, s):
+  if not s.mem128:
+    return {"cpu": m.cpu_view()[0x4000:]}
+  return {bank: m.bank(bank) for bank in range(8)}
+
+
+def check(m, name, s, want):
+  got = loaded(m, s)
+  for k in want:
+    if got[k] != want[k]:
+      i = next(i for i in range(len(want[k])) if got[k][i] != want[k][i])
+      raise AssertionError("%s %s differs at 0x%04X" % (name, k, i))
+  assert m.bank("rom1") == ROM, name
+  assert m.ctrl_log[-1] == 4, (name, m.ctrl_log) # started from boot stub
+  assert m.boot_ram[0] != 0, name
+
+
+def quiet(f, *args):
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull, "w")
+  try:
+    return f(*args)
+  finally:
+    sys.stdout.close()
+    sys.stdout = stdout
+
+
+def load(bus, path, cache=0):
+  ld = ld_zxspectrum.ld_zxspectrum(bus)
+  if cache:
+    ld.replay_cache = ld_replay.ld_replay(ld, os.path.join(os.path.dirname(path), ".zxcache"))
+  if path.endswith(".sna"):
+    quiet(ld.loadsna, path)
+  else:
+    quiet(ld.loadz80, path, cache)
+  return ld
+
+
+def each_snapshot(test):
+  d = tempfile.mkdtemp()
+  try:
+    for name, data in sorted(snapshots().items()):
+      path = os.path.join(d, name)
+      with open(path, "wb") as f:
+        f.write(data)
+      test(name, path, data)
+  finally:
+    shutil.rmtree(d)
+
+
+def test_load():
+  def test(name, path, data):
+    s, want = expected(name, data)
+    for cls in (spibus.spibus, spidiff.spidiff):
+      m = spimodel.spimodel(ROM)
+      load(cls(m, m), path)
+      check(m, name + " " + cls.__name__, s, want)
+  each_snapshot(test)
+
+
+# RAM of an earlier snapshot must not show through
+def test_load_over():
+  def test(name, path, data):
+    s, want = expected(name, data)
+    m = spimodel.spimodel(ROM)
+    m.ram[0x4000:] = bytes(len(m.ram) - 0x4000)
+    for i in range(0x4000, len(m.ram), 7):
+      m.ram[i] = 0x5A
+    bus = spidiff.spidiff(m, m)
+    load(bus, path)
+    check(m, name, s, want)
+    load(bus, path) # same data again, spidiff skips unchanged blocks
+    check(m, name + " again", s, want)
+  each_snapshot(test)
+
+
+def test_replay():
+  def test(name, path, data):
+    if not name.endswith(".z80"):
+      return
+    s, want = expected(name, data)
+    for rep in range(3): # direct and record, replay, replay
+      m = spimodel.spimodel(ROM)
+      ld = load(spibus.spibus(m, m), path, 1)
+      check(m, "%s replay %d" % (name, rep), s, want)
+    with open(ld.replay_cache.cachefile(path), "rb") as f:
+      replay = f.read()
+    # kept only when smaller than snapshot, else loaded directly
+    assert len(replay) < len(data) or (replay[14] == ld_replay.DIRECT and len(replay) == 16), name
+  each_snapshot(test)
+
+
+# v2/v3 page decoding to more than 16K doesn't write into the
+# next slot: page 8 (0x4000) is last, after 4 (0x8000)
+def test_page_overflow():
+  ram48 = ram(3)
+  out = bytearray(zxbench.make_z80(ram48, 3))
+  h = 30 + 2 + 54
+  del out[h:]
+  for page, addr in ((4, 0x8000), (5, 0xC000), (8, 0x4000)):
+    c = zxbench.rle(ram48[addr - 0x4000:addr])
+    if page == 8: # corrupt: run, single ED and literal data past 16K
+      c += b"\xED\xED\x40\x77\xED\x01" + b"\x55" * 1500
+    out += bytes((len(c) & 0xFF, len(c) >> 8, page)) + c
+  d = tempfile.mkdtemp()
+  try:
+    path = os.path.join(d, "overflow.z80")
+    with open(path, "wb") as f:
+      f.write(out)
+    for cls in (spibus.spibus, spidiff.spidiff):
+      m = spimodel.spimodel(ROM)
+      load(cls(m, m), path)
+      assert m.cpu_view()[0x4000:] == ram48, cls.__name__
+  finally:
+    shutil.rmtree(d)
+
+
+# spidiff reads back what was written before CPU leaves halt,
+# also after reset (ctrl 3, 1, 0) and blocks of a replay compile
+def test_readback():
+  m = spimodel.spimodel(ROM)
+  m.max_baudrate = 1000000 # reads flip bits
+  bus = spidiff.spidiff(m, m)
+  bus.ctrl(3)
+  bus.poke(0x8000, bytes(range(256)) * 4)
+  bus.ctrl(1)
+  bus.ctrl(0)
+  assert bus.errors == 1
+  def test(name, path, data):
+    s, want = expected(name, data)
+    if s.mem128 or not name.endswith(".z80"):
+      return
+    m = spimodel.spimodel(ROM)
+    m.max_baudrate = 1000000
+    bus = spidiff.spidiff(m, m)
+    load(bus, path, 1)
+    assert bus.errors == 1, name
+  each_snapshot(test)
+
+
+# 128K snapshots on a 48K core (C_mem128=0) are not loaded, not
+# even replayed from a file compiled on a 128K core: RAM is left
+# as it was and CPU runs on
+def test_core48():
+  def test(name, path, data):
+    s, want = expected(name, data)
+    if not s.mem128:
+      return
+    for cache in (0, 1): # direct, replay of file compiled on 128K core
+      if cache:
+        m = spimodel.spimodel(ROM)
+        load(spibus.spibus(m, m), path, 1)
+      m = spimodel.spimodel(ROM, 0)
+      ld = load(spibus.spibus(m, m), path, cache)
+      assert ld.mem128 == 0, name
+      assert m.cpu_view()[0x4000:] == bytes(0xC000), name
+      assert m.ctrl_log[-1] == 0, (name, m.ctrl_log)
+  each_snapshot(test)
+
+
+def test_savez80():
+  def test(name, path, data):
+    s, want = expected(name, data)
+    if s.mem128:
+      return
+    m = spimodel.spimodel(ROM)
+    ld = load(spibus.spibus(m, m), path)
+    saved = path + ".saved.z80"
+    quiet(ld.savez80, saved, s.pc, 0xFF00)
+    with open(saved, "rb") as f:
+      s2 = zxconvert.read_z80(f.read())
+    assert s2.ram48() == want["cpu"], name
+    assert s2.pc == s.pc, name
+    m = spimodel.spimodel(ROM)
+    load(spibus.spibus(m, m), saved)
+    check(m, name + " saved", s, want)
+  each_snapshot(test)
+
+
+if __name__ == "__main__":
+  for name, f in sorted(globals().items()):
+    if name.startswith("test_"):
+      f()
+      print(name, "ok")
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+# OSD file browser against spimodel: after every cursor, page,
+# letter and search move, screen shown by the FPGA (text,
+# invert and hardware scroll) is what a full redraw would
+# show, and the shadow copy is what the FPGA holds. when the
+# scroll register moves, the rows it brings in are already sent.
+
+# LICENSE=BSD
+
+# usage:
+#   python3 -m pytest esp32/tests
+#   python3 esp32/tests/test_osd.py
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.normpath(os.path.join(HERE, "..", ".."))
+sys.path[0:0] = [os.path.join(ROOT, "esp32"), os.path.join(ROOT, "esp32", "bench")]
+
+import spimodel
+import spibus
+import dirindex
+import osdfb
+import zxbench
+
+
+# screen as shown right after each scroll register write
+class scrollmodel(spimodel.spimodel):
+  def write_reg(self, a3, b):
+    spimodel.spimodel.write_reg(self, a3, b)
+    if a3 == 0xFC:
+      self.scrolled = [self.osd_line(y) for y in range(20)]
+
+
+class browser:
+  def __init__(self, rnd, files=57, hw_scroll=1):
+    self.d = tempfile.mkdtemp()
+    for i in range(files): # names longer than a line too
+      with open(os.path.join(self.d, "file%03d_%s.z80" % (i, "x" * rnd.randint(0, 70))), "wb") as f:
+        f.write(bytes(i * 100))
+    for name in ("subdir", "games", "zx"):
+      os.mkdir(os.path.join(self.d, name))
+    dirindex.os = osdfb.os = zxbench.sdos(zxbench.sdcard()) # os.ilistdir on a PC
+    self.m = scrollmodel()
+    self.fb = osdfb.osdfb(spibus.spibus(self.m, self.m), self.d, hw_scroll)
+    self.m.scrolled = None # reset to 0 before first draw
+    self.names = [self.fb.direntries.name(i) for i in range(len(self.fb.direntries))]
+
+  def close(self):
+    self.fb.direntries.close()
+    dirindex.os = osdfb.os = os
+    shutil.rmtree(self.d)
+
+  # every line as a full redraw renders it
+  def check(self):
+    fb = self.fb
+    m = self.m
+    assert m.osd_scroll == fb.scroll
+    if getattr(m, "scrolled", None):
+      assert m.scrolled == [m.osd_line(y) for y in range(fb.screen_y)], "stale rows shown"
+      m.scrolled = None
+    for y in range(fb.screen_y):
+      invert = fb.render_dir_line(y, fb.line)
+      assert m.osd_line(y) == str(bytes(fb.line), "ascii"), (y, m.osd_line(y), bytes(fb.line))
+      p = ((y+fb.scroll) % fb.screen_y) * fb.screen_x
+      assert m.osd_invert[p:p+fb.screen_x] == bytes([1 if invert else 0]) * fb.screen_x, y
+    assert fb.fb_topitem <= fb.fb_cursor < fb.fb_topitem+fb.screen_y
+    assert bytes(fb.shadow) == bytes(m.osd_text[0:len(fb.shadow)])
+    assert bytes(fb.shadow_invert) == bytes(m.osd_invert[0:len(fb.shadow_invert)])
+
+
+def run(test, hw_scroll=1):
+  rnd = random.Random(1)
+  b = browser(rnd, hw_scroll=hw_scroll)
+  try:
+    b.fb.show_dir()
+    b.check()
+    test(b, rnd)
+  finally:
+    b.close()
+
+
+def test_cursor():
+  def test(b, rnd):
+    fb = b.fb
+    for k in range(2000):
+      fb.move_dir_cursor(rnd.choice((1, -1, 1)))
+      b.check()
+      if k % 300 == 0: # selection mark
+        fb.fb_selected = fb.fb_cursor
+        fb.show_dir()
+        b.check()
+    for k in range(1000):
+      step = rnd.choice((1, -1, 5, -5, 19, -19, 20, -20, 37, -300, 300, 1000, -1000))
+      want = max(0, min(fb.fb_cursor+step, len(b.names)-1))
+      fb.move_dir_cursor(step)
+      b.check()
+      assert fb.fb_cursor == want
+  run(test)
+
+
+def test_page_letter_jump():
+  def test(b, rnd):
+    fb = b.fb
+    for k in range(500):
+      r = rnd.random()
+      if r < 0.3:
+        fb.move_dir_page(rnd.choice((1, -1)))
+      elif r < 0.6:
+        fb.move_dir_letter(rnd.choice((1, -1)))
+      else:
+        fb.jump(rnd.randrange(len(b.names)))
+      b.check()
+    # letter steps go to first names of the next or previous letter
+    firsts = [i for i, n in enumerate(b.names) if i == 0 or n[0] != b.names[i-1][0]]
+    fb.jump(0)
+    for i in firsts[1:]:
+      fb.move_dir_letter(1)
+      b.check()
+      assert fb.fb_cursor == i
+    for i in reversed(firsts[:-1]):
+      fb.move_dir_letter(-1)
+      b.check()
+      assert fb.fb_cursor == i
+    for k in range(300): # n steps at once are n single steps
+      step = rnd.choice((1, -1, 2, -2, 3, -3))
+      start = fb.fb_cursor
+      for i in range(abs(step)):
+        fb.move_dir_letter(1 if step > 0 else -1)
+      want = fb.fb_cursor
+      fb.jump(start)
+      fb.move_dir_letter(step)
+      b.check()
+      assert fb.fb_cursor == want
+  run(test)
+
+
+def test_search():
+  def test(b, rnd):
+    fb = b.fb
+    fb.jump(0)
+    for ch in b"file05":
+      fb.type_key(ch)
+      b.check()
+    assert b.names[fb.fb_cursor].startswith("file05"), b.names[fb.fb_cursor]
+    fb.type_key(ord("Q")) # no match, dropped
+    assert fb.search_len == 6
+    fb.type_key(8)
+    fb.type_key(8)
+    b.check()
+    assert b.names[fb.fb_cursor].startswith("file0")
+    fb.type_key(27)
+    for ch in b"zx":
+      fb.type_key(ch)
+      b.check()
+    assert b.names[fb.fb_cursor] == "zx"
+  run(test)
+
+
+# core without OSD scroll register: never written, lines redrawn
+def test_no_hw_scroll():
+  def test(b, rnd):
+    b.m.osd_scroll = 7 # register that doesn't exist
+    fb = b.fb
+    for k in range(500):
+      if k % 50 == 0:
+        fb.move_dir_page(rnd.choice((1, -1)))
+      else:
+        fb.move_dir_cursor(rnd.choice((1, -1, 1, 5, -19, 300)))
+      assert b.m.osd_scroll == 7
+      b.m.osd_scroll = 0 # top line as shown
+      b.check()
+      b.m.osd_scroll = 7
+  run(test, 0)
+
+
+def test_without_catalog(): # catalog.py not uploaded
+  catalog = osdfb.catalog
+  osdfb.catalog = None
+  try:
+    def test(b, rnd):
+      b.fb.read_dir()
+      for k in range(100):
+        b.fb.move_dir_cursor(rnd.choice((1, -1, 20)))
+        b.check()
+    run(test)
+  finally:
+    osdfb.catalog = catalog
+
+
+if __name__ == "__main__":
+  for name, f in sorted(globals().items()):
+    if name.startswith("test_"):
+      f()
+      print(name, "ok")
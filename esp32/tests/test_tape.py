@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+# .tap/.tzx loads against spimodel. the model has no CPU, ROM
+# init after reset is done by romspectrum: system variables
+# are set when CPU first runs out of reset, like ROM does.
+# BASIC loader and CODE block must be in RAM, started at USR
+# with SP at CLEAR, after one ROM init poll and without
+# reading RAM while CPU runs. POKEs of the loader are done.
+
+# LICENSE=BSD
+
+# usage:
+#   python3 -m pytest esp32/tests
+#   python3 esp32/tests/test_tape.py
+
+import io
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.normpath(os.path.join(HERE, "..", ".."))
+sys.path[0:0] = [os.path.join(ROOT, "esp32")]
+
+import spimodel
+import spibus
+import spidiff
+import ld_zxspectrum
+import ld_tape
+
+ROM = open(os.path.join(ROOT, "roms", "opense.rom"), "rb").read()
+CODE = bytes((i * 7 + 3) & 0xFF for i in range(3000))
+
+
+# ROM init when CPU runs out of reset: CHANS and PROG as set
+# by 48K ROM, with RAM top at 0xFF57, DF_SZ last
+class romspectrum(spimodel.spimodel):
+  def write_reg(self, a3, b):
+    reset = a3 == 0xFF and self.ctrl & 1
+    spimodel.spimodel.write_reg(self, a3, b)
+    if reset and not b & 3:
+      for addr, word in ((ld_tape.SV_CHANS, 0x5CB6), (ld_tape.SV_PROG, ld_tape.PROG), (ld_tape.SV_RAMTOP, 0xFF57)):
+        a = self.phys(addr)
+        self.ram[a:a+2] = struct.pack("<H", word)
+      self.ram[self.phys(ld_tape.SV_DF_SZ)] = 2
+
+
+def number(n):
+  return str(n).encode() + b"\x0E\x00\x00" + struct.pack("<H", n) + b"\x00"
+
+
+# 10 CLEAR 24999: LOAD ""CODE: RANDOMIZE USR 25000
+# with more statements before USR
+def basic(clear, usr, more=b""):
+  line = b"\xFD" + number(clear) + b":\xEF\"\"\xAF:" + more + b"\xF9\xC0" + number(usr) + b"\x0D"
+  return struct.pack(">HH", 10, len(line)) + line
+
+
+def block(flag, data):
+  check = flag
+  for b in data:
+    check ^= b
+  return bytes([flag]) + data + bytes([check])
+
+
+def header(btype, name, length, param1, param2):
+  return block(0, struct.pack("<B10sHHH", btype, name.ljust(10).encode(), length, param1, param2))
+
+
+def tape_blocks(clear=24999, usr=25000, more=b""):
+  prog = basic(clear, usr, more)
+  return [
+    header(0, "loader", len(prog), 10, len(prog)),
+    block(0xFF, prog),
+    header(3, "code", len(CODE), usr, 32768),
+    block(0xFF, CODE),
+  ]
+
+
+def tap(blocks):
+  return b"".join(struct.pack("<H", len(b)) + b for b in blocks)
+
+
+def tzx(blocks):
+  out = b"ZXTape!\x1A\x01\x14"
+  out += b"\x30\x05hello" # text block is skipped
+  for b in blocks:
+    out += b"\x10" + struct.pack("<HH", 1000, len(b)) + b
+  return out
+
+
+def load(cls, name, data):
+  slept = []
+  sleep = ld_tape.sleep
+  ld_tape.sleep = slept.append
+  d = tempfile.mkdtemp()
+  stdout = sys.stdout
+  sys.stdout = printed = io.StringIO()
+  try:
+    path = os.path.join(d, name)
+    with open(path, "wb") as f:
+      f.write(data)
+    m = romspectrum(ROM)
+    ld_zxspectrum.ld_zxspectrum(cls(m, m)).loadtap(path)
+  finally:
+    sys.stdout = stdout
+    ld_tape.sleep = sleep
+    shutil.rmtree(d)
+  m.printed = printed.getvalue()
+  return m, sum(slept)
+
+
+def check(m, slept, clear=24999, usr=25000, more=b""):
+  assert abs(slept - 0.01) < 1e-6, slept # ROM init seen at first poll
+  assert m.unhalted_reads == 0
+  ram = m.cpu_view()
+  prog = basic(clear, usr, more)
+  assert ram[ld_tape.PROG:ld_tape.PROG+len(prog)] == prog
+  assert ram[usr:usr+len(CODE)] == CODE
+  assert struct.unpack("<H", ram[ld_tape.SV_RAMTOP:ld_tape.SV_RAMTOP+2])[0] == clear
+  assert struct.unpack("<H", ram[ld_tape.SV_VARS:ld_tape.SV_VARS+2])[0] == ld_tape.PROG+len(prog)
+  assert m.ctrl_log[-1] == 4 # boot stub
+  stub = m.boot_ram
+  assert stub[spibus.BOOT_JP] == 0xC3
+  assert struct.unpack("<H", stub[spibus.BOOT_JP+1:spibus.BOOT_JP+3])[0] == usr
+  sp = ld_zxspectrum.BOOT_HEADER+8
+  assert struct.unpack("<H", stub[sp:sp+2])[0] == clear
+
+
+def test_tap():
+  for cls in (spibus.spibus, spidiff.spidiff):
+    m, slept = load(cls, "game.tap", tap(tape_blocks()))
+    check(m, slept)
+
+
+def test_tzx():
+  m, slept = load(spibus.spibus, "game.tzx", tzx(tape_blocks(30000, 32000)))
+  check(m, slept, 30000, 32000)
+
+
+# 5 POKE 25001,9
+# 10 CLEAR 24999: LOAD ""CODE: POKE 23692,255: POKE 32768,1:
+#    GO TO 20: RANDOMIZE USR 25000
+# POKEs before USR are done, POKE 25001 is overwritten by the
+# CODE block loaded after it, GO TO is reported as not run
+def test_basic_pokes():
+  more = b"\xF4" + number(23692) + b"," + number(255) + b":" + \
+    b"\xF4" + number(32768) + b"," + number(1) + b":\xEC" + number(20) + b":"
+  line = b"\xF4" + number(25001) + b"," + number(9) + b"\x0D"
+  prog = struct.pack(">HH", 5, len(line)) + line + basic(24999, 25000, more)
+  blocks = [header(0, "loader", len(prog), 5, len(prog)), block(0xFF, prog)] + tape_blocks()[2:]
+  m, slept = load(spibus.spibus, "game.tap", tap(blocks))
+  ram = m.cpu_view()
+  assert ram[ld_tape.PROG:ld_tape.PROG+len(prog)] == prog
+  assert ram[25000:25000+len(CODE)] == CODE
+  assert ram[23692] == 255
+  assert ram[32768] == 1
+  assert "statement EC" in m.printed
+  assert struct.unpack("<H", m.boot_ram[spibus.BOOT_JP+1:spibus.BOOT_JP+3])[0] == 25000
+
+
+# without ROM init DF_SZ stays 0, load waits init_ms and goes on
+def test_rom_timeout():
+  slept = []
+  sleep = ld_tape.sleep
+  ld_tape.sleep = slept.append
+  try:
+    m = spimodel.spimodel(ROM)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+      assert ld_tape.ld_tape(ld_zxspectrum.ld_zxspectrum(spibus.spibus(m, m)), 200).rom_init() == 0
+    finally:
+      sys.stdout.close()
+      sys.stdout = stdout
+  finally:
+    ld_tape.sleep = sleep
+  assert abs(sum(slept) - 0.2) < 1e-6
+  assert m.unhalted_reads == 0
+  assert m.ctrl & 2 # halted
+
+
+if __name__ == "__main__":
+  for name, f in sorted(globals().items()):
+    if name.startswith("test_"):
+      f()
+      print(name, "ok")
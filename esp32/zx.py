@@ -20,6 +20,9 @@ import os
 
 import ecp5
 import gc
+import spidiff
+import spicalib
+import ld_rom
 
 class zx:
   def __init__(self):
@@ -39,71 +42,147 @@ class zx:
   def init_spi(self):
     self.spi=SPI(self.spi_channel, baudrate=self.spi_freq, polarity=0, phase=0, bits=8, firstbit=SPI.MSB, sck=Pin(self.gpio_sck), mosi=Pin(self.gpio_mosi), miso=Pin(self.gpio_miso))
     self.cs=Pin(self.gpio_cs, Pin.OUT)
-    self.cs.off()
+    self.calib=spicalib.spicalib(self.spi,self.cs)
+    self.spi_freq=self.calib.init() # stored or calibrated clock
+    self.bus=spidiff.spidiff(self.spi,self.cs)
+    self.rom_manager=ld_rom.ld_rom(self.bus,rom0="/sd/zxspectrum/roms/128-0.rom")
 
+  # load again when readback failed, see spicalib.checked
+  def checked(self,load,*args):
+    self.calib.checked(self.bus,self.rom_manager,load,*args)
+    self.spi_freq=self.calib.freq
 
   def loadz80(self,filename):
     import ld_zxspectrum
-    s=ld_zxspectrum.ld_zxspectrum(self.spi,self.cs)
-    s.loadz80(filename)
+    s=ld_zxspectrum.ld_zxspectrum(self.bus,self.rom_manager)
+    self.checked(s.loadz80,filename)
+
+  def loadsna(self,filename):
+    import ld_zxspectrum
+    s=ld_zxspectrum.ld_zxspectrum(self.bus,self.rom_manager)
+    self.checked(s.loadsna,filename)
+
+  def loadtap(self,filename):
+    import ld_zxspectrum
+    s=ld_zxspectrum.ld_zxspectrum(self.bus,self.rom_manager)
+    self.checked(s.loadtap,filename)
 
   def load(self,filename, addr=0x4000):
     import ld_zxspectrum
-    s=ld_zxspectrum.ld_zxspectrum(self.spi,self.cs)
+    s=ld_zxspectrum.ld_zxspectrum(self.bus,self.rom_manager)
+    self.checked(self.load_file,s,filename,addr)
+
+  def load_file(self,s,filename,addr):
     s.cpu_halt()
-    s.load_stream(open(filename, "rb"), addr=addr)
+    if addr < 0x4000:
+      self.rom_manager.forget()
+    s.load_file(filename,addr)
     s.cpu_continue()
 
+  # switch ROM, only differing bytes are written, and reset
+  def setrom(self,filename):
+    self.bus.cpu_halt()
+    self.rom_manager.load(filename)
+    self.bus.ctrl(3) # reset and halt
+    self.bus.ctrl(1) # only reset
+    self.bus.cpu_continue()
+
+  # .z80 is saved compressed with header, other files raw
   def save(self,filename, addr=0x4000, length=0xC000):
     import ld_zxspectrum
-    s=ld_zxspectrum.ld_zxspectrum(self.spi,self.cs)
+    s=ld_zxspectrum.ld_zxspectrum(self.bus,self.rom_manager)
+    if filename.endswith(".z80"):
+      s.savez80(filename)
+      return
     f=open(filename, "wb")
     s.cpu_halt()
     s.save_stream(f, addr, length)
     s.cpu_continue()
     f.close()
 
-  def peek(self,addr,length=1):
+  def savez80(self,filename,pc=-1,sp=-1):
     import ld_zxspectrum
-    s=ld_zxspectrum.ld_zxspectrum(self.spi,self.cs)
-    s.cpu_halt()
-    s.cs.on()
-    s.spi.write(bytearray([1,(addr >> 24) & 0xFF, (addr >> 16) & 0xFF, (addr >> 8) & 0xFF, addr & 0xFF, 0]))
-    b=bytearray(length)
-    s.spi.readinto(b)
-    s.cs.off()
-    s.cpu_continue()
+    s=ld_zxspectrum.ld_zxspectrum(self.bus,self.rom_manager)
+    s.savez80(filename,pc,sp)
+
+  def peek(self,addr,length=1):
+    self.bus.cpu_halt()
+    b=self.bus.peek(addr,length)
+    self.bus.cpu_continue()
     return b
 
   def poke(self,addr,data):
-    import ld_zxspectrum
-    s=ld_zxspectrum.ld_zxspectrum(self.spi,self.cs)
-    s.cpu_halt()
-    s.cs.on()
-    s.spi.write(bytearray([0,(addr >> 24) & 0xFF, (addr >> 16) & 0xFF, (addr >> 8) & 0xFF, addr & 0xFF]))
-    s.spi.write(data)
-    s.cs.off()
-    s.cpu_continue()
+    self.bus.cpu_halt()
+    if addr < 0x4000:
+      self.rom_manager.forget()
+    self.bus.poke(addr,data)
+    self.bus.cpu_continue()
+
+  # list of (addr,length), all read in one CPU halt
+  def peek_many(self,peeks):
+    self.bus.cpu_halt()
+    b=self.bus.peek_many(peeks)
+    self.bus.cpu_continue()
+    return b
+
+  # list of (addr,data), all written in one CPU halt
+  def poke_many(self,pokes):
+    self.bus.cpu_halt()
+    for addr,data in pokes:
+      if addr < 0x4000:
+        self.rom_manager.forget()
+        break
+    self.bus.poke_many(pokes)
+    self.bus.cpu_continue()
+
+# one zx object and SPI for all module functions
+zx_session=None
+
+def session():
+  global zx_session
+  if zx_session is None:
+    zx_session=zx()
+  return zx_session
 
 def peek(addr,length=1):
-  s=zx()
+  s=session()
   return s.peek(addr,length)
 
 def poke(addr,data):
-  s=zx()
-  s.peek(addr,data)
+  s=session()
+  s.poke(addr,data)
+
+def peek_many(peeks):
+  s=session()
+  return s.peek_many(peeks)
+
+def poke_many(pokes):
+  s=session()
+  s.poke_many(pokes)
 
 def loadz80(filename):
-  s=zx()
+  s=session()
   s.loadz80(filename)
 
+def loadsna(filename):
+  s=session()
+  s.loadsna(filename)
+
+def loadtap(filename):
+  s=session()
+  s.loadtap(filename)
+
 def load(filename, addr=0x4000):
-  s=zx()
+  s=session()
   s.load(filename, addr)
 
 def save(filename, addr=0x4000, length=0xC000):
-  s=zx()
+  s=session()
   s.save(filename,addr,length)
+
+def savez80(filename,pc=-1,sp=-1):
+  s=session()
+  s.savez80(filename,pc,sp)
   
 os.mount(SDCard(slot=3),"/sd")
 ecp5.prog("/sd/zxspectrum/bitstreams/zxspectrum12f.bit")
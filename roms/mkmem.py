@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+# build $readmemh init image for dpram from ROM, raw and snapshot files
+# inputs are placed in given order, later ones overwrite earlier:
+#   file.rom         raw bytes at 0
+#   file.bin@0x8000  raw bytes at 0x8000
+#   game.z80         48K snapshot RAM at 0x4000, .sna too. ROM start
+#                    is patched by ld_zxspectrum.patch_rom, so the game
+#                    starts with its registers after FPGA configuration
+# image is read back after writing. first line holds sha1 of the
+# inputs, when it matches the output is left untouched, so make
+# doesn't resynthesize.
+
+# LICENSE=BSD
+
+# usage:
+#   mkmem.py -o spectrum48.mem opense.rom
+#   mkmem.py -o game.mem opense.rom ../snapshots/wow.z80
+#   mkmem.py --each ../snapshots --outdir mem opense.rom   # mem/<name>.mem
+
+import argparse
+import concurrent.futures
+import hashlib
+import os
+import struct
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.normpath(os.path.join(HERE, "..", "esp32")))
+sys.path.insert(0, os.path.normpath(os.path.join(HERE, "..", "esp32", "converter")))
+
+import ld_zxspectrum
+import zxcatalog
+
+VERSION = b"mkmem1"
+SNAPSHOTS = (".z80", ".sna")
+
+
+# ld_zxspectrum.patch_rom writes through bus.poke
+class membus:
+  def __init__(self, image, used):
+    self.image = image
+    self.used = used
+
+  def poke(self, addr, data):
+    place(self.image, self.used, addr, data)
+
+
+def place(image, used, addr, data):
+  if addr < 0 or addr + len(data) > len(image):
+    raise ValueError("%d bytes at 0x%04X don't fit %d bytes" % (len(data), addr, len(image)))
+  image[addr:addr + len(data)] = data
+  used[addr:addr + len(data)] = b"\x01" * len(data)
+
+
+# "file@addr" -> (file, addr), addr -1 for snapshots
+def parse_input(spec):
+  name, at, addr = spec.rpartition("@")
+  if not at:
+    name, addr = spec, None
+  snapshot = os.path.splitext(name)[1].lower() in SNAPSHOTS
+  if snapshot:
+    if addr is not None:
+      raise ValueError("%s: snapshot has no address" % spec)
+    return name, -1
+  return name, int(addr, 0) if addr is not None else 0
+
+
+# snapshot -> (RAM 0x4000-0xFFFF, pc, z80 header), pc None if
+# it has no registers
+def snapshot(name, data):
+  if name.lower().endswith(".z80"):
+    version, mem128, mem, screen = zxcatalog.decode_z80(data)
+    header = bytearray(data[0:30])
+    if version == 1:
+      pc = struct.unpack("<H", header[6:8])[0]
+    else:
+      pc = struct.unpack("<H", data[32:34])[0]
+  else:
+    version, mem128, mem, screen = zxcatalog.decode_sna(data)
+    if version == 0: # raw RAM dump, no registers to start with
+      return mem, None, None
+    sna = data[0:27]
+    sp = struct.unpack("<H", sna[23:25])[0]
+    if sp < 0x4000 or sp >= 0xFFFF:
+      raise zxcatalog.broken("SP 0x%04X is not in RAM" % sp)
+    pc = struct.unpack("<H", mem[sp - 0x4000:sp - 0x4000 + 2])[0]
+    header = ld_zxspectrum.ld_zxspectrum(None).sna2z80(sna, (sp + 2) & 0xFFFF)
+  if mem128:
+    raise zxcatalog.broken("128K snapshot doesn't fit 64K dpram")
+  return mem, pc, header
+
+
+def digest(inputs, size, start):
+  h = hashlib.sha1(VERSION)
+  h.update(struct.pack("<LB", size, start))
+  for name, addr, data in inputs:
+    h.update(struct.pack("<lB", addr, name.lower().endswith(".z80")))
+    h.update(hashlib.sha1(data).digest())
+  return h.hexdigest()
+
+
+def build(inputs, size, start):
+  image = bytearray(size)
+  used = bytearray(size)
+  patch = None
+  for name, addr, data in inputs:
+    if addr < 0:
+      mem, pc, header = snapshot(name, data)
+      place(image, used, 0x4000, mem)
+      patch = (pc, header) if pc is not None else None
+    else:
+      place(image, used, addr, data)
+  if patch and start: # after all inputs, ROM may come later
+    loader = ld_zxspectrum.ld_zxspectrum(membus(image, used))
+    loader.patch_rom(patch[0], patch[1])
+  return image, used
+
+
+# contiguous used ranges as (start, end)
+def ranges(used):
+  r = []
+  i = used.find(1)
+  while i >= 0:
+    end = used.find(0, i)
+    if end < 0:
+      end = len(used)
+    r.append((i, end))
+    i = used.find(1, end)
+  return r
+
+
+def write_mem(filename, header, image, used):
+  with open(filename, "w") as f:
+    f.write("// %s\n" % header)
+    addr = 0
+    for start, end in ranges(used):
+      if start != addr:
+        f.write("@%x\n" % start)
+      f.write(image[start:end].hex("\n", 1))
+      f.write("\n")
+      addr = end
+
+
+def read_mem(filename, size):
+  image = bytearray(size)
+  used = bytearray(size)
+  addr = 0
+  with open(filename) as f:
+    for line in f:
+      line = line.split("//")[0]
+      for word in line.split():
+        if word[0] == "@":
+          addr = int(word[1:], 16)
+        else:
+          image[addr] = int(word, 16)
+          used[addr] = 1
+          addr += 1
+  return image, used
+
+
+def first_line(filename):
+  try:
+    with open(filename) as f:
+      return f.readline().rstrip("\n")
+  except OSError:
+    return None
+
+
+# returns message, raises on error
+def mkmem(out, specs, size=0x10000, start=True, force=False):
+  inputs = []
+  for spec in specs:
+    name, addr = parse_input(spec)
+    with open(name, "rb") as f:
+      inputs.append((name, addr, f.read()))
+  header = "mkmem sha1 %s" % digest(inputs, size, start)
+  if not force and first_line(out) == "// " + header:
+    return "%s up to date" % out
+  image, used = build(inputs, size, start)
+  tmp = out + ".tmp"
+  write_mem(tmp, header, image, used)
+  if read_mem(tmp, size) != (image, used):
+    os.remove(tmp)
+    raise ValueError("%s readback differs" % out)
+  os.replace(tmp, out)
+  return "%s %d bytes in %d ranges" % (out, sum(used), len(ranges(used)))
+
+
+def job(args):
+  out, specs, size, start, force = args
+  try:
+    return 0, mkmem(out, specs, size, start, force)
+  except (OSError, ValueError, zxcatalog.broken) as e:
+    return 1, "%s: %s" % (out, e)
+
+
+def main():
+  ap = argparse.ArgumentParser(description="build dpram .mem init image from ROM, raw and snapshot files")
+  ap.add_argument("inputs", nargs="+", help="file[@addr], .z80/.sna snapshots go to 0x4000")
+  ap.add_argument("-o", "--out", help="output .mem file")
+  ap.add_argument("--each", help="one image per .z80/.sna in this directory, added to inputs")
+  ap.add_argument("--outdir", default=".", help="output directory for --each")
+  ap.add_argument("--size", type=lambda s: int(s, 0), default=0x10000, help="memory size")
+  ap.add_argument("--no-start", action="store_true", help="snapshot RAM only, don't patch ROM start")
+  ap.add_argument("--force", action="store_true", help="rebuild even if inputs are unchanged")
+  ap.add_argument("--jobs", type=int, default=os.cpu_count(), help="parallel builds for --each")
+  args = ap.parse_args()
+
+  if args.each:
+    os.makedirs(args.outdir, exist_ok=True)
+    jobs = []
+    for name in sorted(os.listdir(args.each)):
+      stem, ext = os.path.splitext(name)
+      if ext.lower() in SNAPSHOTS:
+        jobs.append((os.path.join(args.outdir, stem + ".mem"), args.inputs + [os.path.join(args.each, name)],
+          args.size, not args.no_start, args.force))
+  elif args.out:
+    jobs = [(args.out, args.inputs, args.size, not args.no_start, args.force)]
+  else:
+    ap.error("-o or --each is needed")
+
+  errors = 0
+  with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+    for status, message in pool.map(job, jobs):
+      print(message)
+      errors += status
+  return 1 if errors else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -1,19 +1,23 @@
-module dpram (
+module dpram
+#(
+  parameter MEM_INIT_FILE = "",
+  parameter ADDR_WIDTH = 16,
+  parameter MEM_SIZE = 1 << ADDR_WIDTH
+)
+(
   // Port A
-  input            clk_a,
-  input            we_a,
-  input [15:0]     addr_a,
-  input [7:0]      din_a,
-  output reg [7:0] dout_a,
+  input                  clk_a,
+  input                  we_a,
+  input [ADDR_WIDTH-1:0] addr_a,
+  input [7:0]            din_a,
+  output reg [7:0]       dout_a,
   // Port B
-  input            clk_b,
-  input [15:0]     addr_b,
-  output reg [7:0] dout_b
+  input                  clk_b,
+  input [ADDR_WIDTH-1:0] addr_b,
+  output reg [7:0]       dout_b
 );
 
-  parameter MEM_INIT_FILE = "";
-   
-  reg [7:0] ram [0:65535];
+  reg [7:0] ram [0:MEM_SIZE-1];
 
   initial
     if (MEM_INIT_FILE != "")
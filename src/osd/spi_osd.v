@@ -5,6 +5,7 @@ module spi_osd
 #(
   parameter [7:0] c_addr_enable  = 8'hFE, // high addr byte of enable byte
   parameter [7:0] c_addr_display = 8'hFD, // high addr byte of display data, +0x10000 for inverted
+  parameter [7:0] c_addr_scroll  = 8'hFC, // high addr byte of scroll, tile row shown on top line
   parameter c_start_x   = 64,  // x1  pixel window h-position
   parameter c_start_y   = 48,  // x1  pixel window v-position
   parameter c_chars_x   = 64,  // x8  pixel window h-size
@@ -70,12 +71,23 @@ module spi_osd
         osd_en <= ram_di[0];
     end
 
+    // hardware scroll: line y shows tile row (y+scroll) mod c_chars_y
+    // scroll is clamped to c_chars_y-1, so tilerow wraps with one subtraction
+    reg [7:0] scroll = 0;
+    always @(posedge clk_pixel)
+    begin
+      if(ram_wr && (ram_addr[31:24] == c_addr_scroll)) // write to 0xFCxxxxxx sets top tile row
+        scroll <= ram_di < c_chars_y ? ram_di : c_chars_y-1;
+    end
+
     wire [9:0] osd_x, osd_y;
     reg [7:0] font[0:4095];
     initial
       $readmemb(c_font_file, font);
     reg [7:0] data_out;
-    wire [11:0] tileaddr = (osd_y >> 4) * c_chars_x + (osd_x >> 3);
+    wire [9:0] tilerow_sum = (osd_y >> 4) + scroll;
+    wire [9:0] tilerow = tilerow_sum >= c_chars_y ? tilerow_sum - c_chars_y : tilerow_sum;
+    wire [11:0] tileaddr = tilerow * c_chars_x + (osd_x >> 3);
     generate
       if(c_inverse)
         always @(posedge clk_pixel)
@@ -6,7 +6,9 @@ module spectrum
   // darfon  : C_report_bytes= 8, C_report_bytes_strict=1
   parameter C_report_bytes=8, // 8:usual joystick, 20:xbox360
   parameter C_report_bytes_strict=1, // 0:when report length is variable/unknown
-  parameter C_autofire_hz=10  // joystick trigger and bumper
+  parameter C_autofire_hz=10, // joystick trigger and bumper
+  parameter C_mem128=0, // 1:128K banked RAM paged by port 0x7FFD (160K BRAM, 45F/85F), 0:48K (64K BRAM)
+  parameter C_mem_init_file="../roms/spectrum48.mem" // dpram init image, ulx3s make builds its own
 )
 (
   input         clk25_mhz,
@@ -135,7 +137,8 @@ module spectrum
   reg [7:0] R_cpu_control;
   wire loading = R_cpu_control[1];
 
-  wire n_hard_reset = pwr_up_reset_n & btn[0] & ~R_cpu_control[0];
+  reg [7:0] R_boot_reset = 0; // reset pulse from control bit 2, cpuClock cycles
+  wire n_hard_reset = pwr_up_reset_n & btn[0] & ~R_cpu_control[0] & R_boot_reset == 0;
 
   tv80n cpu1 (
     .reset_n(n_hard_reset),
@@ -252,6 +255,109 @@ module spectrum
     end
   end
 
+  // ===============================================================
+  // Boot stub, starts snapshot with its registers without ROM patch
+  // ===============================================================
+  // ESP32 writes register restore code and data to 256 bytes at
+  // SPI 0xF9000000, then control register with bit 2: CPU gets
+  // a reset pulse and reads 0x0000-0x00FF from the stub. the
+  // first opcode fetch after the JP at C_boot_jp (to snapshot PC)
+  // reads memory again, stub is unmapped.
+  localparam C_boot_jp = 16'h007D;
+  reg [7:0] R_boot_ram [0:255];
+  reg [7:0] boot_out;
+  reg R_boot = 0; // stub mapped at 0x0000
+  reg R_boot_jp = 0; // JP fetched, next opcode from memory
+  reg old_n_M1;
+
+  always @(posedge cpuClock) begin
+    if (spi_ram_wr && spi_ram_addr[31:24] == 8'hF9)
+      R_boot_ram[spi_ram_addr[7:0]] <= spi_ram_di;
+    boot_out <= R_boot_ram[cpuAddress[7:0]];
+  end
+
+  always @(posedge cpuClock) begin
+    old_n_M1 <= n_M1;
+    if (!pwr_up_reset_n || !btn[0]) begin
+      R_boot <= 0;
+      R_boot_reset <= 0;
+    end else if (spi_ram_wr && spi_ram_addr[31:24] == 8'hFF) begin
+      R_boot <= spi_ram_di[2];
+      R_boot_jp <= 0;
+      R_boot_reset <= spi_ram_di[2] ? 8'hFF : 8'h00;
+    end else begin
+      if (R_boot_reset != 0)
+        R_boot_reset <= R_boot_reset - 1;
+      if (!n_M1 && old_n_M1 && R_boot_reset == 0) begin // opcode fetch
+        if (R_boot_jp)
+          R_boot <= 0;
+        else if (cpuAddress == C_boot_jp)
+          R_boot_jp <= R_boot;
+      end
+    end
+  end
+
+  // ===============================================================
+  // 128K paging, port 0x7FFD
+  // ===============================================================
+  // bits 2-0 RAM bank at 0xC000, bit 3 screen from bank 7,
+  // bit 4 ROM 1 (48 BASIC), bit 5 locked until reset.
+  // starts as locked 48K machine with ROM 1. ESP32 writes it
+  // at SPI 0xFA000000 before loading, CPU reset keeps it.
+  reg [7:0] R_port_7ffd = 8'h30;
+  wire port_7ffd_we = ~cpuAddress[15] & ~cpuAddress[1] & ~n_IORQ & ~n_WR & n_M1;
+  reg old_port_7ffd_we;
+  wire [7:0] port_7ffd = C_mem128 ? R_port_7ffd : 8'h30;
+
+  always @(posedge cpuClock) begin
+    old_port_7ffd_we <= port_7ffd_we;
+    if (!pwr_up_reset_n || !btn[0])
+      R_port_7ffd <= 8'h30;
+    else if (spi_ram_wr && spi_ram_addr[31:24] == 8'hFA)
+      R_port_7ffd <= spi_ram_di;
+    else if (port_7ffd_we && !old_port_7ffd_we && !R_port_7ffd[5])
+      R_port_7ffd <= cpuDataOut;
+  end
+
+  // dpram is made of 16K slots: 0 ROM 1, 1-3 banks 5,2,0 so
+  // slots 0-3 are the 48K map, 4-8 banks 1,3,4,6,7, 9 ROM 0
+  function [3:0] bank_slot;
+    input [2:0] bank;
+    case (bank)
+      3'd0: bank_slot = 4'd3;
+      3'd1: bank_slot = 4'd4;
+      3'd2: bank_slot = 4'd2;
+      3'd3: bank_slot = 4'd5;
+      3'd4: bank_slot = 4'd6;
+      3'd5: bank_slot = 4'd1;
+      3'd6: bank_slot = 4'd7;
+      default: bank_slot = 4'd8;
+    endcase
+  endfunction
+
+  // slot seen by CPU in 16K area a
+  function [3:0] view_slot;
+    input [1:0] a;
+    input [7:0] port;
+    case (a)
+      2'd0: view_slot = port[4] ? 4'd0 : 4'd9;
+      2'd1: view_slot = 4'd1;
+      2'd2: view_slot = 4'd2;
+      default: view_slot = bank_slot(port[2:0]);
+    endcase
+  endfunction
+
+  // SPI RAM address 0x00000-0x0FFFF: as seen by CPU,
+  // 0x10000 + 0x4000*n, n=0-9: ROM 1, ROM 0, banks 0-7 in order
+  // (.z80 page p at 0xC000 + 0x4000*p except ROM 1 page 0)
+  wire [3:0] spi_linear = spi_ram_addr[17:14] - 4'd4;
+  wire [3:0] spi_slot = spi_ram_addr[23:16] == 0 ? view_slot(spi_ram_addr[15:14], port_7ffd) :
+                        spi_linear == 0 ? 4'd0 :
+                        spi_linear == 1 ? 4'd9 :
+                        bank_slot(spi_linear[2:0] - 3'd2);
+  wire spi_ram_valid = spi_ram_addr[31:24] == 8'h00 &&
+                       (spi_ram_addr[23:16] == 0 || (C_mem128 && spi_ram_addr[23:18] == 0 && spi_linear <= 4'd9));
+
   // ===============================================================
   // Border color and sound
   // ===============================================================
@@ -276,18 +382,24 @@ module spectrum
   wire [7:0] attrOut;
   wire [12:0] attr_addr;
 
+  wire [17:0] cpu_phys = {view_slot(cpuAddress[15:14], port_7ffd), cpuAddress[13:0]};
+  wire [17:0] spi_phys = {spi_slot, spi_ram_addr[13:0]};
+  wire [17:0] vga_phys = {port_7ffd[3] ? 4'd8 : 4'd1, 1'b0, vga_addr}; // bank 7 or 5
+
   dpram
   #(
-    .MEM_INIT_FILE("../roms/spectrum48.mem")
+    .MEM_INIT_FILE(C_mem_init_file),
+    .ADDR_WIDTH(C_mem128 ? 18 : 16),
+    .MEM_SIZE(C_mem128 ? 10*16384 : 65536)
   )
   ram48 (
     .clk_a(cpuClock),
-    .we_a(loading ? spi_ram_wr  && spi_ram_addr[31:24] == 8'h00 : !n_ramCS & !n_memWR),
-    .addr_a(loading ? spi_ram_addr[15:0] : cpuAddress),
+    .we_a(loading ? spi_ram_wr && spi_ram_valid : !n_ramCS & !n_memWR),
+    .addr_a(loading ? spi_phys : cpu_phys),
     .din_a(loading ? spi_ram_di : cpuDataOut),
     .dout_a(ramOut),
     .clk_b(clk_vga),
-    .addr_b({3'b010, vga_addr}),
+    .addr_b(vga_phys),
     .dout_b(vidOut)
   );
 
@@ -408,6 +520,7 @@ module spectrum
 
   assign cpuDataIn =  n_kbdCS == 1'b0 ? {3'b111, key_data} :
                       n_joyCS == 1'b0 ? {2'b0, R_btn_joy[2], R_btn_joy[1], R_btn_joy[3], R_btn_joy[4], R_btn_joy[5], R_btn_joy[6]} : // x x (x or FIRE2 on modified hardware) FIRE1 UP DOWN LEFT RIGHT
+                      R_boot && cpuAddress[15:8] == 0 ? boot_out :
                       ramOut;
 
   // ===============================================================
@@ -2,6 +2,9 @@ PIN_DEF ?= ulx3s_v20.lpf
 
 DEVICE ?= 85k
 
+# 128K machine needs 160K BRAM, 12k and 25k have 72K and 126K
+MEM128 ?= $(if $(filter %45k %85k,$(DEVICE)),1,0)
+
 BUILDDIR = bin
 
 compile: $(BUILDDIR)/toplevel.bit
@@ -9,9 +12,9 @@ compile: $(BUILDDIR)/toplevel.bit
 prog: $(BUILDDIR)/toplevel.bit
 	ujprog $^
 
-$(BUILDDIR)/toplevel.json: $(VERILOG)
+$(BUILDDIR)/toplevel.json: $(VERILOG) $(MEM)
 	mkdir -p $(BUILDDIR)
-	yosys -p "synth_ecp5 -json $@" $^
+	yosys -p "chparam -set C_mem128 $(MEM128) $(if $(MEM),-set C_mem_init_file \"$(MEM)\") spectrum; synth_ecp5 -json $@" $(VERILOG)
 
 $(BUILDDIR)/%.config: $(PIN_DEF) $(BUILDDIR)/toplevel.json
 	nextpnr-ecp5 --${DEVICE} --package CABGA381 --timing-allow-fail --freq 25 --textcfg  $@ --json $(filter-out $<,$^) --lpf $<
@@ -23,4 +26,4 @@ clean:
 	rm -rf ${BUILDDIR}
 
 .SECONDARY:
-.PHONY: compile clean prog
+.PHONY: compile clean prog FORCE